@@ -14,13 +14,32 @@
 
 """API authentication utility."""
 
+import collections
+import logging
+import os
+import threading
+import time
+
 from apiclient import discovery
+from apiclient import errors
 import httplib2
 
 from oauth2client import appengine as oauth_appengine
 
 from google.appengine.api import memcache
 
+from src import parallel
+
+# Discovery documents may be bundled with the app as <name>.<version>.json in
+# this directory so that cold starts need not fetch them at all.
+DISCOVERY_DOC_DIR = os.path.join(os.path.dirname(__file__), 'discovery')
+# Bump to force every instance to refetch documents cached in memcache.
+DISCOVERY_CACHE_VERSION = 1
+DISCOVERY_CACHE_SECONDS = 24 * 60 * 60
+
+# Documents read in this process, as (content, expiry time) by cache key.
+_discovery_docs = {}
+
 
 class Service(object):
 
@@ -49,7 +68,154 @@ class Service(object):
     Returns:
       The authorized service.
     """
-    service = discovery.build(name, version,
-                              http=Service.HttpFromServiceAccount(scope),
-                              developerKey=developer_key)
+    service = discovery.build_from_document(
+        Service.DiscoveryDocument(name, version),
+        http=Service.HttpFromServiceAccount(scope),
+        developerKey=developer_key)
     return service
+
+  @staticmethod
+  def FromPool(name, version, scope, developer_key=None):
+    """Returns a pooled service authenticated by the service account.
+
+    Args:
+      name: The service name.
+      version: The service API version.
+      scope: Desired service API scope.
+      developer_key: The simple API key (optional).
+
+    Returns:
+      The authorized service, shared with other callers on this thread (and
+      with later threads once this one releases it).
+    """
+    return _POOL.Get(name, version, scope, developer_key)
+
+  @staticmethod
+  def DiscoveryDocument(name, version):
+    """Returns the discovery document for an API.
+
+    Documents are looked up in this process, then in memcache, then among
+    the documents bundled in DISCOVERY_DOC_DIR and only then fetched from
+    the discovery service. Both caches keep them for DISCOVERY_CACHE_SECONDS.
+
+    Args:
+      name: The service name.
+      version: The service API version.
+
+    Returns:
+      The discovery document as a JSON string.
+    """
+    key = 'discovery:%d:%s:%s' % (DISCOVERY_CACHE_VERSION, name, version)
+    (content, expires) = _discovery_docs.get(key, (None, 0))
+    if expires > time.time():
+      return content
+    content = memcache.get(key)
+    if not content:
+      path = os.path.join(DISCOVERY_DOC_DIR, '%s.%s.json' % (name, version))
+      if os.path.exists(path):
+        # Bundled documents are cheap to read again (and some are larger
+        # than memcache takes).
+        with open(path) as f:
+          content = f.read()
+      else:
+        content = Service._FetchDiscoveryDocument(name, version)
+        memcache.set(key, content, time=DISCOVERY_CACHE_SECONDS)
+    _discovery_docs[key] = (content, time.time() + DISCOVERY_CACHE_SECONDS)
+    return content
+
+  @staticmethod
+  def _FetchDiscoveryDocument(name, version):
+    """Fetches a discovery document from the discovery service."""
+    url = discovery.DISCOVERY_URI.format(api=name, apiVersion=version)
+    logging.info('Fetching discovery document %s', url)
+    resp, content = httplib2.Http().request(url)
+    if resp.status == 404:
+      raise errors.UnknownApiNameOrVersion(
+          'name: %s  version: %s' % (name, version))
+    if resp.status >= 400:
+      raise errors.HttpError(resp, content, uri=url)
+    return content
+
+
+class ClientPool(object):
+  """A process-wide pool of authorized API clients.
+
+  Credentials (and so their access tokens) are shared by every thread in the
+  process. The service objects, and the httplib2.Http they hold keep-alive
+  connections on, are not thread-safe so each is checked out to one thread
+  at a time. A thread keeps its clients until it calls Release, which the
+  worker threads of src.parallel do when they finish, so the clients (and
+  their open connections) are handed on to the next workers.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._credentials = {}
+    self._idle = {}
+    self._local = threading.local()
+    self.stats = collections.Counter()
+
+  def Credentials(self, scope):
+    """Returns the shared service account credentials for a scope."""
+    with self._lock:
+      credentials = self._credentials.get(scope)
+      if not credentials:
+        credentials = oauth_appengine.AppAssertionCredentials(scope)
+        self._credentials[scope] = credentials
+      return credentials
+
+  def Get(self, name, version, scope, developer_key=None):
+    """Returns an authorized service, building it on first use.
+
+    Args:
+      name: The service name.
+      version: The service API version.
+      scope: Desired service API scope.
+      developer_key: The simple API key (optional).
+
+    Returns:
+      The authorized service.
+    """
+    key = (name, version, scope, developer_key)
+    services = self._local.__dict__.setdefault('services', {})
+    service = services.get(key)
+    if not service:
+      with self._lock:
+        idle = self._idle.get(key)
+        if idle:
+          service = services[key] = idle.pop()
+    if service:
+      self._Count('hits')
+      return service
+    self._Count('misses')
+    http = self.Credentials(scope).authorize(http=httplib2.Http(memcache))
+    service = discovery.build_from_document(
+        Service.DiscoveryDocument(name, version), http=http,
+        developerKey=developer_key)
+    services[key] = service
+    logging.debug('Built %s %s client, pool stats: %r',
+                  name, version, dict(self.stats))
+    return service
+
+  def Release(self):
+    """Checks the clients of the calling thread back in for other threads."""
+    services = self._local.__dict__.pop('services', {})
+    with self._lock:
+      for (key, service) in services.iteritems():
+        self._idle.setdefault(key, []).append(service)
+
+  def Clear(self):
+    """Drops every pooled client and credential."""
+    with self._lock:
+      self._credentials.clear()
+      self._idle.clear()
+      self._local = threading.local()
+      self.stats.clear()
+
+  def _Count(self, stat):
+    with self._lock:
+      self.stats[stat] += 1
+
+
+_POOL = ClientPool()
+parallel.AtThreadExit(lambda: _POOL.Release())  # pylint: disable=unnecessary-lambda
@@ -0,0 +1,145 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""API authentication utility unit tests."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from src import auth
+from src import basetest
+from src import parallel
+
+
+class ClientPoolTest(basetest.TestCase):
+
+  def setUp(self):
+    super(ClientPoolTest, self).setUp()
+    self.pool = auth.ClientPool()
+    self.build = mock.patch.object(auth.discovery, 'build_from_document',
+                                   side_effect=lambda *a, **kw: mock.Mock())
+    mock.patch.object(auth.Service, 'DiscoveryDocument').start()
+    self.credentials = mock.patch.object(auth.oauth_appengine,
+                                         'AppAssertionCredentials')
+    self.mock_build = self.build.start()
+    self.mock_credentials = self.credentials.start()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(ClientPoolTest, self).tearDown()
+
+  def testReusesClients(self):
+    scope = 'https://www.googleapis.com/auth/bigquery'
+    first = self.pool.Get('bigquery', 'v2', scope)
+    self.assertIs(first, self.pool.Get('bigquery', 'v2', scope))
+    self.assertIsNot(first, self.pool.Get('compute', 'v1', scope))
+    self.assertEquals(2, self.mock_build.call_count)
+    self.mock_credentials.assert_called_once_with(scope)
+    self.assertEquals({'hits': 1, 'misses': 2}, dict(self.pool.stats))
+
+  def testClientsArePerThread(self):
+    scope = 'https://www.googleapis.com/auth/compute'
+    services = [self.pool.Get('compute', 'v1', scope)]
+    thread = threading.Thread(
+        target=lambda: services.append(self.pool.Get('compute', 'v1', scope)))
+    thread.start()
+    thread.join()
+    self.assertIsNot(services[0], services[1])
+    self.mock_credentials.assert_called_once_with(scope)
+
+  def testWorkerThreadsReuseClients(self):
+    scope = 'https://www.googleapis.com/auth/devstorage.full_control'
+    with mock.patch.object(auth, '_POOL', self.pool):
+      services = parallel.Map(
+          lambda _: auth.Service.FromPool('storage', 'v1beta2', scope),
+          range(40), max_workers=4)
+    # No more clients are built than there are workers at once.
+    self.assertLessEqual(self.pool.stats['misses'], 4)
+    self.assertEquals(40, self.pool.stats['hits'] + self.pool.stats['misses'])
+    self.assertLessEqual(len(set(id(s) for s in services)), 4)
+
+  def testReleaseChecksClientsIn(self):
+    scope = 'https://www.googleapis.com/auth/compute'
+    service = self.pool.Get('compute', 'v1', scope)
+    self.pool.Release()
+    services = []
+    thread = threading.Thread(
+        target=lambda: services.append(self.pool.Get('compute', 'v1', scope)))
+    thread.start()
+    thread.join()
+    self.assertIs(service, services[0])
+    self.assertIsNot(service, self.pool.Get('compute', 'v1', scope))
+
+
+class DiscoveryDocumentTest(basetest.TestCase):
+
+  def setUp(self):
+    super(DiscoveryDocumentTest, self).setUp()
+    auth._discovery_docs.clear()
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    super(DiscoveryDocumentTest, self).tearDown()
+
+  def testCachesFetchedDocuments(self):
+    with mock.patch.object(auth.Service, '_FetchDiscoveryDocument',
+                           return_value='{"name": "storage"}') as mock_fetch:
+      for _ in range(2):
+        self.assertEquals('{"name": "storage"}',
+                          auth.Service.DiscoveryDocument('storage', 'v1beta2'))
+      auth._discovery_docs.clear()
+      self.assertEquals('{"name": "storage"}',
+                        auth.Service.DiscoveryDocument('storage', 'v1beta2'))
+    mock_fetch.assert_called_once_with('storage', 'v1beta2')
+
+  def testReadsBundledDocuments(self):
+    with mock.patch.object(auth, 'DISCOVERY_DOC_DIR', self.tmpdir):
+      with open(os.path.join(self.tmpdir, 'compute.v1.json'), 'w') as f:
+        f.write('{"name": "compute"}')
+      with mock.patch.object(auth.Service,
+                             '_FetchDiscoveryDocument') as mock_fetch:
+        self.assertEquals('{"name": "compute"}',
+                          auth.Service.DiscoveryDocument('compute', 'v1'))
+      self.assertFalse(mock_fetch.called)
+
+  def testProcessCacheExpires(self):
+    with mock.patch.object(auth.Service, '_FetchDiscoveryDocument',
+                           side_effect=['{"v": 1}', '{"v": 2}']):
+      with mock.patch.object(auth.memcache, 'get', return_value=None):
+        for (now, expected) in [
+            (1000, '{"v": 1}'),
+            (999 + auth.DISCOVERY_CACHE_SECONDS, '{"v": 1}'),
+            (1001 + auth.DISCOVERY_CACHE_SECONDS, '{"v": 2}')]:
+          with mock.patch.object(auth.time, 'time', return_value=now):
+            self.assertEquals(expected, auth.Service.DiscoveryDocument(
+                'storage', 'v1beta2'))
+
+  def testBundledDocuments(self):
+    with mock.patch.object(auth.Service,
+                           '_FetchDiscoveryDocument') as mock_fetch:
+      for (name, version) in [('bigquery', 'v2'), ('compute', 'v1')]:
+        doc = json.loads(auth.Service.DiscoveryDocument(name, version))
+        self.assertEquals((name, version), (doc['name'], doc['version']))
+    self.assertFalse(mock_fetch.called)
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -25,6 +25,7 @@ from apiclient.errors import HttpError
 from oauth2client.client import AccessTokenRefreshError
 
 from src import auth
+from src import parallel
 
 
 class ColumnTypes(object):
@@ -69,6 +70,39 @@ class BigQueryError(Exception):
   pass
 
 
+# Jobs are polled after 1, 2, 4, ... seconds, and then every minute. Callers
+# that block a request while they wait poll at least every few seconds.
+BACKOFF_INITIAL_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+BLOCKING_BACKOFF_MAX_SECONDS = 4
+
+
+def BackoffSeconds(poll, max_seconds=BACKOFF_MAX_SECONDS):
+  """Returns how long to wait before the next poll of a job.
+
+  Args:
+    poll: the number of polls done so far.
+    max_seconds: the longest delay.
+
+  Returns:
+    The delay in seconds.
+  """
+  return min(max_seconds, BACKOFF_INITIAL_SECONDS * 2 ** min(poll, 16))
+
+
+# tabledata.insertAll limits and retries. Failed requests are retried after
+# BackoffSeconds; the insertIds keep retried rows from being added twice.
+INSERT_ALL_MAX_ROWS = 500
+INSERT_ALL_MAX_BYTES = 5 << 20
+INSERT_ALL_RETRIES = 5
+RETRY_HTTP_STATUSES = (429, 500, 502, 503, 504)
+RETRY_ROW_REASONS = ('backendError', 'internalError', 'stopped', 'timeout')
+
+# Query results are read in pages of up to this many rows, several at once.
+QUERY_PAGE_ROWS = 10000
+QUERY_PAGE_WORKERS = 8
+
+
 class BigQuery(object):
   """A class for accessing bigquery."""
   AUTH_SCOPE = 'https://www.googleapis.com/auth/bigquery'
@@ -81,8 +115,11 @@ class BigQuery(object):
       project_id: The bigquery project id.
     """
     self.project_id = project_id
-    self.bigquery = auth.Service.FromServiceAccount('bigquery', 'v2',
-                                                    self.AUTH_SCOPE)
+
+  @property
+  def bigquery(self):
+    """The bigquery service for the calling thread."""
+    return auth.Service.FromPool('bigquery', 'v2', self.AUTH_SCOPE)
 
   def CreateDataset(self, dataset_id, email=None):
     """Makes a dataset in BigQuery and shares it with email."""
@@ -116,73 +153,286 @@ class BigQuery(object):
   def CreateTable(self, dataset_id, table_name, fields, src_file,
                   source_format=None,
                   skip_leading_rows=0):
-    """Create a table in a dataset in BigQuery."""
+    """Create a table in a dataset in BigQuery and wait for it to load.
+
+    Pipeline stages should rather start the job with InsertLoadJob and wait
+    for it with a bigqueryjob.WaitForJob pipeline, which does not hold a
+    request while the job runs.
+
+    Returns:
+      True if the table was loaded, False if the load job failed.
+    """
+    job_id = self.InsertLoadJob(dataset_id, table_name, fields, src_file,
+                                source_format=source_format,
+                                skip_leading_rows=skip_leading_rows)
     try:
-      job_collection = self.bigquery.jobs()
+      job = self.WaitForJob(job_id)
+    except BigQueryError as err:
+      logging.error('Error loading table: %s', err)
+      return False
+    logging.info('Done Loading! Stats: %r', job.get('statistics'))
+    return True
 
-      verified_source_format = None
+  def InsertLoadJob(self, dataset_id, table_name, fields, src_file,
+                    source_format=None, skip_leading_rows=0, job_id=None):
+    """Starts a job that loads a GCS object into a table.
 
-      if source_format is None:
-        verified_source_format = SourceFormatTypes.DEFAULT_FORMAT
-      else:
-        verified_source_format = SourceFormatTypes.ToString(
-            source_format.upper())
-        if verified_source_format == 'UNKNOWN_TYPE':
-          logging.error('Invalid BigQuery source format: %s.',
-                        source_format)
-          raise BigQueryError('BigQuery import abandoned: '
-                              'invalid source format.')
-
-      logging.info('table fields are: %r', fields)
-
-      job_data = {
-          'projectId': self.project_id,
-          'configuration': {
-              'load': {
-                  'sourceUris': [src_file],
-                  'sourceFormat': verified_source_format,
-                  'schema': {
-                      'fields': fields,
-                      },
-                  'destinationTable': {
-                      'projectId': self.project_id,
-                      'datasetId': dataset_id,
-                      'tableId': table_name,
-                      },
-                  'maxBadRecords': 10000,
-                  }
-              }
-          }
-      if skip_leading_rows:
-        job_data['configuration']['load']['skipLeadingRows'] = skip_leading_rows
-
-      insert_response = job_collection.insert(projectId=self.project_id,
-                                              body=job_data).execute()
-
-      logging.info('insert_response is : %s', pprint.pformat(insert_response))
-
-      # Ping for status until it is done, with a short pause between calls.
-      while True:
-        job_id = insert_response['jobReference']['jobId']
-        job = job_collection.get(projectId=self.project_id,
-                                 jobId=job_id).execute()
-        logging.info('job is : %s', pprint.pformat(job))
-
-        if 'DONE' == job['status']['state']:
-          logging.info('Done Loading! Stats: %r', job.get('statistics'))
-          return True
-        if 'errorResult' in job['status']:
-          logging.error('Error loading table: %s', pprint.pformat(job))
-          return False
-
-        logging.info('Waiting for loading to complete...')
-        # TODO(user) update the Data Pipeline Stage about the loading...
-        time.sleep(10)
+    Args:
+      dataset_id: the dataset of the table.
+      table_name: the table to load into.
+      fields: the schema fields of the table.
+      src_file: the gs:// URL of the data, or a list of them. URLs may end
+        in a '*' wildcard.
+      source_format: one of SourceFormatTypes, CSV by default.
+      skip_leading_rows: the number of (header) rows to skip.
+      job_id: optional id for the job. Inserting a job whose id is already
+        taken does nothing, so retries will not load the data twice.
+
+    Returns:
+      The id of the job.
+
+    Raises:
+      BigQueryError: the source format is not valid.
+    """
+    verified_source_format = VerifySourceFormat(source_format)
+
+    logging.info('table fields are: %r', fields)
+
+    job_data = {
+        'projectId': self.project_id,
+        'configuration': {
+            'load': {
+                'sourceUris': (src_file if isinstance(src_file, list)
+                               else [src_file]),
+                'sourceFormat': verified_source_format,
+                'schema': {
+                    'fields': fields,
+                    },
+                'destinationTable': {
+                    'projectId': self.project_id,
+                    'datasetId': dataset_id,
+                    'tableId': table_name,
+                    },
+                'maxBadRecords': 10000,
+                }
+            }
+        }
+    if skip_leading_rows:
+      job_data['configuration']['load']['skipLeadingRows'] = skip_leading_rows
+    return self.InsertJob(job_data, job_id=job_id)
+
+  def InsertQueryJob(self, query, destination_table=None, job_id=None):
+    """Starts a job that runs a query.
+
+    Args:
+      query: the query string.
+      destination_table: optional dict with the projectId, datasetId and
+        tableId of a table to (over)write with the results. Results larger
+        than 128MB need one. Without it the results go to a temporary table.
+      job_id: optional id for the job, see InsertLoadJob.
+
+    Returns:
+      The id of the job.
+    """
+    query_config = {'query': query}
+    if destination_table:
+      query_config.update({
+          'destinationTable': destination_table,
+          'allowLargeResults': True,
+          'writeDisposition': 'WRITE_TRUNCATE',
+          })
+    job_data = {'projectId': self.project_id,
+                'configuration': {'query': query_config}}
+    return self.InsertJob(job_data, job_id=job_id)
+
+  def InsertExtractJob(self, source_table, destination_uris,
+                       destination_format=None, compression=None,
+                       print_header=True, job_id=None):
+    """Starts a job that exports a table to GCS.
 
+    Args:
+      source_table: dict with the projectId, datasetId and tableId of the
+        table.
+      destination_uris: the gs:// URLs to write to. A URL with a '*'
+        wildcard is written as many shards, in parallel.
+      destination_format: one of SourceFormatTypes, CSV by default.
+      compression: 'GZIP' or 'NONE' (the default).
+      print_header: whether CSV files start with a header row.
+      job_id: optional id for the job, see InsertLoadJob.
+
+    Returns:
+      The id of the job.
+
+    Raises:
+      BigQueryError: the destination format is not valid.
+    """
+    job_data = {
+        'projectId': self.project_id,
+        'configuration': {
+            'extract': {
+                'sourceTable': source_table,
+                'destinationUris': destination_uris,
+                'destinationFormat': VerifySourceFormat(destination_format),
+                'compression': compression or 'NONE',
+                'printHeader': print_header,
+                }
+            }
+        }
+    return self.InsertJob(job_data, job_id=job_id)
+
+  def InsertJob(self, job_data, job_id=None):
+    """Starts a job.
+
+    Args:
+      job_data: the job resource.
+      job_id: optional id for the job, see InsertLoadJob.
+
+    Returns:
+      The id of the job.
+    """
+    if job_id:
+      job_data['jobReference'] = {'projectId': self.project_id,
+                                  'jobId': job_id}
+    try:
+      insert_response = self.bigquery.jobs().insert(
+          projectId=self.project_id, body=job_data).execute()
     except HttpError as err:
-      logging.error('Error in loadTable: %r', err)
+      if job_id and err.resp.status == 409:
+        logging.info('job %s was already inserted', job_id)
+        return job_id
+      logging.error('Error inserting job: %r', err)
       raise err
-    return False
+    logging.info('insert_response is : %s', pprint.pformat(insert_response))
+    return insert_response['jobReference']['jobId']
+
+  def CheckJob(self, job_id):
+    """Gets the state of a job.
+
+    Args:
+      job_id: the id of the job.
+
+    Returns:
+      The job resource if it is done, or None while it is still running.
+
+    Raises:
+      BigQueryError: the job failed.
+    """
+    job = self.bigquery.jobs().get(projectId=self.project_id,
+                                   jobId=job_id).execute()
+    status = job['status']
+    if 'errorResult' in status:
+      logging.error('Job %s failed: %s', job_id, pprint.pformat(job))
+      raise BigQueryError('Job %s failed: %s' % (
+          job_id, status['errorResult'].get('message')))
+    if status['state'] == 'DONE':
+      return job
+    return None
+
+  def WaitForJob(self, job_id):
+    """Polls a job, with capped exponential backoff, until it is done.
+
+    This holds the request while the job runs, so the polls are never more
+    than BLOCKING_BACKOFF_MAX_SECONDS apart. Pipeline stages should rather
+    wait with a bigqueryjob.WaitForJob pipeline.
+
+    Args:
+      job_id: the id of the job.
+
+    Returns:
+      The job resource.
+
+    Raises:
+      BigQueryError: the job failed.
+    """
+    poll = 0
+    while True:
+      job = self.CheckJob(job_id)
+      if job:
+        return job
+      delay = BackoffSeconds(poll, BLOCKING_BACKOFF_MAX_SECONDS)
+      logging.info('Waiting %ds for job %s to complete...', delay, job_id)
+      time.sleep(delay)
+      poll += 1
+
+  def CreateEmptyTable(self, dataset_id, table_name, fields):
+    """Creates a table with a schema unless it already exists.
+
+    Args:
+      dataset_id: the dataset of the table.
+      table_name: the table to create.
+      fields: the schema fields of the table.
+    """
+    body = {
+        'tableReference': {
+            'projectId': self.project_id,
+            'datasetId': dataset_id,
+            'tableId': table_name,
+            },
+        'schema': {'fields': fields},
+        }
+    try:
+      self.bigquery.tables().insert(projectId=self.project_id,
+                                    datasetId=dataset_id,
+                                    body=body).execute()
+    except HttpError as err:
+      if err.resp.status != 409:
+        logging.error('Error in CreateEmptyTable: %r', err)
+        raise err
+      logging.info('table %s.%s already exists', dataset_id, table_name)
+
+  def InsertAll(self, dataset_id, table_id, rows,
+                retries=INSERT_ALL_RETRIES):
+    """Streams rows into a table, retrying failures with backoff.
+
+    Requests that fail with a quota or server error are sent again, as are
+    rows that BigQuery reports as not inserted for a reason that may not
+    happen again (including rows that were stopped because of other, bad
+    rows in the same request).
+
+    Args:
+      dataset_id: the dataset of the table.
+      table_id: the table to insert into.
+      rows: a list of (insert id, row dict) pairs. The insert ids let
+        BigQuery drop rows that a retry sends again.
+      retries: how many times to retry.
+
+    Returns:
+      A list of (insert id, errors) pairs for the rows that were not
+      inserted.
+
+    Raises:
+      HttpError: the request failed for good.
+    """
+    not_inserted = []
+    poll = 0
+    while True:
+      body = {'rows': [{'insertId': insert_id, 'json': row}
+                       for (insert_id, row) in rows]}
+      try:
+        reply = self.bigquery.tabledata().insertAll(
+            projectId=self.project_id, datasetId=dataset_id,
+            tableId=table_id, body=body).execute()
+      except HttpError as err:
+        if poll >= retries or err.resp.status not in RETRY_HTTP_STATUSES:
+          logging.error('Error in InsertAll: %r', err)
+          raise err
+        logging.warning('InsertAll of %d rows failed: %r', len(rows), err)
+      else:
+        failed = [(rows[e['index']][0], e['errors'])
+                  for e in reply.get('insertErrors', [])]
+        retry = set(i for (i, errors) in failed
+                    if all(e.get('reason') in RETRY_ROW_REASONS
+                           for e in errors))
+        if poll >= retries:
+          retry = set()
+        not_inserted.extend(f for f in failed if f[0] not in retry)
+        if not retry:
+          return not_inserted
+        logging.warning('%d of %d rows were not inserted, retrying',
+                        len(retry), len(rows))
+        rows = [r for r in rows if r[0] in retry]
+      time.sleep(BackoffSeconds(poll))
+      poll += 1
 
   def DeleteTable(self, dataset_id, table_id):
     """Delete a table from bigquery."""
@@ -215,6 +465,9 @@ class BigQuery(object):
             table_info=None, offset=0, max_results=100, timeout=0):
     """Query a table, pagination is supported with optional args.
 
+    To read all the rows of a query use QueryResults, which runs the query
+    only once.
+
     Args:
       query: The query string.
       table_info: A dict that contains dataset, project and table ID.
@@ -227,26 +480,11 @@ class BigQuery(object):
     """
     try:
       if table_info is None:
-        logging.info('timeout:%d', timeout)
-        job_collection = self.bigquery.jobs()
-        query_data = {'query': query, 'timeoutMs': timeout}
-
-        query_reply = job_collection.query(projectId=self.project_id,
-                                           body=query_data).execute()
-
-        job_reference = query_reply['jobReference']
-        job_config = job_collection.get(**job_reference).execute()
-
-        while job_config['status']['state'] != 'DONE':
-          if 'errorResult' in job_config['status']:
-            logging.error('Job has failed.')
-            return
-          time.sleep(1)
-          job_config = job_collection.get(**job_reference).execute()
-
-        # query results are stored in a temp table, get the temp table config.
-        # This will let us paginate the results.
-        table_info = job_config['configuration']['query']['destinationTable']
+        try:
+          table_info = self.RunQuery(query, timeout=timeout)
+        except BigQueryError:
+          logging.error('Job has failed.')
+          return
 
       # TODO(user): Temp tables expire after 24 hours.
       # Recreate temp table if query is 24 hours old by finding out
@@ -268,6 +506,145 @@ class BigQuery(object):
     except Exception as err:
       logging.error('Undefined error %r', err)
 
+  def RunQuery(self, query, timeout=0):
+    """Runs a query and waits for it.
+
+    Args:
+      query: The query string.
+      timeout: Time to wait while polling for completeness.
+
+    Returns:
+      A dict with the projectId, datasetId and tableId of the (temporary)
+      table that holds the results.
+
+    Raises:
+      BigQueryError: the query failed.
+    """
+    logging.info('timeout:%d', timeout)
+    query_data = {'query': query, 'timeoutMs': timeout}
+    query_reply = self.bigquery.jobs().query(projectId=self.project_id,
+                                             body=query_data).execute()
+    job_config = self.WaitForJob(query_reply['jobReference']['jobId'])
+    # query results are stored in a temp table, get the temp table config.
+    # This will let us paginate the results.
+    return job_config['configuration']['query']['destinationTable']
+
+  def QueryResults(self, query, timeout=0, **kwargs):
+    """Runs a query and returns its rows.
+
+    Args:
+      query: The query string.
+      timeout: Time to wait while polling for completeness.
+      **kwargs: passed to TableRows.
+
+    Returns:
+      A TableRows over the results.
+
+    Raises:
+      BigQueryError: the query failed.
+    """
+    return TableRows(self, self.RunQuery(query, timeout=timeout), **kwargs)
+
+
+class TableRows(object):
+  """The rows of a table, such as the results of a query, read lazily.
+
+  The first page tells how many rows there are. The rest are then read in
+  pages of up to page_rows rows, up to max_workers pages at a time, and
+  yielded in order as they arrive. With max_workers=1 the pages are read
+  one after the other, following their pageTokens.
+
+  Rows are in the tabledata.list form, {'f': [{'v': value}, ...]}; the
+  schema describing them is fetched once, when first asked for.
+  """
+
+  def __init__(self, bq, table_info, page_rows=QUERY_PAGE_ROWS,
+               max_workers=QUERY_PAGE_WORKERS):
+    """Creates a TableRows.
+
+    Args:
+      bq: the BigQuery client.
+      table_info: a dict with the projectId, datasetId and tableId of the
+        table.
+      page_rows: the most rows to ask for in one request.
+      max_workers: the most requests to have in flight.
+    """
+    self.table_info = table_info
+    self.page_rows = page_rows
+    self.max_workers = max_workers
+    self.total_rows = None
+    self._bq = bq
+    self._schema = None
+
+  @property
+  def schema(self):
+    """The schema of the rows."""
+    if self._schema is None:
+      table = self._bq.GetTable(self.table_info['datasetId'],
+                                self.table_info['tableId'])
+      self._schema = table['schema']
+    return self._schema
+
+  def _Page(self, max_results, start=None, page_token=None):
+    kwargs = dict(self.table_info, maxResults=max_results)
+    if page_token:
+      kwargs['pageToken'] = page_token
+    else:
+      kwargs['startIndex'] = start
+    return self._bq.bigquery.tabledata().list(**kwargs).execute()
+
+  def _Range(self, start):
+    """Reads the rows of the page_rows long range that begins at start."""
+    end = min(start + self.page_rows, self.total_rows)
+    rows = []
+    while start < end:
+      page_rows = self._Page(end - start, start=start).get('rows')
+      if not page_rows:
+        break
+      rows.extend(page_rows)
+      start += len(page_rows)
+    return rows
+
+  def __iter__(self):
+    page = self._Page(self.page_rows, start=0)
+    self.total_rows = int(page.get('totalRows', 0))
+    rows = page.get('rows', [])
+    for row in rows:
+      yield row
+    if self.max_workers <= 1:
+      while page.get('pageToken') and page.get('rows'):
+        page = self._Page(self.page_rows, page_token=page['pageToken'])
+        for row in page.get('rows', []):
+          yield row
+      return
+    starts = xrange(len(rows), self.total_rows, self.page_rows)
+    for range_rows in parallel.IMap(self._Range, starts,
+                                    max_workers=self.max_workers):
+      for row in range_rows:
+        yield row
+
+
+def VerifySourceFormat(source_format):
+  """Returns the BigQuery name of a source (or destination) format.
+
+  Args:
+    source_format: a SourceFormatTypes name in any case, or None for the
+      default format.
+
+  Returns:
+    The format as BigQuery spells it.
+
+  Raises:
+    BigQueryError: the format is not valid.
+  """
+  if source_format is None:
+    return SourceFormatTypes.DEFAULT_FORMAT
+  verified_source_format = SourceFormatTypes.ToString(source_format.upper())
+  if verified_source_format == 'UNKNOWN_TYPE':
+    logging.error('Invalid BigQuery source format: %s.', source_format)
+    raise BigQueryError('BigQuery import abandoned: invalid source format.')
+  return verified_source_format
+
 
 def MakeValidFieldName(header):
   """Turn a header name into a valid bigquery field name.
@@ -16,6 +16,11 @@
 
 
 import logging
+
+from apiclient import errors
+import httplib2
+import mock
+
 from src import basetest
 from src.clients import bigquery
 
@@ -51,6 +56,194 @@ class TestBigQueryFunctions(basetest.TestCase):
     self.assertEquals('_9ark66',
                       bigquery.MakeValidTableName(' &^@*#9ark#&$^$^66'))
 
+  def testBackoffSeconds(self):
+    self.assertEquals([1, 2, 4, 8, 16, 32, 60, 60],
+                      [bigquery.BackoffSeconds(p) for p in range(8)])
+    self.assertEquals(60, bigquery.BackoffSeconds(1000))
+    self.assertEquals([1, 2, 4, 4], [bigquery.BackoffSeconds(p, 4)
+                                     for p in range(4)])
+
+
+class TestBigQueryJobs(basetest.TestCase):
+
+  def setUp(self):
+    super(TestBigQueryJobs, self).setUp()
+    self.service = mock.MagicMock()
+    mock.patch.object(bigquery.auth.Service, 'FromPool',
+                      return_value=self.service).start()
+    self.jobs = self.service.jobs.return_value
+    self.bq = bigquery.BigQuery('project')
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(TestBigQueryJobs, self).tearDown()
+
+  def testCheckJob(self):
+    running = {'status': {'state': 'RUNNING'}}
+    done = {'status': {'state': 'DONE'}, 'statistics': {}}
+    failed = {'status': {'state': 'DONE',
+                         'errorResult': {'message': 'bad'}}}
+    self.jobs.get.return_value.execute.side_effect = [running, done, failed]
+    self.assertIsNone(self.bq.CheckJob('job'))
+    self.assertEquals(done, self.bq.CheckJob('job'))
+    self.assertRaises(bigquery.BigQueryError, self.bq.CheckJob, 'job')
+    self.jobs.get.assert_called_with(projectId='project', jobId='job')
+
+  def testWaitForJob(self):
+    running = {'status': {'state': 'RUNNING'}}
+    done = {'status': {'state': 'DONE'}}
+    self.jobs.get.return_value.execute.side_effect = [running] * 5 + [done]
+    with mock.patch.object(bigquery.time, 'sleep') as sleep:
+      self.assertEquals(done, self.bq.WaitForJob('job'))
+    self.assertEquals([1, 2, 4, 4, 4], [c[0][0] for c in sleep.call_args_list])
+
+  def testInsertJob(self):
+    self.jobs.insert.return_value.execute.return_value = {
+        'jobReference': {'jobId': 'generated'}}
+    self.assertEquals('generated', self.bq.InsertJob({}))
+    job_data = {}
+    self.assertEquals('generated', self.bq.InsertJob(job_data, job_id='mine'))
+    self.assertEquals({'projectId': 'project', 'jobId': 'mine'},
+                      job_data['jobReference'])
+
+  def testInsertJobAlreadyExists(self):
+    conflict = errors.HttpError(httplib2.Response({'status': 409}), '')
+    self.jobs.insert.return_value.execute.side_effect = conflict
+    self.assertEquals('mine', self.bq.InsertJob({}, job_id='mine'))
+    self.assertRaises(errors.HttpError, self.bq.InsertJob, {})
+
+  def testInsertLoadJob(self):
+    self.jobs.insert.return_value.execute.return_value = {
+        'jobReference': {'jobId': 'job'}}
+    self.assertEquals('job', self.bq.InsertLoadJob(
+        'dataset', 'table', [], 'gs://bucket/object',
+        source_format='newline_delimited_json', skip_leading_rows=1))
+    load = self.jobs.insert.call_args[1]['body']['configuration']['load']
+    self.assertEquals(['gs://bucket/object'], load['sourceUris'])
+    self.assertEquals('NEWLINE_DELIMITED_JSON', load['sourceFormat'])
+    self.assertEquals(1, load['skipLeadingRows'])
+    self.bq.InsertLoadJob('dataset', 'table', [], ['gs://b/1', 'gs://b/2*'])
+    load = self.jobs.insert.call_args[1]['body']['configuration']['load']
+    self.assertEquals(['gs://b/1', 'gs://b/2*'], load['sourceUris'])
+    self.assertRaises(bigquery.BigQueryError, self.bq.InsertLoadJob,
+                      'dataset', 'table', [], 'gs://bucket/object',
+                      source_format='xml')
+
+  def testInsertQueryAndExtractJobs(self):
+    self.jobs.insert.return_value.execute.return_value = {
+        'jobReference': {'jobId': 'job'}}
+    table = {'projectId': 'project', 'datasetId': 'd', 'tableId': 't'}
+    self.bq.InsertQueryJob('SELECT 1', destination_table=table)
+    query = self.jobs.insert.call_args[1]['body']['configuration']['query']
+    self.assertEquals('SELECT 1', query['query'])
+    self.assertEquals(table, query['destinationTable'])
+    self.assertTrue(query['allowLargeResults'])
+
+    self.bq.InsertExtractJob(table, ['gs://b/o-*'], compression='GZIP')
+    extract = self.jobs.insert.call_args[1]['body']['configuration'][
+        'extract']
+    self.assertEquals(['gs://b/o-*'], extract['destinationUris'])
+    self.assertEquals('CSV', extract['destinationFormat'])
+    self.assertEquals('GZIP', extract['compression'])
+
+  def testInsertAllRetries(self):
+    rows = [('a', {'x': 1}), ('b', {'x': 2}), ('c', {'x': 3})]
+    unavailable = errors.HttpError(httplib2.Response({'status': 503}), '')
+    self.service.tabledata.return_value.insertAll.return_value.execute.\
+        side_effect = [
+            unavailable,
+            {'insertErrors': [
+                {'index': 0, 'errors': [{'reason': 'invalid'}]},
+                {'index': 2, 'errors': [{'reason': 'stopped'}]}]},
+            {}]
+    with mock.patch.object(bigquery.time, 'sleep') as sleep:
+      self.assertEquals([('a', [{'reason': 'invalid'}])],
+                        self.bq.InsertAll('dataset', 'table', rows))
+    self.assertEquals(2, sleep.call_count)
+    calls = self.service.tabledata.return_value.insertAll.call_args_list
+    self.assertEquals([3, 3, 1], [len(c[1]['body']['rows']) for c in calls])
+    self.assertEquals({'insertId': 'c', 'json': {'x': 3}},
+                      calls[2][1]['body']['rows'][0])
+
+  def testInsertAllGivesUp(self):
+    bad_request = errors.HttpError(httplib2.Response({'status': 400}), '')
+    self.service.tabledata.return_value.insertAll.return_value.execute.\
+        side_effect = bad_request
+    self.assertRaises(errors.HttpError, self.bq.InsertAll, 'dataset', 'table',
+                      [('a', {})])
+
+
+class TestTableRows(basetest.TestCase):
+
+  def setUp(self):
+    super(TestTableRows, self).setUp()
+    self.service = mock.MagicMock()
+    mock.patch.object(bigquery.auth.Service, 'FromPool',
+                      return_value=self.service).start()
+    self.bq = bigquery.BigQuery('project')
+    self.table_info = {'projectId': 'project', 'datasetId': 'd',
+                       'tableId': 't'}
+    self.total = 25
+    self.tabledata = self.service.tabledata.return_value
+
+    def List(**kwargs):
+      # Serves at most 4 rows a page, like a reply that hit the size limit.
+      start = kwargs.get('startIndex')
+      if start is None:
+        start = int(kwargs['pageToken'])
+      end = min(start + kwargs['maxResults'], start + 4, self.total)
+      reply = {'totalRows': str(self.total),
+               'rows': [{'f': [{'v': str(i)}]} for i in range(start, end)]}
+      if end < self.total:
+        reply['pageToken'] = str(end)
+      return mock.MagicMock(**{'execute.return_value': reply})
+    self.tabledata.list.side_effect = List
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(TestTableRows, self).tearDown()
+
+  def _Values(self, rows):
+    return [row['f'][0]['v'] for row in rows]
+
+  def testConcurrentPages(self):
+    rows = bigquery.TableRows(self.bq, self.table_info, page_rows=10)
+    self.assertEquals([str(i) for i in range(25)], self._Values(rows))
+    self.assertEquals(25, rows.total_rows)
+    for c in self.tabledata.list.call_args_list:
+      self.assertNotIn('pageToken', c[1])
+
+  def testPageTokens(self):
+    rows = bigquery.TableRows(self.bq, self.table_info, page_rows=10,
+                              max_workers=1)
+    self.assertEquals([str(i) for i in range(25)], self._Values(rows))
+    self.assertEquals(7, self.tabledata.list.call_count)
+
+  def testEmpty(self):
+    self.total = 0
+    rows = bigquery.TableRows(self.bq, self.table_info)
+    self.assertEquals([], list(rows))
+
+  def testSchemaIsCached(self):
+    self.service.tables.return_value.get.return_value.execute.return_value = {
+        'schema': {'fields': [{'name': 'id'}]}}
+    rows = bigquery.TableRows(self.bq, self.table_info)
+    self.assertEquals({'fields': [{'name': 'id'}]}, rows.schema)
+    self.assertEquals({'fields': [{'name': 'id'}]}, rows.schema)
+    self.assertEquals(1, self.service.tables.return_value.get.call_count)
+
+  def testQueryResults(self):
+    jobs = self.service.jobs.return_value
+    jobs.query.return_value.execute.return_value = {
+        'jobReference': {'jobId': 'job'}}
+    jobs.get.return_value.execute.return_value = {
+        'status': {'state': 'DONE'},
+        'configuration': {'query': {'destinationTable': self.table_info}}}
+    rows = self.bq.QueryResults('SELECT 1', page_rows=10)
+    self.assertEquals(self.table_info, rows.table_info)
+    self.assertEquals(25, len(list(rows)))
+    self.assertEquals(1, jobs.query.call_count)
+
 
 if __name__ == '__main__':
   basetest.main()
@@ -32,8 +32,11 @@ class ComputeEngine(object):
       project_id: The Compute Engine project id.
     """
     self.project_id = project_id
-    self.computeengine = auth.Service.FromServiceAccount(
-        'compute', self.API_VERSION, self.AUTH_SCOPE)
+
+  @property
+  def computeengine(self):
+    """The compute service for the calling thread."""
+    return auth.Service.FromPool('compute', self.API_VERSION, self.AUTH_SCOPE)
 
   def ListInstances(self, zone, fields=None):
     """Query the Compute Engine API and return all instances in a zone.
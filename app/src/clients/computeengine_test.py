@@ -0,0 +1,48 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""ComputeEngine client unit tests."""
+
+import threading
+
+import mock
+
+from src import auth
+from src import basetest
+from src import parallel
+from src.clients import computeengine
+
+
+class ComputeEngineTest(basetest.TestCase):
+
+  def testServicePerThread(self):
+    services = {}
+
+    def FromPool(*unused_args):
+      return services.setdefault(threading.current_thread(),
+                                 mock.MagicMock())
+
+    gce = computeengine.ComputeEngine('project')
+    with mock.patch.object(auth.Service, 'FromPool', side_effect=FromPool):
+      parallel.Map(lambda zone: gce.ListInstances(zone), ['a', 'b', 'c'])
+
+    # Every thread made its request with a service of its own.
+    self.assertEquals(3, len(services))
+    for service in services.itervalues():
+      self.assertEquals(1, service.instances.return_value.list.call_count)
+
+
+if __name__ == '__main__':
+  basetest.main()
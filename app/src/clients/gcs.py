@@ -14,23 +14,43 @@
 
 """Google Cloud Storage client library."""
 
-import contextlib
+import collections
 import fnmatch
+import hashlib
 import logging
 import math
+import os
+import re
+import threading
+import time
 import urlparse
 import uuid
 
 from apiclient.errors import HttpError
+from apiclient.http import BatchHttpRequest
 
 import cloudstorage
+from google.appengine.api import memcache
 from src import auth
+from src import parallel
+
+GLOB_SPECIAL_CHARS = re.compile(r'[*?[]')
+
+
+_backend = None
+
+
+def SetBackend(backend):
+  """Sets the StorageBackend used by new Gcs instances (None for GCS)."""
+  global _backend
+  _backend = backend
 
 
 class Gcs(object):
   """Google Cloud Storage utility class.
 
-  This class makes use of both the AppEngine storage API as well as the
+  Object operations go through a StorageBackend, by default GcsBackend
+  which makes use of both the AppEngine storage API as well as the
   library that uses the JSON API. Some operations are only available
   or optimized (e.g. bucket-to-bucket object copying) using the JSON API. Others
   are used depending on the credentials provided.
@@ -43,17 +63,25 @@ class Gcs(object):
   CHUNK_SIZE_8MB = 1 << 23
   READ_CHUNK_SIZE = CHUNK_SIZE_8MB
   DEFAULT_CONTENT_TYPE = 'binary/octet-stream'
-
-  def __init__(self):
+  LIST_CACHE_MAX_NAMES = 10000
+  PARALLEL_UPLOAD_THRESHOLD = 1 << 25  # larger streams are uploaded in parts
+  PARALLEL_UPLOAD_PART_SIZE = 1 << 24
+  PARALLEL_UPLOAD_WORKERS = 4
+  STREAM_CHUNK_SIZE = 1 << 18  # the cloudstorage writer's upload block size
+  PREFETCH_RANGES = 4  # ranges a ParallelReader keeps in flight
+  PREFETCH_RANGE_SIZE = CHUNK_SIZE_8MB  # smaller objects are read directly
+  DELETE_BATCH_SIZE = 100  # max requests the JSON API accepts in one batch
+
+  def __init__(self, backend=None):
     self._service = None
+    self._backend = backend or _backend or GcsBackend(self)
 
   def _AcquireService(self):
-    """Acquires the storage service."""
-    if not self._service:
-      self._service = auth.Service.FromServiceAccount(self.SERVICE_NAME,
-                                                      self.SERVICE_VERSION,
-                                                      self.AUTH_SCOPE)
-    return self._service
+    """Acquires the storage service for the calling thread."""
+    if self._service:
+      return self._service
+    return auth.Service.FromPool(self.SERVICE_NAME, self.SERVICE_VERSION,
+                                 self.AUTH_SCOPE)
 
   @staticmethod
   def UrlCreator(bucket, prefix=''):
@@ -143,49 +171,153 @@ class Gcs(object):
         project=project_id, body={'name': bucket, 'location': location})
     return req.execute()
 
-  def ListBucket(self, bucket, prefix=None, glob=None):
-    """List all objects in a bucket filtered optionally by prefix and regex.
+  def ListBucket(self, bucket, prefix=None, glob=None, fan_out=False,
+                 use_cache=True):
+    """Lists the objects in a bucket filtered optionally by prefix and glob.
+
+    Objects are streamed a page at a time rather than read into a list. The
+    literal part of the glob is sent to the server as a prefix. Completed
+    listings of up to LIST_CACHE_MAX_NAMES objects are cached briefly.
 
     Args:
       bucket: required, specifies the GCS bucket.
       prefix: optional, specifies object [path] prefix to filter against.
-      glob: optional, glob filter for the object list.
+      glob: optional, glob filter for the object list. It is matched against
+        the '/bucket/object' path.
+      fan_out: optional, list each '/' separated sub-prefix of the prefix
+        concurrently.
+      use_cache: optional, set to False when the objects may have been
+        written by something other than this process.
+
+    Yields:
+      Object URLs (gs://bucket/object).
+    """
+    prefix = self._GlobPrefix(bucket.lstrip('/'), prefix, glob)
+    key = (bucket.strip('/'), prefix)
+    cached = _list_cache.Get(key) if use_cache else None
+    if cached is not None:
+      names = cached
+    elif fan_out:
+      names = self._ListParallel(bucket, prefix)
+    else:
+      names = (i.filename for i in self._backend.List(bucket, prefix))
+    listed = []
+    for name in names:
+      if cached is None and listed is not None:
+        listed.append(name)
+        if len(listed) > self.LIST_CACHE_MAX_NAMES:
+          listed = None
+      if not glob or fnmatch.fnmatch(name, glob):
+        yield 'gs:/' + name
+    if cached is None and listed is not None:
+      _list_cache.Put(key, listed)
+
+  def ListBucketSizes(self, bucket, prefix=None, glob=None):
+    """Lists objects like ListBucket along with the sizes in the listing.
+
+    This saves a stat per object; the listing is not cached.
 
-    Returns:
-      A list of object names.
+    Args:
+      bucket: required, specifies the GCS bucket.
+      prefix: optional, specifies object [path] prefix to filter against.
+      glob: optional, glob filter for the object list. It is matched against
+        the '/bucket/object' path.
+
+    Yields:
+      (url, size in bytes) tuples.
     """
-    # TODO(user): paginate and return an iterator instead of a flat list.
-    items = cloudstorage.listbucket(bucket, prefix=prefix)
+    bucket = bucket.strip('/')
+    prefix = self._GlobPrefix(bucket, prefix, glob)
+    for item in self._backend.List('/' + bucket, prefix):
+      if not glob or fnmatch.fnmatch(item.filename, glob):
+        yield ('gs:/' + item.filename, item.st_size)
+
+  def _ListParallel(self, bucket, prefix):
+    """Lists the sub-prefixes (directories) of a prefix concurrently."""
+    prefix = prefix or ''
+    path = self.MakeBucketAndNamePath(bucket.strip('/'), prefix)
+    entries = [e for e in self._backend.List(
+        bucket, prefix[:prefix.rfind('/') + 1] or None, delimiter='/')
+               if e.filename.startswith(path)]
+    dirs = [e.filename.split('/', 2)[2] for e in entries if e.is_dir]
+    listings = parallel.IMap(
+        lambda d: [i.filename for i in self._backend.List(bucket, d)], dirs)
+    for e in entries:
+      if e.is_dir:
+        for name in next(listings):
+          yield name
+      else:
+        yield e.filename
+
+  @staticmethod
+  def _GlobPrefix(bucket, prefix, glob):
+    """Narrows a listing prefix with the literal start of a glob.
+
+    Args:
+      bucket: the GCS bucket.
+      prefix: the listing prefix, if any.
+      glob: a glob over '/bucket/object' paths, if any.
 
-    return ['gs:/' + i.filename for i in items
-            if not glob or fnmatch.fnmatch(i.filename, glob)]
+    Returns:
+      The longest object name prefix implied by both.
+    """
+    if not glob:
+      return prefix
+    literal = GLOB_SPECIAL_CHARS.split(glob, 1)[0]
+    bucket_path = '/%s/' % bucket
+    if not literal.startswith(bucket_path):
+      return prefix
+    literal = literal[len(bucket_path):]
+    if not prefix or literal.startswith(prefix):
+      return literal
+    return prefix
 
   def DeleteBucket(self, bucket):
     """Removes an existing GCS bucket."""
     return self._AcquireService().buckets().delete(bucket=bucket).execute()
 
-  def StatObject(self, url=None, bucket=None, obj=None):
+  def StatObject(self, url=None, bucket=None, obj=None, use_cache=True):
     """Reads some information about an object in Gcs.
 
+    Stats are cached for the rest of the request and for a few seconds in
+    memcache. Writes through this class invalidate them.
+
     Args:
       url: Full URL of the object. Use either this or bucket and object
       bucket: Bucket name. Use either this and object or url.
       obj: Object name. Use either this and bucket or url.
+      use_cache: optional, set to False when the object may have been
+        written by something other than this class.
 
     Returns:
       A dict with size, md5, contentType and metadata keys.
     """
-    stat = None
     if url:
-      stat = cloudstorage.stat(Gcs.UrlToBucketAndNamePath(url))
+      path = Gcs.UrlToBucketAndNamePath(url)
     else:
-      stat = cloudstorage.stat(Gcs.MakeBucketAndNamePath(bucket, obj))
-    return {
-        'size': stat.st_size,
-        'md5Hash': stat.etag,
-        'contentType': stat.content_type,
-        'metadata': stat.metadata
-    }
+      path = Gcs.MakeBucketAndNamePath(bucket, obj)
+    result = _stat_cache.Get(path) if use_cache else None
+    if result is None:
+      result = self._backend.Stat(path)
+      _stat_cache.Put(path, result)
+    return result
+
+  def StatObjects(self, urls):
+    """Stats many objects concurrently.
+
+    Args:
+      urls: the URLs of the objects.
+
+    Returns:
+      A dict of each URL to its StatObject dict, or None if it does not exist.
+    """
+    def Stat(url):
+      try:
+        return self.StatObject(url)
+      except cloudstorage.NotFoundError:
+        return None
+    urls = list(urls)
+    return dict(zip(urls, parallel.Map(Stat, urls)))
 
   def CopyObject(self, src, dest):
     """Copies an object from one bucket to another.
@@ -216,14 +348,25 @@ class Gcs(object):
     if not dest_obj:
       dest_obj = src_obj
 
-    req = self._AcquireService().objects().copy(sourceBucket=src_bucket,
-                                                sourceObject=src_obj,
-                                                destinationBucket=dest_bucket,
-                                                destinationObject=dest_obj,
-                                                body={})
-    return req.execute()
+    _Invalidate(dest_bucket, dest_obj)
+    return self._backend.Copy(src_bucket, src_obj, dest_bucket, dest_obj)
 
-  def OpenObject(self, url=None, bucket=None, obj=None, mode='r'):
+  def SetObjectMetadata(self, url, metadata):
+    """Sets custom metadata on an object, keeping any other keys it has.
+
+    Args:
+      url: Full URL of the object.
+      metadata: a dict of string keys to string values.
+
+    Returns:
+      The object resource.
+    """
+    (bucket, obj) = self.UrlToBucketAndName(url)
+    _Invalidate(bucket, obj)
+    return self._backend.SetMetadata(bucket, obj, metadata)
+
+  def OpenObject(self, url=None, bucket=None, obj=None, mode='r',
+                 prefetch=0):
     """Opens an object for reading from Gcs.
 
     Args:
@@ -231,6 +374,9 @@ class Gcs(object):
       bucket: Bucket name. Use either this and object or url.
       obj: Object name. Use either this and bucket or url.
       mode: Open mode of the Object.  'r' (default) or 'w'.
+      prefetch: When reading, the number of ranges to fetch ahead
+        concurrently (see ParallelReader). 0 reads sequentially, as do
+        objects no larger than one PREFETCH_RANGE_SIZE range.
 
     Returns:
       A file-like object with which the object data can be read (should be
@@ -241,42 +387,152 @@ class Gcs(object):
       target = Gcs.UrlToBucketAndNamePath(url)
     else:
       target = Gcs.MakeBucketAndNamePath(bucket, obj)
-    return cloudstorage.open(target, mode)
-
-  def InsertObject(self, stream, url=None, bucket=None, obj=None):
+    if mode != 'r':
+      return self._OpenWriter(*target[1:].split('/', 1))
+    elif prefetch:
+      (bucket, obj) = target[1:].split('/', 1)
+      size = self.StatObject(bucket=bucket, obj=obj)['size']
+      if size > self.PREFETCH_RANGE_SIZE:
+        return ParallelReader(self, bucket, obj, size,
+                              range_size=self.PREFETCH_RANGE_SIZE,
+                              prefetch=prefetch)
+    return self._backend.Open(target, mode)
+
+  def _OpenWriter(self, bucket, obj, content_type=None):
+    """Opens an object for writing, dropping its cached stats and listings.
+
+    They are dropped again when the writer is closed, so nothing cached
+    while the object was being written outlives the write.
+    """
+    _Invalidate(bucket, obj)
+    return _InvalidatingWriter(
+        self._backend.Open(Gcs.MakeBucketAndNamePath(bucket, obj), 'w',
+                           content_type=content_type),
+        bucket, obj)
+
+  def InsertObject(self, stream, url=None, bucket=None, obj=None,
+                   content_type=None, size=None):
     """Writes a stream as the contents of an object in Gcs.
 
+    The stream is written through to the object until more than
+    PARALLEL_UPLOAD_THRESHOLD bytes have been written. The rest of a longer
+    stream is split into parts that are uploaded concurrently to temporary
+    objects and then composed after what was already written (until then the
+    object holds only the start of the stream).
+
     Args:
       stream: Any io.RawIOBase (will NOT be closed by this function).
       url: Full URL of the object. Use either this or bucket and object.
       bucket: Bucket name. Use either this and object or url.
       obj: Object name. Use either this and bucket or url.
+      content_type: Optional content/MIME type of the object.
+      size: Optional length of the stream. If known to be longer than
+        PARALLEL_UPLOAD_THRESHOLD the whole stream is uploaded in parts.
     """
-    path = ''
     if url:
-      path = Gcs.UrlToBucketAndNamePath(url)
-    else:
-      path = Gcs.MakeBucketAndNamePath(bucket, obj)
-    with contextlib.closing(cloudstorage.open(path, 'w')) as obj:
+      (bucket, obj) = Gcs.UrlToBucketAndName(url)
+    _Invalidate(bucket, obj)
+
+    if size is not None and size > self.PARALLEL_UPLOAD_THRESHOLD:
+      self._InsertObjectParallel(stream, bucket, obj, content_type)
+      return
+
+    written = 0
+    with self._OpenWriter(bucket, obj, content_type) as gcs_obj:
+      while written <= self.PARALLEL_UPLOAD_THRESHOLD:
+        buf = stream.read(self.STREAM_CHUNK_SIZE)
+        if not buf:
+          return
+        gcs_obj.write(buf)
+        written += len(buf)
+    self._InsertObjectParallel(stream, bucket, obj, content_type, [obj])
+
+  def _InsertObjectParallel(self, stream, bucket, obj, content_type,
+                            head=()):
+    """Uploads a stream as concurrent parts and composes them into obj.
+
+    Args:
+      stream: the data to upload.
+      bucket: Bucket name.
+      obj: Object name.
+      content_type: Optional content/MIME type of the object.
+      head: objects holding data from before the stream, composed first.
+        They are deleted if the upload fails.
+    """
+    token = uuid.uuid4().hex
+
+    def Parts():
+      data = ''
+      index = 0
       while True:
-        buf = stream.read(self.READ_CHUNK_SIZE)
-        if buf and len(buf):
-          obj.write(buf)
-        else:
+        while len(data) < self.PARALLEL_UPLOAD_PART_SIZE:
+          buf = stream.read(self.READ_CHUNK_SIZE)
+          if not buf:
+            break
+          data += buf
+        if not data:
           return
+        yield (index, data[:self.PARALLEL_UPLOAD_PART_SIZE])
+        data = data[self.PARALLEL_UPLOAD_PART_SIZE:]
+        index += 1
+
+    def UploadPart(part):
+      (index, data) = part
+      name = '%s.upload-%s-%05d' % (obj, token, index)
+      with self._OpenWriter(bucket, name) as gcs_obj:
+        gcs_obj.write(data)
+      return name
+
+    start = time.time()
+    names = []
+    try:
+      for name in parallel.IMap(UploadPart, Parts(),
+                                max_workers=self.PARALLEL_UPLOAD_WORKERS):
+        names.append(name)
+      if names:
+        self.ComposeObjects(bucket, list(head) + names, obj,
+                            content_type or self.DEFAULT_CONTENT_TYPE)
+    except Exception:  # pylint: disable=broad-except
+      if head:
+        self._DeleteTemporaries(bucket, head)
+      raise
+    finally:
+      self._DeleteTemporaries(bucket, names)
+    logging.info('Uploaded gs://%s/%s in %d parts in %.1fs',
+                 bucket, obj, len(names), time.time() - start)
 
   def DeleteObject(self, bucket, obj, ignore_missing_files=True):
     """Removes an existing GCS object."""
+    _Invalidate(bucket, obj)
     try:
-      self._AcquireService().objects().delete(bucket=bucket,
-                                              object=obj).execute()
-    except HttpError as err:
-      if err.resp.status == 404 and ignore_missing_files:
+      self._backend.Delete(bucket, obj)
+    except Exception as err:  # pylint: disable=broad-except
+      if self._backend.IsNotFound(err) and ignore_missing_files:
         logging.info('ignoring missing file (404) error deleting gs://%s/%s %r',
                      bucket, obj, err)
       else:
         raise err
 
+  def DeleteObjects(self, urls, ignore_missing_files=True):
+    """Removes many GCS objects concurrently (in batch requests on GCS).
+
+    Args:
+      urls: the URLs of the objects to delete.
+      ignore_missing_files: treat objects that do not exist as deleted.
+
+    Returns:
+      A dict of each URL to None if it was deleted or the error if not.
+    """
+    urls = list(collections.OrderedDict.fromkeys(urls))
+    for url in urls:
+      _Invalidate(*Gcs.UrlToBucketAndName(url))
+    results = self._backend.DeleteMany(urls)
+    for url, err in results.iteritems():
+      if err and ignore_missing_files and self._backend.IsNotFound(err):
+        logging.info('ignoring missing file (404) error deleting %s', url)
+        results[url] = None
+    return results
+
   def ComposeObjects(self, bucket, src_objects, dest_obj, content_type):
     """Composes multiple objects into a one.
 
@@ -292,16 +548,12 @@ class Gcs(object):
       The destination object resource.
     """
     src_objects_len = len(src_objects)
+    _Invalidate(bucket, dest_obj)
     if src_objects_len < 1:
       return {}
     elif src_objects_len <= self.MAX_COMPOSABLE_OBJECTS:
-      body = {'sourceObjects': [{'name': s} for s in src_objects],
-              'destination': {'contentType': content_type}}
       logging.info('calling gcs composit with %d objects', len(src_objects))
-      req = self._AcquireService().objects().compose(destinationBucket=bucket,
-                                                     destinationObject=dest_obj,
-                                                     body=body)
-      return req.execute()
+      return self._backend.Compose(bucket, src_objects, dest_obj, content_type)
     elif src_objects_len <= self.MAX_TOTAL_COMPOSABLE_OBJECTS:
       # A composed object can store all these src_objects
       tmp = []
@@ -309,9 +561,7 @@ class Gcs(object):
         tmp.append(self.UrlToBucketAndName(self.UrlCreator(bucket)())[1])
         self.ComposeObjects(bucket, chunk, tmp[-1], content_type)
       r = self.ComposeObjects(bucket, tmp, dest_obj, content_type)
-      # Clean up temporary objects
-      for t in tmp:
-        self.DeleteObject(bucket, t)
+      self._DeleteTemporaries(bucket, tmp)
       return r
     else:
       # A composed object will have too many parts to make this in one compose.
@@ -321,14 +571,19 @@ class Gcs(object):
         tmp.append(self.UrlToBucketAndName(self.UrlCreator(bucket)())[1])
         self.ComposeObjects(bucket, chunk, tmp[-1], content_type)
       # now compress those temp files to reset the composed object count
-      for dest_obj in tmp:
-        self.CompressObject(self.MakeUrl(*dest_obj))
-      r = self.ComposeObjects(bucket, tmp, dest_obj, content_type)
-      # Clean up temporary objects
       for t in tmp:
-        self.DeleteObject(bucket, t)
+        self.CompressObject(self.MakeUrl(bucket, t))
+      r = self.ComposeObjects(bucket, tmp, dest_obj, content_type)
+      self._DeleteTemporaries(bucket, tmp)
       return r
 
+  def _DeleteTemporaries(self, bucket, objs):
+    """Removes temporary objects, logging any that could not be deleted."""
+    results = self.DeleteObjects(self.MakeUrl(bucket, o) for o in objs)
+    for url, err in results.iteritems():
+      if err:
+        logging.warning('Could not delete temporary object %s: %r', url, err)
+
   def CompressObject(self, src):
     """Compresses an object to reset the composite-ness of it.
 
@@ -345,17 +600,14 @@ class Gcs(object):
       raise ValueError('No source specified.')
 
     (src_bucket, src_object) = self.UrlToBucketAndName(src)
-    tmp = self.UrlCreator(bucket=src_bucket)
+    tmp = self.UrlCreator(bucket=src_bucket)()
 
     logging.info('Compressing %s to %s', src, tmp)
 
     # copy the file contents.
-    src_path = Gcs.UrlToBucketAndNamePath(src)
-    tmp_path = Gcs.UrlToBucketAndNamePath(src)
-
     count = 0
-    with cloudstorage.open(src_path) as src_obj:
-      with cloudstorage.open(tmp_path, 'w') as tmp_obj:
+    with self.OpenObject(src, prefetch=self.PREFETCH_RANGES) as src_obj:
+      with self.OpenObject(tmp, mode='w') as tmp_obj:
         while True:
           count += 1
           if count % 128 == 0:
@@ -373,6 +625,385 @@ class Gcs(object):
     logging.info('Compressing %s DONE', src)
 
 
+class StorageBackend(object):
+  """The object storage operations Gcs is built on.
+
+  Paths are '/bucket/object' strings as used by cloudstorage.
+  """
+
+  def Open(self, path, mode='r', content_type=None):
+    """Returns a file-like object for reading ('r') or writing ('w')."""
+    raise NotImplementedError()
+
+  def Stat(self, path):
+    """Returns a dict with size, md5Hash, contentType and metadata keys."""
+    raise NotImplementedError()
+
+  def List(self, bucket, prefix=None, delimiter=None):
+    """Yields GCSFileStat-like objects (filename, is_dir) in name order."""
+    raise NotImplementedError()
+
+  def ReadRange(self, bucket, obj, start, end):
+    """Returns the bytes of an object from start up to (excluding) end."""
+    raise NotImplementedError()
+
+  def Copy(self, src_bucket, src_obj, dest_bucket, dest_obj):
+    """Copies an object and returns the destination object resource."""
+    raise NotImplementedError()
+
+  def SetMetadata(self, bucket, obj, metadata):
+    """Merges metadata into the custom metadata of an object."""
+    raise NotImplementedError()
+
+  def Compose(self, bucket, src_objects, dest_obj, content_type):
+    """Concatenates up to MAX_COMPOSABLE_OBJECTS objects into dest_obj."""
+    raise NotImplementedError()
+
+  def Delete(self, bucket, obj):
+    """Removes an object."""
+    raise NotImplementedError()
+
+  def DeleteMany(self, urls):
+    """Removes objects, returning a dict of each URL to None or the error."""
+    def Delete(url):
+      try:
+        self.Delete(*Gcs.UrlToBucketAndName(url))
+      except Exception as err:  # pylint: disable=broad-except
+        return err
+    return dict(zip(urls, parallel.Map(Delete, urls)))
+
+  def IsNotFound(self, err):
+    """Returns True if err was raised because an object does not exist."""
+    return isinstance(err, cloudstorage.NotFoundError)
+
+
+class GcsBackend(StorageBackend):
+  """Google Cloud Storage through cloudstorage and the JSON API."""
+
+  def __init__(self, storage):
+    """Create a GcsBackend.
+
+    Args:
+      storage: the Gcs client whose JSON API service is used.
+    """
+    self._storage = storage
+
+  def _Objects(self):
+    return self._storage._AcquireService().objects()
+
+  def Open(self, path, mode='r', content_type=None):
+    if content_type:
+      return cloudstorage.open(path, mode, content_type=content_type)
+    return cloudstorage.open(path, mode)
+
+  def Stat(self, path):
+    stat = cloudstorage.stat(path)
+    return {
+        'size': stat.st_size,
+        'md5Hash': stat.etag,
+        'contentType': stat.content_type,
+        'metadata': stat.metadata
+    }
+
+  def List(self, bucket, prefix=None, delimiter=None):
+    if delimiter:
+      return cloudstorage.listbucket(bucket, prefix=prefix, delimiter=delimiter)
+    return cloudstorage.listbucket(bucket, prefix=prefix)
+
+  def ReadRange(self, bucket, obj, start, end):
+    req = self._Objects().get_media(bucket=bucket, object=obj)
+    req.headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+    return req.execute()
+
+  def Copy(self, src_bucket, src_obj, dest_bucket, dest_obj):
+    req = self._Objects().copy(sourceBucket=src_bucket,
+                               sourceObject=src_obj,
+                               destinationBucket=dest_bucket,
+                               destinationObject=dest_obj,
+                               body={})
+    return req.execute()
+
+  def SetMetadata(self, bucket, obj, metadata):
+    req = self._Objects().patch(bucket=bucket, object=obj,
+                                body={'metadata': metadata})
+    return req.execute()
+
+  def Compose(self, bucket, src_objects, dest_obj, content_type):
+    body = {'sourceObjects': [{'name': s} for s in src_objects],
+            'destination': {'contentType': content_type}}
+    req = self._Objects().compose(destinationBucket=bucket,
+                                  destinationObject=dest_obj,
+                                  body=body)
+    return req.execute()
+
+  def Delete(self, bucket, obj):
+    self._Objects().delete(bucket=bucket, object=obj).execute()
+
+  def DeleteMany(self, urls):
+    """Deletes objects in concurrent JSON API batch requests."""
+
+    def DeleteBatch(batch_urls):
+      results = {}
+
+      def Callback(url, unused_response, exception):
+        results[url] = exception
+
+      batch = BatchHttpRequest()
+      objects = self._Objects()
+      for url in batch_urls:
+        (bucket, obj) = Gcs.UrlToBucketAndName(url)
+        batch.add(objects.delete(bucket=bucket, object=obj),
+                  callback=Callback, request_id=url)
+      batch.execute()
+      return results
+
+    results = {}
+    for r in parallel.IMap(DeleteBatch,
+                           SplitEvenly(urls, Gcs.DELETE_BATCH_SIZE)):
+      results.update(r)
+    return results
+
+  def IsNotFound(self, err):
+    return isinstance(err, HttpError) and err.resp.status == 404
+
+
+class ParallelReader(object):
+  """A read-only file-like GCS object that fetches ranges concurrently.
+
+  While the current range is consumed, up to prefetch following ranges are
+  downloaded with ranged JSON API media requests. Only those ranges are held
+  in memory. Seeking within the current range is free; seeking anywhere else
+  drops the prefetched ranges and starts fetching from the new offset.
+  """
+
+  def __init__(self, storage, bucket, obj, size,
+               range_size=Gcs.PREFETCH_RANGE_SIZE,
+               prefetch=Gcs.PREFETCH_RANGES):
+    """Create a ParallelReader.
+
+    Args:
+      storage: the Gcs client to read with.
+      bucket: the GCS bucket.
+      obj: the GCS object name.
+      size: the size of the object in bytes.
+      range_size: the size of each ranged request.
+      prefetch: the number of ranges fetched concurrently.
+    """
+    self._storage = storage
+    self._bucket = bucket
+    self._obj = obj
+    self._size = size
+    self._range_size = range_size
+    self._prefetch = prefetch
+    self.closed = False
+    self._FetchFrom(0)
+
+  def _FetchFrom(self, offset):
+    """Drops any buffered data and starts fetching ranges at offset."""
+    self._ranges = parallel.IMap(
+        self._ReadRange, xrange(offset, self._size, self._range_size),
+        max_workers=self._prefetch)
+    self._buffer = ''
+    self._buffer_start = offset
+    self._buffer_offset = 0
+
+  def _ReadRange(self, start):
+    """Downloads the range of the object beginning at start."""
+    end = min(start + self._range_size, self._size)
+    return self._storage._backend.ReadRange(self._bucket, self._obj,
+                                            start, end)
+
+  def _NextRange(self):
+    """Makes the next range current. Returns False after the last one."""
+    self._buffer_start += len(self._buffer)
+    self._buffer = next(self._ranges, '')
+    self._buffer_offset = 0
+    return bool(self._buffer)
+
+  def _Read(self, size, find_newline):
+    """Reads up to size bytes (all if negative), optionally up to a newline."""
+    if self.closed:
+      raise ValueError('I/O operation on closed file.')
+    chunks = []
+    while size:
+      if self._buffer_offset >= len(self._buffer) and not self._NextRange():
+        break
+      end = len(self._buffer)
+      if find_newline:
+        end = self._buffer.find('\n', self._buffer_offset) + 1 or end
+      if size > 0:
+        end = min(end, self._buffer_offset + size)
+        size -= end - self._buffer_offset
+      chunks.append(self._buffer[self._buffer_offset:end])
+      self._buffer_offset = end
+      if find_newline and chunks[-1].endswith('\n'):
+        break
+    return ''.join(chunks)
+
+  def read(self, size=-1):
+    return self._Read(size, False)
+
+  def readline(self, size=-1):
+    return self._Read(size, True)
+
+  def seek(self, offset, whence=0):
+    if self.closed:
+      raise ValueError('I/O operation on closed file.')
+    if whence == 1:
+      offset += self.tell()
+    elif whence == 2:
+      offset += self._size
+    if offset < 0:
+      raise IOError('Invalid seek offset %d' % offset)
+    if self._buffer_start <= offset <= self._buffer_start + len(self._buffer):
+      self._buffer_offset = offset - self._buffer_start
+    else:
+      self._FetchFrom(offset)
+
+  def tell(self):
+    return self._buffer_start + self._buffer_offset
+
+  def close(self):
+    self.closed = True
+    self._buffer = ''
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration()
+    return line
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+
+class ListCache(object):
+  """A small, time limited cache of bucket listings keyed by (bucket, prefix).
+
+  Entries for a bucket are dropped whenever this process writes to it.
+  """
+
+  def __init__(self, max_entries=64, ttl_seconds=30):
+    self._max_entries = max_entries
+    self._ttl_seconds = ttl_seconds
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def Get(self, key):
+    """Returns the cached names for key or None."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if not entry or entry[0] < time.time():
+        return None
+      self._entries[key] = entry
+      return entry[1]
+
+  def Put(self, key, names):
+    """Caches names for key, evicting the least recently used entry."""
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self._ttl_seconds, names)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def Invalidate(self, bucket):
+    """Drops every cached listing of bucket."""
+    bucket = bucket.strip('/')
+    with self._lock:
+      for key in [k for k in self._entries if k[0] == bucket]:
+        del self._entries[key]
+
+
+class StatCache(object):
+  """Caches object stats for the current request and briefly in memcache."""
+
+  KEY_PREFIX = 'gcs-stat:'
+
+  def __init__(self, ttl_seconds=10):
+    self._ttl_seconds = ttl_seconds
+    self._local = threading.local()
+
+  def _RequestStats(self):
+    """Returns the stats cached by this request, if it is one.
+
+    Concurrent requests on a threadsafe instance run on their own threads, so
+    the stats live in thread-local storage and are dropped when the thread
+    moves on to another request.
+    """
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if not request_id:
+      return {}
+    if getattr(self._local, 'request_id', None) != request_id:
+      self._local.request_id = request_id
+      self._local.stats = {}
+    return self._local.stats
+
+  def _Key(self, path):
+    if len(path) > 200:
+      path = hashlib.sha1(path).hexdigest()
+    return self.KEY_PREFIX + path
+
+  def Get(self, path):
+    """Returns the cached stat for a /bucket/object path or None."""
+    stats = self._RequestStats()
+    stat = stats.get(path)
+    if stat is None:
+      stat = memcache.get(self._Key(path))
+      if stat is not None:
+        stats[path] = stat
+    return stat
+
+  def Put(self, path, stat):
+    """Caches the stat of a /bucket/object path."""
+    self._RequestStats()[path] = stat
+    memcache.set(self._Key(path), stat, time=self._ttl_seconds)
+
+  def Invalidate(self, path):
+    """Drops the cached stat of a /bucket/object path."""
+    self._RequestStats().pop(path, None)
+    memcache.delete(self._Key(path))
+
+
+_list_cache = ListCache()
+_stat_cache = StatCache()
+
+
+def _Invalidate(bucket, obj):
+  """Drops cached listings and stats made stale by writing an object."""
+  _list_cache.Invalidate(bucket)
+  _stat_cache.Invalidate(Gcs.MakeBucketAndNamePath(bucket, obj))
+
+
+class _InvalidatingWriter(object):
+  """Wraps a backend writer to call _Invalidate once more when it closes."""
+
+  def __init__(self, writer, bucket, obj):
+    self._writer = writer
+    self._bucket = bucket
+    self._obj = obj
+
+  def close(self):
+    try:
+      self._writer.close()
+    finally:
+      _Invalidate(self._bucket, self._obj)
+
+  def __getattr__(self, name):
+    return getattr(self._writer, name)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+
 def SplitEvenly(arr, max_size):
   """Split an array into even chunks that are no larger than max_size."""
   arr_len = len(arr)
@@ -14,9 +14,15 @@
 
 """GCS utility unit tests."""
 
+import os
+import StringIO
+import threading
+
+from apiclient.errors import HttpError
 import mock
 
 import cloudstorage  # pylint: disable=unused-import
+from google.appengine.api import memcache
 
 import logging
 from src import basetest
@@ -25,6 +31,11 @@ from src.clients import gcs
 
 class GCSTest(basetest.TestCase):
 
+  def setUp(self):
+    super(GCSTest, self).setUp()
+    gcs._list_cache = gcs.ListCache()
+    gcs._stat_cache = gcs.StatCache()
+
   def testURLFuncs(self):
     bad_proto_urls = ['/bad', 'bad', '//bad', '', '/', '//', ' ', 'bad/bad',
                       '//bad/bad', 'foo://bad', 'foo://bad/bad', '://', ':/',
@@ -75,10 +86,45 @@ class GCSTest(basetest.TestCase):
     mock_list_resp.return_value = [mock.MagicMock(filename=o) for o in objs]
     with mock.patch.object(cloudstorage, 'listbucket',
                            mock_list_resp):
-      res = storage.ListBucket('bucket')
+      res = list(storage.ListBucket('bucket'))
       for o in objs_in_gs:
         self.assertIn(o, res)
 
+  def testListPushesGlobPrefix(self):
+    objs = ['/bucket/logs/2013/a.csv', '/bucket/logs/2013/b.txt']
+    storage = gcs.Gcs()
+    with mock.patch.object(cloudstorage, 'listbucket', return_value=[
+        mock.MagicMock(filename=o) for o in objs]) as mock_list:
+      res = list(storage.ListBucket('bucket', 'logs/',
+                                    '/bucket/logs/2013/*.csv'))
+      self.assertEquals(['gs://bucket/logs/2013/a.csv'], res)
+      mock_list.assert_called_once_with('bucket', prefix='logs/2013/')
+
+      # Listings are cached until the bucket is written to.
+      list(storage.ListBucket('bucket', 'logs/2013/'))
+      self.assertEquals(1, mock_list.call_count)
+      with mock.patch.object(cloudstorage, 'open'):
+        storage.OpenObject(bucket='bucket', obj='logs/2013/c.csv', mode='w')
+      list(storage.ListBucket('bucket', 'logs/2013/'))
+      self.assertEquals(2, mock_list.call_count)
+
+  def testListFanOut(self):
+    listings = {
+        None: [mock.MagicMock(filename='/bucket/a', is_dir=False),
+               mock.MagicMock(filename='/bucket/b/', is_dir=True),
+               mock.MagicMock(filename='/bucket/c', is_dir=False),
+               mock.MagicMock(filename='/bucket/d/', is_dir=True)],
+        'b/': [mock.MagicMock(filename='/bucket/b/1'),
+               mock.MagicMock(filename='/bucket/b/2')],
+        'd/': [mock.MagicMock(filename='/bucket/d/1')],
+    }
+    storage = gcs.Gcs()
+    with mock.patch.object(cloudstorage, 'listbucket',
+                           side_effect=lambda b, prefix, **_: listings[prefix]):
+      res = list(storage.ListBucket('bucket', fan_out=True))
+    self.assertEquals(['gs://bucket/a', 'gs://bucket/b/1', 'gs://bucket/b/2',
+                       'gs://bucket/c', 'gs://bucket/d/1'], res)
+
   def testStat(self):
     class MockStat(object):
       def __init__(self):
@@ -103,6 +149,74 @@ class GCSTest(basetest.TestCase):
       stat = storage.StatObject(bucket='bucket', obj='obj')
       self.assertSameStructure(stat, expect)
 
+  def testStatCacheIsPerRequest(self):
+    cache = gcs.StatCache()
+    stat = {'size': 1}
+    with mock.patch.dict(os.environ, {'REQUEST_LOG_ID': 'a'}):
+      cache.Put('/bucket/obj', stat)
+      with mock.patch.object(memcache, 'get', return_value=None):
+        self.assertIs(stat, cache.Get('/bucket/obj'))
+
+        seen = []
+
+        def OtherRequest():
+          with mock.patch.dict(os.environ, {'REQUEST_LOG_ID': 'b'}):
+            seen.append(cache.Get('/bucket/obj'))
+
+        # A concurrent request on another thread doesn't see these stats,
+        # nor does it drop them for this one.
+        thread = threading.Thread(target=OtherRequest)
+        thread.start()
+        thread.join()
+        self.assertEquals([None], seen)
+        self.assertIs(stat, cache.Get('/bucket/obj'))
+
+      with mock.patch.dict(os.environ, {'REQUEST_LOG_ID': 'c'}):
+        with mock.patch.object(memcache, 'get', return_value=None):
+          self.assertIsNone(cache.Get('/bucket/obj'))
+
+  def testStatCache(self):
+    storage = gcs.Gcs()
+    stat = mock.MagicMock(st_size=100, etag='etag', content_type='text/plain',
+                          metadata={})
+    with mock.patch.object(cloudstorage, 'stat',
+                           return_value=stat) as mock_stat:
+      storage.StatObject('gs://bucket/obj')
+      gcs._stat_cache = gcs.StatCache()  # A new request still hits memcache.
+      self.assertEquals(100, storage.StatObject('gs://bucket/obj')['size'])
+      self.assertEquals(1, mock_stat.call_count)
+
+      with mock.patch.object(cloudstorage, 'open') as mock_open:
+        writer = storage.OpenObject('gs://bucket/obj', mode='w')
+        storage.StatObject('gs://bucket/obj')
+        self.assertEquals(2, mock_stat.call_count)
+
+        # Stats cached while the object is being written are dropped too.
+        writer.close()
+        mock_open.return_value.close.assert_called_once_with()
+        storage.StatObject('gs://bucket/obj')
+        self.assertEquals(3, mock_stat.call_count)
+
+        storage.InsertObject(StringIO.StringIO('data'), 'gs://bucket/obj',
+                             size=4)
+        storage.StatObject('gs://bucket/obj')
+        self.assertEquals(4, mock_stat.call_count)
+
+  def testStatObjects(self):
+    def Stat(path):
+      if path == '/bucket/missing':
+        raise cloudstorage.NotFoundError()
+      return mock.MagicMock(st_size=len(path), etag='etag',
+                            content_type='text/plain', metadata={})
+
+    storage = gcs.Gcs()
+    with mock.patch.object(cloudstorage, 'stat', side_effect=Stat):
+      stats = storage.StatObjects(['gs://bucket/a', 'gs://bucket/missing',
+                                   'gs://bucket/bcd'])
+    self.assertEquals({'gs://bucket/a': 9, 'gs://bucket/bcd': 11,
+                       'gs://bucket/missing': None},
+                      dict((k, v and v['size']) for k, v in stats.items()))
+
   def testComposeNoRec(self):
     src = ['0', '1', '2', '3', '4', '5', '6', '7']
     mock_service = mock.MagicMock()
@@ -133,7 +247,9 @@ class GCSTest(basetest.TestCase):
                            autospec=True):
       storage.MAX_COMPOSABLE_OBJECTS = 3
       storage._service = mock_service
-      storage.ComposeObjects('bucket', src, 'dest', 'text/plain')
+      with mock.patch.object(gcs, 'BatchHttpRequest') as mock_batch:
+        storage.ComposeObjects('bucket', src, 'dest', 'text/plain')
+      mock_batch.return_value.execute.assert_called_once_with()
 
       call_a = mock.call.compose(
           destinationBucket='bucket',
@@ -159,6 +275,136 @@ class GCSTest(basetest.TestCase):
       calls = [call_a, call_b, call_c, call_d]
       mock_objects.assert_has_calls(calls, any_order=True)
 
+  def testSetObjectMetadata(self):
+    mock_service = mock.MagicMock()
+    storage = gcs.Gcs()
+    storage._service = mock_service
+    storage.SetObjectMetadata('gs://bucket/a/obj', {'k': 'v'})
+    mock_service.objects().patch.assert_called_once_with(
+        bucket='bucket', object='a/obj', body={'metadata': {'k': 'v'}})
+
+  def testDeleteObjects(self):
+    urls = ['gs://bucket/%d' % i for i in range(250)]
+    mock_service = mock.MagicMock()
+    storage = gcs.Gcs()
+    storage._service = mock_service
+    batches = []
+
+    class MockBatch(object):
+
+      def __init__(self):
+        self.requests = []
+        batches.append(self)
+
+      def add(self, request, callback, request_id):
+        self.requests.append((request_id, callback))
+
+      def execute(self):
+        for (url, callback) in self.requests:
+          status = {'gs://bucket/7': 404, 'gs://bucket/8': 500}.get(url)
+          callback(url, None,
+                   status and HttpError(mock.Mock(status=status), ''))
+
+    with mock.patch.object(gcs, 'BatchHttpRequest', MockBatch):
+      results = storage.DeleteObjects(urls)
+
+    self.assertEquals([82, 84, 84], sorted(len(b.requests) for b in batches))
+    self.assertEquals(set(urls), set(results))
+    self.assertEquals(['gs://bucket/8'], [u for u in urls if results[u]])
+    mock_service.objects().delete.assert_any_call(bucket='bucket', object='7')
+
+  def testParallelReader(self):
+    data = ''.join('line %d\n' % i for i in range(100))
+    requests = []
+
+    def GetMedia(bucket, object):  # pylint: disable=redefined-builtin
+      self.assertEquals(('bucket', 'obj'), (bucket, object))
+      req = mock.MagicMock(headers={})
+      req.execute.side_effect = lambda: data[
+          int(req.headers['Range'][6:].split('-')[0]):
+          int(req.headers['Range'].split('-')[1]) + 1]
+      requests.append(req)
+      return req
+
+    storage = gcs.Gcs()
+    storage._service = mock.MagicMock()
+    storage._service.objects.return_value.get_media.side_effect = GetMedia
+    with mock.patch.object(cloudstorage, 'stat',
+                           return_value=mock.MagicMock(
+                               st_size=len(data), etag='etag',
+                               content_type='text/plain', metadata={})):
+      with mock.patch.object(cloudstorage, 'open') as mock_open:
+        self.assertEquals(mock_open.return_value,
+                          storage.OpenObject('gs://bucket/obj', prefetch=3))
+        storage.PREFETCH_RANGE_SIZE = 64
+        self.assertIsInstance(storage.OpenObject('gs://bucket/obj', prefetch=3),
+                              gcs.ParallelReader)
+    with gcs.ParallelReader(storage, 'bucket', 'obj', len(data),
+                            range_size=64, prefetch=3) as reader:
+      self.assertEquals('line 0\n', reader.readline())
+      self.assertEquals('line', reader.read(4))
+      self.assertEquals(11, reader.tell())
+      self.assertEquals(data[11:], ''.join(reader))
+      self.assertEquals('', reader.read())
+    self.assertEquals(len(data), reader.tell())
+    self.assertEquals(
+        sorted('bytes=%d-%d' % (i, min(i + 64, len(data)) - 1)
+               for i in range(0, len(data), 64)),
+        sorted(r.headers['Range'] for r in requests))
+
+    with gcs.ParallelReader(storage, 'bucket', 'obj', len(data),
+                            range_size=64, prefetch=3) as reader:
+      reader.seek(7)
+      self.assertEquals('line 1\n', reader.readline())
+      reader.seek(-8, 2)
+      self.assertEquals('line 99\n', reader.read())
+      reader.seek(0)
+      reader.seek(7, 1)
+      self.assertEquals(7, reader.tell())
+      self.assertEquals('line 1\n', reader.readline())
+      self.assertRaises(IOError, reader.seek, -1)
+
+  def testInsertObject(self):
+    storage = gcs.Gcs()
+    storage.READ_CHUNK_SIZE = 3
+    storage.STREAM_CHUNK_SIZE = 4
+    storage.PARALLEL_UPLOAD_THRESHOLD = 10
+    storage.PARALLEL_UPLOAD_PART_SIZE = 8
+    with mock.patch.object(storage, 'ComposeObjects') as mock_compose:
+      storage.InsertObject(StringIO.StringIO('small'), 'gs://bucket/small')
+      self.assertFalse(mock_compose.called)
+      with mock.patch.object(storage, 'DeleteObjects') as mock_delete:
+        mock_delete.return_value = {}
+        storage.InsertObject(StringIO.StringIO('0123456789abcdefghij'),
+                             'gs://bucket/large', content_type='text/plain')
+
+    storage.InsertObject(StringIO.StringIO('0123456789'),
+                         'gs://bucket/known', size=10)
+    with storage.OpenObject('gs://bucket/known') as f:
+      self.assertEquals('0123456789', f.read())
+    with storage.OpenObject('gs://bucket/small') as f:
+      self.assertEquals('small', f.read())
+    (bucket, parts, obj, content_type) = mock_compose.call_args[0]
+    self.assertEquals(('bucket', 'large', 'text/plain'),
+                      (bucket, obj, content_type))
+    contents = []
+    for part in parts:
+      with storage.OpenObject(bucket='bucket', obj=part) as f:
+        contents.append(f.read())
+    # The first 12 bytes were streamed into the object itself.
+    self.assertEquals('large', parts[0])
+    self.assertEquals(['0123456789ab', 'cdefghij'], contents)
+    self.assertEquals([gcs.Gcs.MakeUrl('bucket', p) for p in parts[1:]],
+                      list(mock_delete.call_args[0][0]))
+
+    with mock.patch.object(storage, 'ComposeObjects') as mock_compose, \
+        mock.patch.object(storage, 'DeleteObjects', return_value={}):
+      storage.InsertObject(StringIO.StringIO('0123456789abcdefghij'),
+                           'gs://bucket/sized', size=20)
+    (_, parts, _, _) = mock_compose.call_args[0]
+    self.assertEquals(3, len(parts))
+    self.assertNotIn('sized', parts)
+
   def testSplitEvenly(self):
     self.assertEquals([6, 5],
                       [len(x) for x in gcs.SplitEvenly(tuple(range(11)), 9)])
@@ -0,0 +1,274 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Local filesystem storage backend.
+
+Lets pipelines (and benchmarks of them) run without live GCS:
+
+  gcs.SetBackend(localstorage.LocalBackend('/tmp/gcs'))
+
+makes every new Gcs client keep gs://bucket/object in a file in /tmp/gcs/bucket.
+Each bucket is a flat directory of files named after their objects with '/'
+(and other special characters) %-escaped, so that, as on GCS, an object
+and a "directory" prefix of the same name can coexist: ShardStage, for one,
+composes gs://b/out/<uuid> shards into gs://b/out.
+"""
+
+import collections
+import hashlib
+import mimetypes
+import mmap
+import os
+import shutil
+import urllib
+import uuid
+
+import cloudstorage
+from src.clients import gcs
+
+# Objects are written to a hidden temporary file and renamed into place so
+# that, as on GCS, readers never see partial objects and copies may share
+# data through hard links.
+TMP_PREFIX = '.localstorage-tmp-'
+
+FileStat = collections.namedtuple('FileStat', ['filename', 'is_dir',
+                                               'st_size'])
+
+
+class LocalBackend(gcs.StorageBackend):
+  """Keeps objects as files under root/bucket, see EncodeName."""
+
+  def __init__(self, root):
+    self._root = root
+
+  def _Filename(self, path):
+    """Returns the file that holds a /bucket/object path."""
+    (bucket, obj) = path.lstrip('/').split('/', 1)
+    return os.path.join(self._root, bucket, EncodeName(obj))
+
+  def _CheckExists(self, filename):
+    if not os.path.isfile(filename):
+      raise cloudstorage.NotFoundError(filename)
+
+  def _Resource(self, bucket, obj):
+    """Returns an object resource like those the JSON API returns."""
+    filename = self._Filename(gcs.Gcs.MakeBucketAndNamePath(bucket, obj))
+    return {'bucket': bucket, 'name': obj,
+            'size': str(os.path.getsize(filename)),
+            'selfLink': 'file://' + filename}
+
+  def Open(self, path, mode='r', content_type=None):
+    filename = self._Filename(path)
+    if mode == 'r':
+      self._CheckExists(filename)
+      return MappedFile(filename)
+    return AtomicFile(filename)
+
+  def Stat(self, path):
+    filename = self._Filename(path)
+    self._CheckExists(filename)
+    md5 = hashlib.md5()
+    with MappedFile(filename) as f:
+      while True:
+        buf = f.read(gcs.Gcs.READ_CHUNK_SIZE)
+        if not buf:
+          break
+        md5.update(buf)
+    return {
+        'size': os.path.getsize(filename),
+        'md5Hash': md5.hexdigest(),
+        'contentType': (mimetypes.guess_type(filename)[0] or
+                        gcs.Gcs.DEFAULT_CONTENT_TYPE),
+        'metadata': {}
+    }
+
+  def List(self, bucket, prefix=None, delimiter=None):
+    bucket = bucket.strip('/')
+    prefix = prefix or ''
+    top = os.path.join(self._root, bucket)
+    filenames = os.listdir(top) if os.path.isdir(top) else []
+    names = [DecodeName(f) for f in filenames if not f.startswith(TMP_PREFIX)]
+    names = [n for n in names if n.startswith(prefix)]
+    last_dir = None
+    for name in sorted(names):
+      rest = name[len(prefix):]
+      if delimiter and delimiter in rest:
+        dir_name = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+        if dir_name != last_dir:
+          last_dir = dir_name
+          yield FileStat('/%s/%s' % (bucket, dir_name), True, None)
+      else:
+        yield FileStat('/%s/%s' % (bucket, name), False, os.path.getsize(
+            os.path.join(top, EncodeName(name))))
+
+  def ReadRange(self, bucket, obj, start, end):
+    filename = self._Filename(gcs.Gcs.MakeBucketAndNamePath(bucket, obj))
+    self._CheckExists(filename)
+    with open(filename, 'rb') as f:
+      f.seek(start)
+      return f.read(end - start)
+
+  def Copy(self, src_bucket, src_obj, dest_bucket, dest_obj):
+    src = self._Filename(gcs.Gcs.MakeBucketAndNamePath(src_bucket, src_obj))
+    self._CheckExists(src)
+    dest = self._Filename(gcs.Gcs.MakeBucketAndNamePath(dest_bucket, dest_obj))
+    tmp = TempFilename(dest)
+    try:
+      os.link(src, tmp)
+    except OSError:
+      shutil.copyfile(src, tmp)
+    os.rename(tmp, dest)
+    return self._Resource(dest_bucket, dest_obj)
+
+  def SetMetadata(self, bucket, obj, metadata):
+    # Files carry no custom metadata; Stat always reports an empty dict.
+    filename = self._Filename(gcs.Gcs.MakeBucketAndNamePath(bucket, obj))
+    self._CheckExists(filename)
+    return self._Resource(bucket, obj)
+
+  def Compose(self, bucket, src_objects, dest_obj, content_type):
+    srcs = [self._Filename(gcs.Gcs.MakeBucketAndNamePath(bucket, o))
+            for o in src_objects]
+    for src in srcs:
+      self._CheckExists(src)
+    with AtomicFile(self._Filename(
+        gcs.Gcs.MakeBucketAndNamePath(bucket, dest_obj))) as dest:
+      for src in srcs:
+        with open(src, 'rb') as f:
+          shutil.copyfileobj(f, dest.file, gcs.Gcs.READ_CHUNK_SIZE)
+    return self._Resource(bucket, dest_obj)
+
+  def Delete(self, bucket, obj):
+    filename = self._Filename(gcs.Gcs.MakeBucketAndNamePath(bucket, obj))
+    self._CheckExists(filename)
+    os.remove(filename)
+
+
+def EncodeName(obj):
+  """Returns the filename for an object name.
+
+  Args:
+    obj: the object name.
+
+  Returns:
+    The name with everything but letters, digits and '_.-' %-escaped. A
+    leading '.' is escaped too, so objects never clash with '.', '..' or
+    temporary files.
+  """
+  name = urllib.quote(obj, safe='')
+  if name.startswith('.'):
+    name = '%2E' + name[1:]
+  return name
+
+
+def DecodeName(filename):
+  """Returns the object name a filename from EncodeName stands for."""
+  return urllib.unquote(filename)
+
+
+def TempFilename(filename):
+  """Returns an unused hidden filename next to filename."""
+  dirname = os.path.dirname(filename)
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  return os.path.join(dirname, TMP_PREFIX + uuid.uuid4().hex)
+
+
+class MappedFile(object):
+  """A read-only file-like object over a memory-mapped file."""
+
+  def __init__(self, filename):
+    with open(filename, 'rb') as f:
+      if os.fstat(f.fileno()).st_size:
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self._map = ''
+    self._offset = 0
+    self.closed = False
+
+  def read(self, size=-1):
+    end = len(self._map) if size < 0 else self._offset + size
+    data = self._map[self._offset:end]
+    self._offset += len(data)
+    return data
+
+  def readline(self, size=-1):
+    end = self._map.find('\n', self._offset) + 1 or len(self._map)
+    if size >= 0:
+      end = min(end, self._offset + size)
+    return self.read(end - self._offset)
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._offset
+    elif whence == os.SEEK_END:
+      offset += len(self._map)
+    self._offset = max(0, offset)
+
+  def tell(self):
+    return self._offset
+
+  def close(self):
+    if not self.closed and self._map:
+      self._map.close()
+    self.closed = True
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration()
+    return line
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+
+class AtomicFile(object):
+  """A writable file that replaces its target only when closed."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.tmp_filename = TempFilename(filename)
+    self.file = open(self.tmp_filename, 'wb')
+    self.closed = False
+
+  def write(self, data):
+    self.file.write(data)
+
+  def tell(self):
+    return self.file.tell()
+
+  def close(self):
+    if not self.closed:
+      self.file.close()
+      os.rename(self.tmp_filename, self.filename)
+      self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_value, unused_traceback):
+    if exc_type:
+      self.file.close()
+      os.remove(self.tmp_filename)
+      self.closed = True
+    else:
+      self.close()
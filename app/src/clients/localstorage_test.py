@@ -0,0 +1,114 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Local storage backend unit tests."""
+
+import shutil
+import StringIO
+import tempfile
+
+import cloudstorage
+from src import basetest
+from src.clients import gcs
+from src.clients import localstorage
+
+
+class LocalBackendTest(basetest.TestCase):
+
+  def setUp(self):
+    super(LocalBackendTest, self).setUp()
+    self.root = tempfile.mkdtemp()
+    self.storage = gcs.Gcs(localstorage.LocalBackend(self.root))
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+    super(LocalBackendTest, self).tearDown()
+
+  def _Write(self, url, data):
+    with self.storage.OpenObject(url, mode='w') as f:
+      f.write(data)
+
+  def _Read(self, url):
+    with self.storage.OpenObject(url) as f:
+      return f.read()
+
+  def testReadWriteStat(self):
+    self._Write('gs://bucket/dir/a.csv', 'a,b\nc,d\n')
+    with self.storage.OpenObject('gs://bucket/dir/a.csv') as f:
+      self.assertEquals(['a,b\n', 'c,d\n'], list(f))
+      f.seek(2)
+      self.assertEquals('b\n', f.readline())
+      self.assertEquals(4, f.tell())
+    stat = self.storage.StatObject('gs://bucket/dir/a.csv')
+    self.assertEquals(8, stat['size'])
+    self.assertEquals('text/csv', stat['contentType'])
+    self.assertRaises(cloudstorage.NotFoundError,
+                      self.storage.StatObject, 'gs://bucket/missing')
+
+    with self.storage.OpenObject('gs://bucket/dir/a.csv', prefetch=2) as f:
+      self.assertEquals('a,b\nc,d\n', f.read())
+
+  def testList(self):
+    for name in ['a', 'b/1', 'b/2', 'c', 'd/e/1']:
+      self._Write('gs://bucket/' + name, name)
+    self.assertEquals(
+        ['gs://bucket/a', 'gs://bucket/b/1', 'gs://bucket/b/2',
+         'gs://bucket/c', 'gs://bucket/d/e/1'],
+        list(self.storage.ListBucket('bucket', fan_out=True)))
+    self.assertEquals(['gs://bucket/b/1', 'gs://bucket/b/2'],
+                      list(self.storage.ListBucket('bucket', prefix='b/')))
+
+  def testListBucketSizes(self):
+    for name in ['a', 'b/1', 'b/22']:
+      self._Write('gs://bucket/' + name, name)
+    self.assertEquals(
+        [('gs://bucket/b/1', 3), ('gs://bucket/b/22', 4)],
+        list(self.storage.ListBucketSizes('bucket', glob='/bucket/b/*')))
+
+  def testObjectAndPrefixCoexist(self):
+    self._Write('gs://bucket/out/0', 'a')
+    self._Write('gs://bucket/out/1', 'b')
+    self.storage.ComposeObjects('bucket', ['out/0', 'out/1'], 'out',
+                                'text/plain')
+    self.assertEquals('ab', self._Read('gs://bucket/out'))
+    self._Write('gs://bucket/.hidden', 'c')
+    self.assertEquals(
+        ['gs://bucket/.hidden', 'gs://bucket/out', 'gs://bucket/out/0',
+         'gs://bucket/out/1'],
+        list(self.storage.ListBucket('bucket', use_cache=False)))
+
+  def testCopyComposeDelete(self):
+    self._Write('gs://bucket/a', 'aaa')
+    self._Write('gs://bucket/b', 'bb')
+    self.storage.CopyObject('gs://bucket/a', 'gs://other/a')
+    self._Write('gs://bucket/a', 'changed')
+    self.assertEquals('aaa', self._Read('gs://other/a'))
+
+    self.storage.ComposeObjects('bucket', ['a', 'b', 'a'], 'ab', 'text/plain')
+    self.assertEquals('changedbbchanged', self._Read('gs://bucket/ab'))
+
+    self.storage.InsertObject(StringIO.StringIO('inserted'), 'gs://bucket/c')
+    self.assertEquals('inserted', self._Read('gs://bucket/c'))
+
+    results = self.storage.DeleteObjects(['gs://bucket/a', 'gs://bucket/b',
+                                          'gs://bucket/missing'])
+    self.assertEquals({'gs://bucket/a': None, 'gs://bucket/b': None,
+                       'gs://bucket/missing': None}, results)
+    self.assertEquals(['gs://bucket/ab', 'gs://bucket/c'],
+                      list(self.storage.ListBucket('bucket')))
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -19,6 +19,7 @@ The S3 client library only supports basic read-only operations and uses boto.
 
 
 import cStringIO as StringIO
+import threading
 import urlparse
 
 import boto
@@ -45,7 +46,7 @@ class S3(object):
       key = config.get('accessKey')
       secret = config.get('accessSecret')
 
-    self.service = boto.connect_s3(key, secret)
+    self.service = _POOL.Get(key, secret)
 
   @staticmethod
   def UrlToBucketAndName(url):
@@ -85,11 +86,27 @@ class S3(object):
       bucket: required, specifies the S3 bucket.
       prefix: optional, specifies object [path] prefix to filter against.
 
-    Returns:
-      A list of object names.
+    Yields:
+      The object names, as boto pages through the listing.
+    """
+    for o in self.ListObjects(bucket, prefix):
+      yield o['name']
+
+  def ListObjects(self, bucket, prefix=None, marker=None):
+    """List the objects in a bucket, with their sizes and versions.
+
+    Args:
+      bucket: required, specifies the S3 bucket.
+      prefix: optional, specifies object [path] prefix to filter against.
+      marker: optional, only list objects whose names sort after this.
+
+    Yields:
+      A dict with name, size, etag and lastModified for each object.
     """
-    # TODO(user): paginate/iterate?
-    return [o['name'] for o in self.service.get_bucket(bucket).list(prefix)]
+    for key in self.service.get_bucket(bucket).list(prefix=prefix or '',
+                                                    marker=marker or ''):
+      yield {'name': key.name, 'size': key.size, 'etag': key.etag,
+             'lastModified': key.last_modified}
 
   def StatObject(self, url=None, bucket=None, obj=None):
     """Reads some information about an object in Gcs.
@@ -109,6 +126,34 @@ class S3(object):
         'size': boto_key.size
     }
 
+  def OpenObject(self, url=None, bucket=None, obj=None, start=None,
+                 length=None):
+    """Opens an object, or a range of it, for streaming reads.
+
+    Nothing is buffered beyond what each read asks for.
+
+    Args:
+      url: Full URL of the object. Use either this or bucket and object
+      bucket: Bucket name. Use either this and object or url.
+      obj: Object name. Use either this and bucket or url.
+      start: Optional starting byte offset
+      length: Optional byte length
+
+    Returns:
+      A file-like boto Key with the content_type of the object (should be
+      closed after use).
+    """
+    if url:
+      (bucket, obj) = S3.UrlToBucketAndName(url)
+    boto_key = self.service.get_bucket(bucket, validate=False).new_key(obj)
+    headers = None
+    if start or length:
+      start = start or 0
+      end = start + length - 1 if length else ''
+      headers = {'Range': 'bytes=%s-%s' % (start, end)}
+    boto_key.open_read(headers=headers)
+    return boto_key
+
   def ReadObject(self, url=None, bucket=None, obj=None, handler=None,
                  start=None, length=None):
     """Reads the contents of an object from S3.
@@ -185,3 +230,33 @@ class _WrappedHandler(object):
       self.buffer.seek(0)
       self.handler(self.buffer, delta, self.bytes_remaining, self.content_type)
       self.buffer.truncate(0)
+
+
+class ConnectionPool(object):
+  """A process-wide pool of S3 connections, one per set of credentials.
+
+  A boto connection keeps its own thread-safe pool of keep-alive HTTP
+  connections, so sharing it lets every thread (and every S3 client) of the
+  process reuse them instead of connecting again.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._connections = {}
+
+  def Get(self, key, secret):
+    """Returns the shared connection for the credentials."""
+    with self._lock:
+      connection = self._connections.get((key, secret))
+      if not connection:
+        connection = boto.connect_s3(key, secret)
+        self._connections[(key, secret)] = connection
+      return connection
+
+  def Clear(self):
+    """Drops every pooled connection."""
+    with self._lock:
+      self._connections.clear()
+
+
+_POOL = ConnectionPool()
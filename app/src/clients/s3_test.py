@@ -25,21 +25,75 @@ from src.clients import s3
 
 class S3Test(basetest.TestCase):
 
+  def setUp(self):
+    super(S3Test, self).setUp()
+    s3._POOL.Clear()
+
+  def _MockKeys(self, names):
+    keys = []
+    for (i, name) in enumerate(names):
+      key = mock.Mock(size=i, etag='"%d"' % i, last_modified='2026-10-0%dZ' % i)
+      key.name = name
+      keys.append(key)
+    return keys
+
   def testList(self):
     objs = ['foo', 'foozle', 'dir/a/b', 'dir/a/b/c', 'dir/a/x']
 
     mock_service = mock.MagicMock()
-    mock_list_resp = [{'name': o} for o in objs]
-    config = {'get_bucket.return_value.list.return_value': mock_list_resp}
-    mock_service.configure_mock(**config)
+    mock_service.get_bucket.return_value.list.return_value = iter(
+        self._MockKeys(objs))
 
     with mock.patch.object(boto, 'connect_s3') as mock_connect_s3:
       storage = s3.S3()
       storage.service = mock_service
       mock_connect_s3.assert_called_once_with(None, None)
       res = storage.ListBucket('bucket')
-      for o in objs:
-        self.assertIn(o, res)
+      self.assertFalse(isinstance(res, list))
+      self.assertEquals(objs, list(res))
+
+  def testListObjects(self):
+    mock_service = mock.MagicMock()
+    mock_service.get_bucket.return_value.list.return_value = self._MockKeys(
+        ['obj%d' % i for i in range(3)])
+
+    with mock.patch.object(boto, 'connect_s3'):
+      storage = s3.S3()
+      storage.service = mock_service
+      res = list(storage.ListObjects('bucket', 'obj', marker='obj'))
+      mock_service.get_bucket.return_value.list.assert_called_once_with(
+          prefix='obj', marker='obj')
+      self.assertEquals(
+          [{'name': 'obj%d' % i, 'size': i, 'etag': '"%d"' % i,
+            'lastModified': '2026-10-0%dZ' % i} for i in range(3)], res)
+
+  def testConnectionPool(self):
+    with mock.patch.object(boto, 'connect_s3',
+                           side_effect=lambda *unused: mock.MagicMock()):
+      first = s3.S3(key='key', secret='secret')
+      second = s3.S3(config={'accessKey': 'key', 'accessSecret': 'secret'})
+      other = s3.S3(key='key2', secret='secret2')
+      self.assertIs(first.service, second.service)
+      self.assertIsNot(first.service, other.service)
+      self.assertEquals(2, boto.connect_s3.call_count)
+
+  def testOpenObject(self):
+    mock_service = mock.MagicMock()
+    mock_key = mock_service.get_bucket.return_value.new_key.return_value
+
+    with mock.patch.object(boto, 'connect_s3'):
+      storage = s3.S3()
+      storage.service = mock_service
+      self.assertIs(mock_key, storage.OpenObject(url='s3://bucket/foo.txt'))
+      mock_service.get_bucket.assert_called_with('bucket', validate=False)
+      mock_service.get_bucket.return_value.new_key.assert_called_with(
+          'foo.txt')
+      mock_key.open_read.assert_called_with(headers=None)
+
+      storage.OpenObject(url='s3://bucket/foo.txt', start=0, length=10)
+      mock_key.open_read.assert_called_with(headers={'Range': 'bytes=0-9'})
+      storage.OpenObject(url='s3://bucket/foo.txt', start=10)
+      mock_key.open_read.assert_called_with(headers={'Range': 'bytes=10-'})
 
   def testReadSimpleSmall(self):
     s3_url = 's3://bucket/foo.txt'
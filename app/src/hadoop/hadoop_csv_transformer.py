@@ -74,7 +74,8 @@ class HadoopCsvTransformer(object):
     output_file = self.cloud_storage_client.OpenObject(
         self.config['sinks'][0], mode='w')
     # Copy input file to Cloud Storage MapReduce input directory.
-    input_file = self.cloud_storage_client.OpenObject(self.config['sources'][0])
+    input_file = self.cloud_storage_client.OpenObject(
+        self.config['sources'][0], prefetch=gcs.Gcs.PREFETCH_RANGES)
     hadoop_input = self.cloud_storage_client.OpenObject(
         hadoop_input_filename, mode='w')
 
@@ -98,9 +99,11 @@ class HadoopCsvTransformer(object):
     tab_strip_pattern = re.compile('\t\r?\n')
 
     for hadoop_result in self.cloud_storage_client.ListBucket(
-        '/%s' % bucket, prefix='%s/outputs/part-' % hadoop_dir):
+        '/%s' % bucket, prefix='%s/outputs/part-' % hadoop_dir,
+        use_cache=False):
       logging.debug('Hadoop result file: %s', hadoop_result)
-      hadoop_output = self.cloud_storage_client.OpenObject(hadoop_result)
+      hadoop_output = self.cloud_storage_client.OpenObject(
+          hadoop_result, prefetch=gcs.Gcs.PREFETCH_RANGES)
       for line in hadoop_output:
         # Since Hadoop MapReduce output is key-value pair separated by a tab,
         # and Hadoop transformer always outputs a line as a key,
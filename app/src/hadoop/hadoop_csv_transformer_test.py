@@ -19,6 +19,7 @@ import json
 import mock
 
 from src import basetest
+from src.clients import gcs
 from src.hadoop import datastore
 from src.hadoop import hadoop_csv_transformer
 
@@ -73,7 +74,8 @@ class HadoopCsvTransformerTest(basetest.TestCase):
     transformer.StartTransform()
 
     self.assertEqual(1, self.mock_gcs_new.call_count)
-    self.mock_gcs.OpenObject.assert_any_call('gs://bucket/input')
+    self.mock_gcs.OpenObject.assert_any_call(
+        'gs://bucket/input', prefetch=gcs.Gcs.PREFETCH_RANGES)
     self.mock_gcs.OpenObject.assert_any_call('gs://bucket/output', mode='w')
     self.mock_gcs.OpenObject.assert_any_call(
         'gs://bucket/hadoop-tmp/inputs/input.csv', mode='w')
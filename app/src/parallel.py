@@ -0,0 +1,150 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Helpers for running blocking calls (API requests, mostly) concurrently."""
+
+import collections
+import Queue
+import sys
+import threading
+
+DEFAULT_WORKERS = 8
+
+# Called on each worker thread when its call is done, see AtThreadExit.
+_thread_exit_hooks = []
+
+
+def AtThreadExit(func):
+  """Registers a function to run on every worker thread before it exits.
+
+  Clients pinned to threads (see auth.ClientPool) use this to hand their
+  resources on to the next worker rather than abandoning them.
+
+  Args:
+    func: a function of no arguments.
+  """
+  _thread_exit_hooks.append(func)
+
+
+class _Call(threading.Thread):
+  """Runs one call on its own thread and keeps its result or exception."""
+
+  def __init__(self, func, item):
+    super(_Call, self).__init__()
+    self.daemon = True
+    self._func = func
+    self._item = item
+    self._result = None
+    self._exc_info = None
+
+  def run(self):
+    try:
+      self._result = self._func(self._item)
+    except Exception:  # pylint: disable=broad-except
+      self._exc_info = sys.exc_info()
+    finally:
+      for hook in _thread_exit_hooks:
+        hook()
+
+  def Result(self):
+    """Waits for the call and returns its result or re-raises its error."""
+    self.join()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+def IMap(func, items, max_workers=DEFAULT_WORKERS):
+  """Lazily applies func to items on up to max_workers threads.
+
+  Args:
+    func: A function of one argument.
+    items: An iterable of arguments for func.
+    max_workers: The most calls that may run at once.
+
+  Yields:
+    The results of func, in the order of items.
+
+  Raises:
+    Whatever func raised, once its result is reached.
+  """
+  pending = collections.deque()
+  for item in items:
+    call = _Call(func, item)
+    call.start()
+    pending.append(call)
+    if len(pending) >= max_workers:
+      yield pending.popleft().Result()
+  while pending:
+    yield pending.popleft().Result()
+
+
+def Map(func, items, max_workers=DEFAULT_WORKERS):
+  """Like IMap but returns the results as a list."""
+  return list(IMap(func, items, max_workers))
+
+
+class ReadAhead(object):
+  """A file-like wrapper that reads a stream ahead on a background thread.
+
+  Up to depth chunks are buffered, so a consumer that writes what it reads
+  somewhere else (e.g. uploads it) overlaps its writes with the reads while
+  memory use stays fixed. The thread starts on the first read. Close the
+  wrapper to stop it if the stream is not read to the end.
+  """
+
+  def __init__(self, stream, chunk_size, depth=4):
+    self._stream = stream
+    self._chunk_size = chunk_size
+    self._queue = Queue.Queue(depth)
+    self._thread = None
+    self._buffer = ''
+    self._eof = False
+    self.closed = False
+
+  def _Fill(self):
+    try:
+      while not self.closed:
+        buf = self._stream.read(self._chunk_size)
+        while not self.closed:
+          try:
+            self._queue.put((buf, None), timeout=1)
+            break
+          except Queue.Full:
+            pass
+        if not buf:
+          return
+    except Exception:  # pylint: disable=broad-except
+      self._queue.put((None, sys.exc_info()))
+
+  def read(self, size=-1):
+    if not self._thread:
+      self._thread = threading.Thread(target=self._Fill)
+      self._thread.daemon = True
+      self._thread.start()
+    while not self._eof and (size < 0 or len(self._buffer) < size):
+      (buf, exc_info) = self._queue.get()
+      if exc_info:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      self._eof = not buf
+      self._buffer += buf
+    if size < 0:
+      size = len(self._buffer)
+    data = self._buffer[:size]
+    self._buffer = self._buffer[size:]
+    return data
+
+  def close(self):
+    self.closed = True
@@ -0,0 +1,65 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Concurrency helper unit tests."""
+
+import contextlib
+import StringIO
+import threading
+
+from src import basetest
+from src import parallel
+
+
+class ParallelTest(basetest.TestCase):
+
+  def testMapKeepsOrder(self):
+    self.assertEquals([x * x for x in range(20)],
+                      parallel.Map(lambda x: x * x, range(20), max_workers=3))
+
+  def testMapBoundsWorkers(self):
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def Work(_):
+      with lock:
+        running[0] += 1
+        running[1] = max(running)
+      threading.Event().wait(0.01)
+      with lock:
+        running[0] -= 1
+
+    parallel.Map(Work, range(10), max_workers=2)
+    self.assertLessEqual(running[1], 2)
+
+  def testMapRaises(self):
+    def Work(x):
+      if x == 3:
+        raise ValueError(x)
+      return x
+    self.assertRaises(ValueError, parallel.Map, Work, range(5))
+
+
+  def testReadAhead(self):
+    stream = StringIO.StringIO('0123456789')
+    with contextlib.closing(parallel.ReadAhead(stream, 3, depth=2)) as f:
+      self.assertEquals('01', f.read(2))
+      self.assertEquals('2345', f.read(4))
+      self.assertEquals('6789', f.read())
+      self.assertEquals('', f.read(1))
+
+
+if __name__ == '__main__':
+  basetest.main()
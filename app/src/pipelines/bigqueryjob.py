@@ -0,0 +1,63 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Wait for BigQuery jobs without holding a request while they run."""
+
+import logging
+
+from src.clients import bigquery
+from src.pipelines import pipeline
+
+
+class WaitForJob(pipeline.Pipeline):
+  """Completes when a BigQuery job is done, aborting if it fails.
+
+  The job is polled from task queue callbacks with exponential backoff (see
+  bigquery.BackoffSeconds), so no backend thread waits on it and many jobs
+  can run at once. The output is the statistics of the job.
+  """
+  async = True
+
+  def run(self, project_id, job_id):
+    """Schedules the first poll.
+
+    Args:
+      project_id: the project that runs the job.
+      job_id: the id of the job.
+    """
+    self.SchedulePoll(0, bigquery.BackoffSeconds(0))
+
+  def run_test(self, project_id, job_id):
+    job = bigquery.BigQuery(project_id).WaitForJob(job_id)
+    self.complete(job.get('statistics'))
+
+  def callback(self, poll):
+    """Checks on the job and polls again later if it is still running.
+
+    Args:
+      poll: the sequence number of this check.
+    """
+    (project_id, job_id) = self.args
+    try:
+      job = bigquery.BigQuery(project_id).CheckJob(job_id)
+    except bigquery.BigQueryError as err:
+      self.abort(str(err))
+      return
+    if job:
+      logging.info('job %s is done: %r', job_id, job.get('statistics'))
+      self.complete(job.get('statistics'))
+      return
+    poll = int(poll) + 1
+    self.SchedulePoll(poll, bigquery.BackoffSeconds(poll))
@@ -0,0 +1,64 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""BigQuery job pipeline unit tests."""
+
+
+import mock
+
+from src import basetest
+from src.clients import bigquery
+from src.pipelines import bigqueryjob
+
+
+class WaitForJobTest(basetest.TestCase):
+
+  def setUp(self):
+    super(WaitForJobTest, self).setUp()
+    self.bq = mock.MagicMock()
+    mock.patch.object(bigquery, 'BigQuery', return_value=self.bq).start()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(WaitForJobTest, self).tearDown()
+
+  def testRunTest(self):
+    self.bq.WaitForJob.return_value = {'statistics': {'load': {}}}
+    stage = bigqueryjob.WaitForJob('project', 'job')
+    stage.start_test()
+    self.bq.WaitForJob.assert_called_once_with('job')
+    self.assertEquals({'load': {}}, stage.outputs.default.value)
+
+  def testCallback(self):
+    stage = bigqueryjob.WaitForJob('project', 'job')
+    with mock.patch.object(stage, 'SchedulePoll') as schedule, \
+        mock.patch.object(stage, 'complete') as complete, \
+        mock.patch.object(stage, 'abort') as abort:
+      self.bq.CheckJob.return_value = None
+      stage.callback(poll='3')
+      schedule.assert_called_once_with(4, bigquery.BackoffSeconds(4))
+
+      self.bq.CheckJob.return_value = {'statistics': {'load': {}}}
+      stage.callback(poll='4')
+      complete.assert_called_once_with({'load': {}})
+
+      self.bq.CheckJob.side_effect = bigquery.BigQueryError('failed')
+      stage.callback(poll='5')
+      abort.assert_called_once_with('failed')
+    self.assertEquals(1, schedule.call_count)
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -355,6 +355,17 @@ class LintPipelineTest(basetest.TestCase):
     self.assertTrue(pl.results.valid)
     self.assertSameStructure(expect, pl.results.results)
 
+  def testBigQueryInput(self):
+    pl = linter.PipelineLinter(
+        '{"inputs": [{"type": "BigQueryInput", "projectId": "123",'
+        ' "query": "SELECT 1", "destinationFormat": "CSV",'
+        ' "sinks": ["gs://b1/o1-*"]}]}')
+    self.assertTrue(pl.results.valid)
+    pl = linter.PipelineLinter(
+        '{"inputs": [{"type": "BigQueryInput", "compression": "ZIP",'
+        ' "sinks": ["gs://b1/o1-*"]}]}')
+    self.assertFalse(pl.results.valid)
+
   def testBigQueryOutputOk(self):
     pl = linter.PipelineLinter(
         '{"outputs": [{"type": "BigQueryOutput",'
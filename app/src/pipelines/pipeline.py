@@ -18,6 +18,7 @@ import datetime
 import logging
 
 from mapreduce.lib.pipeline import pipeline
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
 _STATUS_WRITE_FREQUENCY = datetime.timedelta(minutes=1)
@@ -96,6 +97,27 @@ class Pipeline(pipeline.Pipeline):
           'Could not set status for %s#%s: %s' %
           (self, self.pipeline_id, str(e)))
 
+  def SchedulePoll(self, poll, countdown):
+    """Schedules a callback of an async pipeline with a poll parameter.
+
+    The task is named after the pipeline and the poll sequence number so a
+    retried callback does not schedule its next poll twice.
+
+    Args:
+      poll: the sequence number of the poll.
+      countdown: seconds to wait before the callback.
+    """
+    task = self.get_callback_task(
+        name='%s-poll-%d' % (self.pipeline_id, poll),
+        countdown=countdown,
+        params={'poll': poll})
+    try:
+      task.add(queue_name=self.queue_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.info('poll %d of %s was already scheduled', poll,
+                   self.pipeline_id)
+
 
 After = pipeline.After
 InOrder = pipeline.InOrder
+PipelineExistsError = pipeline.PipelineExistsError
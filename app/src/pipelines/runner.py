@@ -71,6 +71,10 @@ class PipelineRunner(object):
         and not explicitly declared as None, the source will be generated by the
         preceding stage. No action will be taken if an output stage is missing a
         sink.
+      - Rather than generating a temporary link, a GcsInput of a single object
+        is linked to that object itself (unless the next stage deletes its
+        sources) and a GcsOutput (fed by anything but a GcsInput) to its
+        destination object, so neither has to copy data.
 
     Args:
       defn: The pipeline definition as a list of stages.
@@ -165,7 +169,7 @@ class PipelineRunner(object):
           if sink not in output_stage['sources']:
             output_stage['sources'].append(sink)
       else:
-        link = sink_generator()
+        link = self._PassThroughLink(stage, output_stage) or sink_generator()
         stage['sinks'] = [link]
         output_stage['sources'].append(link)
 
@@ -194,6 +198,30 @@ class PipelineRunner(object):
           if source not in input_stage['sinks']:
             input_stage['sinks'].append(source)
       else:
-        link = sink_generator()
+        link = (self._PassThroughLink(input_stage, stage) or
+                sink_generator())
         stage['sources'] = [link]
         input_stage['sinks'].append(link)
+
+  @staticmethod
+  def _PassThroughLink(input_stage, output_stage):
+    """Finds a link between two stages that avoids copying data.
+
+    Args:
+      input_stage: A stage that needs a sink.
+      output_stage: The next stage, which needs it as a source.
+
+    Returns:
+      The object a GcsInput of a single object reads, or else the object a
+      GcsOutput writes, or None if neither stage is a pass-through.
+      Objects from the user are never linked to a stage that deletes them.
+    """
+    deletes_sources = (output_stage.get('type') == 'GcsDeleter' or
+                       output_stage.get('deleteSources'))
+    if (input_stage.get('type') == 'GcsInput' and not deletes_sources and
+        'objects' not in input_stage and input_stage.get('object')):
+      return input_stage['object']
+    if (output_stage.get('type') == 'GcsOutput' and
+        input_stage.get('type') != 'GcsInput' and output_stage.get('object')):
+      return output_stage['object']
+    return None
@@ -121,6 +121,32 @@ class PipelineRunnerTest(basetest.TestCase):
     config['inputs'][1]['sinks'] = ['gs://results_bucket/results.csv']
     self.assertEquals(scrubbed, config)
 
+  def testScrubPassThrough(self):
+    r = runner.PipelineRunner()
+    sink_generator = gcs.Gcs.UrlCreator('bucket', 'tmp/')
+    transform = {'type': 'CsvMatchReplace', 'fieldDelimiter': ',',
+                 'columns': []}
+    scrubbed = r.Scrub({
+        'inputs': [{'type': 'GcsInput', 'object': 'gs://bucket/in.csv'}],
+        'transforms': [transform],
+        'outputs': [{'type': 'GcsOutput', 'object': 'gs://bucket/out.csv'}]
+    }, sink_generator)
+    self.assertEquals(['gs://bucket/in.csv'], scrubbed['inputs'][0]['sinks'])
+    self.assertEquals(['gs://bucket/in.csv'],
+                      scrubbed['transforms'][0]['sources'])
+    self.assertEquals(['gs://bucket/out.csv'],
+                      scrubbed['transforms'][0]['sinks'])
+    self.assertEquals(['gs://bucket/out.csv'],
+                      scrubbed['outputs'][0]['sources'])
+
+    # A user's object must not be handed to a stage that deletes it.
+    scrubbed = r.Scrub({
+        'inputs': [{'type': 'GcsInput', 'object': 'gs://bucket/in.csv'}],
+        'outputs': [{'type': 'GcsDeleter'}]
+    }, sink_generator)
+    self.assertTrue(
+        scrubbed['outputs'][0]['sources'][0].startswith('gs://bucket/tmp/'))
+
   def testScrubFullFiles(self):
     directories = ['src/pipelines/testdata', 'static/examples']
 
@@ -14,12 +14,18 @@
 
 """Split a pipeline stage into smaller stages and combine results."""
 
+import collections
 import copy
+import datetime
+import importlib
 import logging
 import math
 import pprint
+import uuid
 
+from google.appengine.ext import ndb
 
+from src import parallel
 from src.clients import gcs
 from src.pipelines import pipeline
 from src.pipelines.stages import gcscompositor
@@ -45,6 +51,9 @@ class ShardStage(pipeline.Pipeline):
           _ = [(yield compositor) for compositor in compositors]
       else:
         # Here is where you would do the work you normally would do.
+
+  If the config also sets speculativeShards the shards are returned wrapped
+  in a single SpeculativeShards stage which re-executes stragglers.
   """
 
   DEFAULT_CONTENT_TYPE = 'binary/octet-stream'
@@ -59,6 +68,9 @@ class ShardStage(pipeline.Pipeline):
     Returns:
       Tuple of Shard Stages and Compositor stages.
     """
+    if config.get('shardAttempt', {}).get('id'):
+      MarkShardAttempt(config['shardAttempt'], started=True)
+
     length = config.get('length', 0)
     shard_size = config.get('shardSize', -1)
 
@@ -68,7 +80,7 @@ class ShardStage(pipeline.Pipeline):
     start = config.get('start', 0)
     position = start
     final_position = start + length
-    shards = []
+    shard_configs = []
     shard_sinks = []
 
     # Now we adjust shard size to split the work evenly.
@@ -78,6 +90,8 @@ class ShardStage(pipeline.Pipeline):
     config['shardSize'] = shard_size
     shard_prefix = config.get('shardPrefix', '')
     sinks = config.get('sinks')
+    speculative = config.pop('speculativeShards', False)
+    group = speculative and uuid.uuid4().hex
 
     while position < final_position:
       shard_config = copy.deepcopy(config)
@@ -87,14 +101,24 @@ class ShardStage(pipeline.Pipeline):
             bucket, '%s/%s' % (obj, shard_prefix))()
       shard_config['start'] = position
       shard_config['length'] = min(shard_size, final_position - position)
+      if speculative:
+        shard_config['shardAttempt'] = {'group': group,
+                                        'index': len(shard_configs)}
       logging.info('making shard of job position: %r, length: %r, start: %r, '
                    'final_position: %r, source_length: %r',
                    position, shard_config['length'],
                    start, final_position, length)
       shard_sinks.append(shard_config['sinks'])
-      shards.append(self.__class__(shard_config))
+      shard_configs.append(shard_config)
       position += shard_size
 
+    if speculative:
+      stage_class_path = '%s.%s' % (self.__class__.__module__,
+                                    self.__class__.__name__)
+      shards = [SpeculativeShards(stage_class_path, shard_configs)]
+    else:
+      shards = [self.__class__(c) for c in shard_configs]
+
     compositors = []
     for i in range(len(shard_sinks[0])):
       compositor_config = {
@@ -107,5 +131,287 @@ class ShardStage(pipeline.Pipeline):
       logging.info('compositor:\n%s', pprint.pformat(compositor_config))
 
     logging.info('sharding with %d shards and %d compositors',
-                 len(shards), len(compositors))
+                 len(shard_sinks), len(compositors))
     return (shards, compositors)
+
+  def finalized(self):
+    """Records when a shard started by SpeculativeShards has finished.
+
+    A speculative attempt that is no longer tracked has lost to the first
+    attempt of its shard, or was aborted, so its output is deleted.
+    """
+    config = self.args and self.args[0]
+    if not isinstance(config, dict) or not config.get('shardAttempt', {}).get(
+        'id'):
+      return
+    tracked = not self.was_aborted and MarkShardAttempt(
+        config['shardAttempt'], finished=True)
+    if not tracked and config['shardAttempt'].get('speculative'):
+      logging.info('deleting the output of shard attempt %s',
+                   config['shardAttempt']['id'])
+      gcs.Gcs().DeleteObjects(config['sinks'])
+
+
+class ShardAttempt(ndb.Model):
+  """Datastore model to track one run of a shard started by SpeculativeShards.
+
+  The attempts of a group of shards share a parent key so they can be read
+  with a strongly consistent ancestor query. The entity id is also used as
+  the pipeline id of the attempt.
+  """
+  group = ndb.StringProperty()
+  index = ndb.IntegerProperty()
+  speculative = ndb.BooleanProperty(default=False)
+  started = ndb.DateTimeProperty()
+  finished = ndb.DateTimeProperty()
+
+  @staticmethod
+  def GroupKey(group):
+    return ndb.Key('ShardAttemptGroup', group)
+
+  @classmethod
+  def AttemptKey(cls, attempt):
+    """Returns the key of the entity for a shardAttempt config section."""
+    return ndb.Key(cls, attempt['id'], parent=cls.GroupKey(attempt['group']))
+
+
+@ndb.transactional
+def MarkShardAttempt(attempt, started=False, finished=False):
+  """Sets the start and/or finish time of a shard attempt to now.
+
+  Attempts that are no longer tracked (e.g. a cancelled duplicate that kept
+  running after its group completed) are ignored.
+
+  Args:
+    attempt: the shardAttempt section of the shard config.
+    started: record the start time.
+    finished: record the finish time.
+
+  Returns:
+    True if the attempt is still tracked.
+  """
+  entity = ShardAttempt.AttemptKey(attempt).get()
+  if not entity:
+    logging.info('shard attempt %s is no longer tracked', attempt['id'])
+    return False
+  now = datetime.datetime.utcnow()
+  if started:
+    entity.started = now
+  if finished:
+    entity.finished = now
+  entity.put()
+  return True
+
+
+@ndb.transactional
+def _RetireShardAttempt(key):
+  """Stops tracking a shard attempt and returns whether it had finished."""
+  entity = key.get()
+  if not entity:
+    return False
+  key.delete()
+  return bool(entity.finished)
+
+
+def AttemptSinks(sinks, speculative):
+  """Returns the sinks that one attempt of a shard writes to."""
+  if not speculative:
+    return sinks
+  return ['%s-speculative' % sink for sink in sinks]
+
+
+def FindStragglers(attempts, shard_count, now, quorum, slowdown, min_seconds):
+  """Finds the shards that deserve a speculative duplicate.
+
+  Args:
+    attempts: all the ShardAttempts of a group of shards.
+    shard_count: the number of shards in the group.
+    now: the current time.
+    quorum: fraction of shards that must be finished before speculating.
+    slowdown: how many times the median duration a shard must be running.
+    min_seconds: shards running for less than this are never stragglers.
+
+  Returns:
+    A sorted list of shard indexes.
+  """
+  by_index = collections.defaultdict(list)
+  for attempt in attempts:
+    by_index[attempt.index].append(attempt)
+
+  durations = sorted(
+      (a.finished - a.started).total_seconds() for a in attempts
+      if a.started and a.finished)
+  done = set(a.index for a in attempts if a.finished)
+  if not durations or len(done) < quorum * shard_count:
+    return []
+
+  threshold = max(min_seconds, slowdown * durations[len(durations) / 2])
+  stragglers = []
+  for index, shard_attempts in by_index.iteritems():
+    if index in done or len(shard_attempts) > 1:
+      continue
+    started = shard_attempts[0].started
+    if started and (now - started).total_seconds() > threshold:
+      stragglers.append(index)
+  return sorted(stragglers)
+
+
+class SpeculativeShards(pipeline.Pipeline):
+  """Runs the shards of a stage and re-executes the stragglers.
+
+  Every shard is started as its own pipeline and tracked with a ShardAttempt.
+  Once SPECULATION_QUORUM of the shards have finished, a duplicate is started
+  for each shard that has been running for more than SPECULATION_SLOWDOWN
+  times the median shard duration. The first attempt writes to the shard
+  sinks and a duplicate to its own sinks next to them. Once every shard has
+  finished, the output of each duplicate that finished first is copied into
+  the shard sinks and the other attempts are aborted. A duplicate that keeps
+  running after it lost deletes its own output when it finishes; a first
+  attempt that does so can only rewrite its shard sinks with the same data.
+  """
+  async = True
+
+  POLL_INTERVAL_SECONDS = 15
+  SPECULATION_QUORUM = 0.75
+  SPECULATION_SLOWDOWN = 2.0
+  MIN_STRAGGLER_SECONDS = 60
+
+  def run(self, stage_class_path, shard_configs):
+    """Starts all the shards.
+
+    Args:
+      stage_class_path: the full path of the sharded stage class.
+      shard_configs: the config of each shard.
+    """
+    for config in shard_configs:
+      self._StartAttempt(stage_class_path, config)
+    self.SchedulePoll(0, self.POLL_INTERVAL_SECONDS)
+
+  def run_test(self, stage_class_path, shard_configs):
+    stage_class = _ImportStageClass(stage_class_path)
+    for config in shard_configs:
+      stage_class(config).start_test()
+    self.complete()
+
+  def callback(self, poll):
+    """Checks on the shards, speculating on or cancelling attempts as needed.
+
+    Args:
+      poll: the sequence number of this check.
+    """
+    (stage_class_path, shard_configs) = self.args
+    attempts = self._GetAttempts()
+
+    done = set(a.index for a in attempts if a.finished)
+    failed = collections.defaultdict(int)
+    for attempt in attempts:
+      if attempt.finished:
+        continue
+      if attempt.index in done:
+        self._AbortAttempt(attempt, 'Lost to a faster attempt.')
+      elif self._HasFailed(attempt):
+        failed[attempt.index] += 1
+    for index, count in failed.iteritems():
+      if count == len([a for a in attempts if a.index == index]):
+        self.abort('Shard %d of %s failed.' % (index, stage_class_path))
+        return
+
+    if len(done) == len(shard_configs):
+      logging.info('all %d shards of %s are done', len(done), stage_class_path)
+      self._CollectWinners(attempts, shard_configs)
+      self.complete()
+      return
+
+    for index in FindStragglers(attempts, len(shard_configs),
+                                datetime.datetime.utcnow(),
+                                self.SPECULATION_QUORUM,
+                                self.SPECULATION_SLOWDOWN,
+                                self.MIN_STRAGGLER_SECONDS):
+      logging.info('shard %d of %s is a straggler, starting a duplicate',
+                   index, stage_class_path)
+      self._StartAttempt(stage_class_path, shard_configs[index],
+                         speculative=True)
+    self.SchedulePoll(int(poll) + 1, self.POLL_INTERVAL_SECONDS)
+
+  def try_cancel(self):
+    for attempt in self._GetAttempts():
+      if not attempt.finished:
+        self._AbortAttempt(attempt, 'Shard group was cancelled.')
+    return True
+
+  def finalized(self):
+    ndb.delete_multi(a.key for a in self._GetAttempts())
+    gcs.Gcs().DeleteObjects(
+        url for config in self.args[1]
+        for url in AttemptSinks(config['sinks'], True))
+
+  def _GetAttempts(self):
+    group = self.args[1][0]['shardAttempt']['group']
+    return ShardAttempt.query(
+        ancestor=ShardAttempt.GroupKey(group)).fetch()
+
+  def _CollectWinners(self, attempts, shard_configs):
+    """Copies the output of duplicates that finished first to the shards.
+
+    The other attempts are no longer tracked; those still running are
+    aborted. The sinks of the duplicates are deleted when this stage is
+    finalized.
+
+    Args:
+      attempts: all the ShardAttempts of the group.
+      shard_configs: the config of each shard.
+    """
+    winners = {}
+    for attempt in sorted((a for a in attempts if a.finished),
+                          key=lambda a: (a.finished, a.key.id())):
+      winners.setdefault(attempt.index, attempt)
+
+    storage = gcs.Gcs()
+    copies = []
+    for index, attempt in winners.iteritems():
+      if attempt.speculative:
+        sinks = shard_configs[index]['sinks']
+        copies.extend(zip(AttemptSinks(sinks, True), sinks))
+    parallel.Map(lambda pair: storage.CopyObject(*pair), copies)
+
+    for attempt in attempts:
+      if attempt is winners[attempt.index]:
+        continue
+      if not _RetireShardAttempt(attempt.key):
+        self._AbortAttempt(attempt, 'Lost to a faster attempt.')
+
+  def _StartAttempt(self, stage_class_path, config, speculative=False):
+    """Starts a shard as its own pipeline (idempotently)."""
+    config = copy.deepcopy(config)
+    attempt = config['shardAttempt']
+    attempt['id'] = '%s-%d-%d' % (attempt['group'], attempt['index'],
+                                  int(speculative))
+    attempt['speculative'] = speculative
+    config['sinks'] = AttemptSinks(config['sinks'], speculative)
+    ShardAttempt.get_or_insert(attempt['id'],
+                               parent=ShardAttempt.GroupKey(attempt['group']),
+                               group=attempt['group'],
+                               index=attempt['index'],
+                               speculative=speculative)
+    stage = _ImportStageClass(stage_class_path)(config)
+    try:
+      stage.start(idempotence_key=attempt['id'],
+                  queue_name=self.queue_name,
+                  base_path=self.base_path)
+    except pipeline.PipelineExistsError:
+      logging.info('shard attempt %s was already started', attempt['id'])
+
+  def _HasFailed(self, attempt):
+    stage = pipeline.Pipeline.from_id(attempt.key.id(), resolve_outputs=False)
+    return stage and stage.was_aborted
+
+  def _AbortAttempt(self, attempt, message):
+    stage = pipeline.Pipeline.from_id(attempt.key.id(), resolve_outputs=False)
+    if stage and not stage.has_finalized:
+      logging.info('aborting shard attempt %s: %s', attempt.key.id(), message)
+      stage.abort(message)
+
+
+def _ImportStageClass(stage_class_path):
+  (module_name, class_name) = stage_class_path.rsplit('.', 1)
+  return getattr(importlib.import_module(module_name), class_name)
@@ -15,11 +15,13 @@
 """ShardStage unit tests."""
 
 
+import datetime
 
 import mock
 
 import logging
 from src import basetest
+from src.clients import gcs
 from src.pipelines import shardstage
 
 
@@ -98,6 +100,120 @@ class ShardStageTest(basetest.TestCase):
           gcscompositor_config = self.gcscompositor_mock.call_args[0][0]
           self.assertSameStructure(expected, gcscompositor_config)
 
+  def testSpeculativeShards(self):
+    config = {'length': 100, 'shardSize': 50, 'sinks': ['gs://bucket/name'],
+              'contentType': 'text/csv', 'speculativeShards': True}
+    stage = SimpleShardStage(config)
+    (shards, compositors) = stage.ShardStage(config)
+    self.assertEquals(1, len(shards))
+    self.assertEquals(1, len(compositors))
+    (stage_class_path, shard_configs) = shards[0].args
+    self.assertEquals(__name__ + '.SimpleShardStage', stage_class_path)
+    self.assertEquals([0, 50], [c['start'] for c in shard_configs])
+    self.assertEquals([0, 1],
+                      [c['shardAttempt']['index'] for c in shard_configs])
+    self.assertEquals(
+        1, len(set(c['shardAttempt']['group'] for c in shard_configs)))
+    for c in shard_configs:
+      self.assertNotIn('speculativeShards', c)
+
+  def _Track(self, speculative, index=0, finished=None):
+    attempt = {'group': 'g', 'index': index, 'speculative': speculative,
+               'id': 'g-%d-%d' % (index, int(speculative))}
+    shardstage.ShardAttempt(key=shardstage.ShardAttempt.AttemptKey(attempt),
+                            group='g', index=index, speculative=speculative,
+                            finished=finished).put()
+    return attempt
+
+  def testDuplicatesWriteToTheirOwnSinks(self):
+    config = {'sinks': ['gs://bucket/name/1'],
+              'shardAttempt': {'group': 'g', 'index': 0}}
+    stage = shardstage.SpeculativeShards(__name__ + '.SimpleShardStage',
+                                         [config])
+    with mock.patch.object(shardstage, '_ImportStageClass') as mock_import:
+      stage._StartAttempt(__name__ + '.SimpleShardStage', config)
+      stage._StartAttempt(__name__ + '.SimpleShardStage', config,
+                          speculative=True)
+    attempt_configs = [c[0][0] for c in
+                       mock_import.return_value.call_args_list]
+    self.assertEquals(
+        [['gs://bucket/name/1'], ['gs://bucket/name/1-speculative']],
+        [c['sinks'] for c in attempt_configs])
+    self.assertEquals(['g-0-0', 'g-0-1'],
+                      [c['shardAttempt']['id'] for c in attempt_configs])
+    attempts = stage._GetAttempts()
+    self.assertEquals(['g-0-0', 'g-0-1'], [a.key.id() for a in attempts])
+    self.assertEquals(shardstage.ShardAttempt.GroupKey('g'),
+                      attempts[0].key.parent())
+
+  def testCollectWinners(self):
+    now = datetime.datetime(2014, 1, 16, 12, 0, 0)
+    later = now + datetime.timedelta(seconds=10)
+    self._Track(False, 0, finished=later)
+    self._Track(True, 0, finished=now)
+    self._Track(False, 1, finished=now)
+    self._Track(True, 1)
+    configs = [{'sinks': ['gs://bucket/name/%d' % i],
+                'shardAttempt': {'group': 'g', 'index': i}} for i in range(2)]
+    stage = shardstage.SpeculativeShards(__name__ + '.SimpleShardStage',
+                                         configs)
+
+    with mock.patch.object(gcs.Gcs, 'CopyObject') as mock_copy:
+      with mock.patch.object(shardstage.SpeculativeShards,
+                             '_AbortAttempt') as mock_abort:
+        stage._CollectWinners(stage._GetAttempts(), configs)
+
+    # Only shard 0 was won by its duplicate.
+    mock_copy.assert_called_once_with('gs://bucket/name/0-speculative',
+                                      'gs://bucket/name/0')
+    self.assertEquals(['g-1-1'],
+                      [c[0][0].key.id() for c in mock_abort.call_args_list])
+    self.assertEquals(['g-0-1', 'g-1-0'],
+                      sorted(a.key.id() for a in stage._GetAttempts()))
+
+  def testLosingAttemptDeletesItsOutput(self):
+    winner = self._Track(False)
+    loser = dict(winner, id='g-0-1', speculative=True)
+    with mock.patch.object(gcs.Gcs, 'DeleteObjects') as mock_delete:
+      SimpleShardStage({'sinks': ['gs://bucket/a'],
+                        'shardAttempt': winner}).finalized()
+      self.assertFalse(mock_delete.called)
+      SimpleShardStage({'sinks': ['gs://bucket/a-speculative'],
+                        'shardAttempt': loser}).finalized()
+      mock_delete.assert_called_once_with(['gs://bucket/a-speculative'])
+
+      # A first attempt that lost leaves the shard sink alone.
+      SimpleShardStage({'sinks': ['gs://bucket/b'],
+                        'shardAttempt': dict(winner, id='g-1-0')}).finalized()
+      self.assertEquals(1, mock_delete.call_count)
+    self.assertTrue(
+        shardstage.ShardAttempt.AttemptKey(winner).get().finished)
+
+  def testFindStragglers(self):
+    now = datetime.datetime(2014, 1, 16, 12, 0, 0)
+
+    def _Attempt(index, started, finished=None, speculative=False):
+      attempt = shardstage.ShardAttempt(
+          index=index, speculative=speculative,
+          started=now - datetime.timedelta(seconds=started))
+      if finished is not None:
+        attempt.finished = now - datetime.timedelta(seconds=finished)
+      return attempt
+
+    attempts = [_Attempt(i, 500, 400) for i in range(4)]
+    attempts += [
+        _Attempt(4, 500),  # straggler
+        _Attempt(5, 150),  # not running long enough yet
+        _Attempt(6, 500),  # straggler that already has a duplicate
+        _Attempt(6, 100, speculative=True),
+        ]
+    self.assertEquals([4], shardstage.FindStragglers(
+        attempts, 7, now, quorum=0.5, slowdown=2.0, min_seconds=60))
+    self.assertEquals([], shardstage.FindStragglers(
+        attempts, 7, now, quorum=1.0, slowdown=2.0, min_seconds=60))
+    self.assertEquals([], shardstage.FindStragglers(
+        attempts, 7, now, quorum=0.5, slowdown=2.0, min_seconds=600))
+
 
 if __name__ == '__main__':
   basetest.main()
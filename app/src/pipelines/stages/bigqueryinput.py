@@ -0,0 +1,189 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Export data from Big Query."""
+
+import logging
+
+from src.clients import bigquery
+from src.clients import gcs
+from src.pipelines import bigqueryjob
+from src.pipelines import pipeline
+
+
+class BigQueryInput(pipeline.Pipeline):
+  """Provides data from Big Query as input to a pipeline."""
+  CONTENT_TYPES = {
+      bigquery.SourceFormatTypes.CSV_FORMAT: 'text/csv',
+      bigquery.SourceFormatTypes.JSON_FORMAT: 'application/json',
+      }
+  GZIP_CONTENT_TYPE = 'application/x-gzip'
+
+  @staticmethod
+  def GetHelp():
+    return """Export data from BigQuery.
+
+The stage config should look like this:
+
+```python
+{
+  "type": "BigQueryInput",
+  "projectId": "...",
+  "query": "SELECT ...",
+  "queryDestinationTable": {
+    "projectId": "...",
+    "datasetId": "...",
+    "tableId": "..."
+  },
+  "sourceTable": {
+    "projectId": "...",
+    "datasetId": "...",
+    "tableId": "..."
+  },
+  "destinationFormat": "CSV",
+  "compression": "NONE",
+  "printHeader": true,
+  "sinks": ["gs://bucket/export/part-*"]
+}
+```
+
+* Give either a query or a sourceTable. The jobs run in projectId, which
+  defaults to the project of the sourceTable.
+* A query writes its results to a temporary table unless a
+  queryDestinationTable is given, which is needed for results over 128MB and
+  is overwritten.
+* The table is exported by an extract job, so no rows pass through App
+  Engine. destinationFormat is CSV or NEWLINE_DELIMITED_JSON and
+  compression is NONE or GZIP.
+* Sinks with a '*' wildcard are written by BigQuery as many shards, in
+  parallel. Stages that take wildcard sources, like BigQueryOutput, can read
+  them as they are, and the output of the stage is the list of shards.
+* A sink without a wildcard gets the shards composed into it (without CSV
+  headers), for stages that read a single object.
+"""
+
+  def run(self, config):
+    """Runs the stage.
+
+    Args:
+      config: Specifies the query or table and the sinks.
+    Yields:
+      Pipeline futures for the query and the export.
+    """
+    project_id = self.ProjectId(config)
+    if 'query' not in config:
+      yield ExportTable(config, None)
+      return
+    bq = bigquery.BigQuery(project_id)
+    job_id = bq.InsertQueryJob(
+        config['query'], destination_table=config.get('queryDestinationTable'),
+        job_id='datapipeline_%s' % self.pipeline_id)
+    query = yield bigqueryjob.WaitForJob(project_id, job_id)
+    with pipeline.After(query):
+      yield ExportTable(config, job_id)
+
+  @staticmethod
+  def ProjectId(config):
+    """Returns the project the jobs of a stage run in."""
+    return config.get('projectId') or config['sourceTable']['projectId']
+
+  def Lint(self, linter):
+    """Stage-specific configuration linting."""
+    linter.AtLeastOneFieldRequiredCheck(['query', 'sourceTable'])
+    if 'query' in linter.config:
+      linter.FieldCheck('projectId', required=True)
+      linter.FieldCheck('queryDestinationTable', field_type=dict)
+    else:
+      linter.FieldCheck('sourceTable', field_type=dict)
+      linter.FieldCheck('sourceTable.projectId', required=True)
+      linter.FieldCheck('sourceTable.datasetId', required=True)
+      linter.FieldCheck('sourceTable.tableId', required=True)
+    linter.FieldCheck('destinationFormat',
+                      validator=bigquery.VerifySourceFormat)
+    linter.FieldCheck('compression', validator=self.ValidateCompression)
+    linter.FieldCheck('printHeader', field_type=bool)
+
+  def ValidateCompression(self, compression):
+    if compression not in ('NONE', 'GZIP'):
+      raise ValueError('Expected "NONE" or "GZIP" but got %r' % compression)
+
+
+class ExportTable(pipeline.Pipeline):
+  """Exports a table, or the results of a query job, to the sinks."""
+
+  def run(self, config, query_job_id):
+    bq = bigquery.BigQuery(BigQueryInput.ProjectId(config))
+    if query_job_id:
+      job = bq.CheckJob(query_job_id)
+      table = job['configuration']['query']['destinationTable']
+    else:
+      table = config['sourceTable']
+
+    sinks = config['sinks']
+    uris = [s for s in sinks if '*' in s]
+    compose = not uris
+    if compose:
+      uris = ['%s.export-*' % sinks[0]]
+    job_id = bq.InsertExtractJob(
+        table, uris, destination_format=config.get('destinationFormat'),
+        compression=config.get('compression'),
+        print_header=config.get('printHeader', True) and not compose,
+        job_id='datapipeline_%s' % self.pipeline_id)
+    extract = yield bigqueryjob.WaitForJob(BigQueryInput.ProjectId(config),
+                                           job_id)
+    with pipeline.After(extract):
+      yield CollectShards(config, uris, sinks[0] if compose else None)
+
+
+class CollectShards(pipeline.Pipeline):
+  """Lists the shards of an export, composing them into a sink if asked."""
+
+  def run(self, config, uris, sink=None):
+    """Lists (and composes) the shards.
+
+    Args:
+      config: the stage config.
+      uris: the wildcard URLs the shards were exported to.
+      sink: optional object to compose the shards into, deleting them.
+
+    Returns:
+      The URLs of the shards, or [sink].
+    """
+    storage = gcs.Gcs()
+    shards = []
+    for uri in uris:
+      (bucket, _) = gcs.Gcs.UrlToBucketAndName(uri)
+      shards.extend(sorted(storage.ListBucket(
+          '/' + bucket, glob=gcs.Gcs.UrlToBucketAndNamePath(uri),
+          use_cache=False)))
+    logging.info('Exported %d shards to %s', len(shards), uris)
+    if not sink:
+      return shards
+
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(sink)
+    destination_format = bigquery.VerifySourceFormat(
+        config.get('destinationFormat'))
+    content_type = BigQueryInput.CONTENT_TYPES[destination_format]
+    if config.get('compression') == 'GZIP':
+      content_type = BigQueryInput.GZIP_CONTENT_TYPE
+    try:
+      storage.ComposeObjects(
+          bucket, [gcs.Gcs.UrlToBucketAndName(s)[1] for s in shards], obj,
+          content_type)
+    finally:
+      for shard, err in storage.DeleteObjects(shards).iteritems():
+        if err:
+          logging.warning('Could not delete shard %s: %r', shard, err)
+    return [sink]
@@ -0,0 +1,127 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""BigQueryInput stage unit tests."""
+
+import shutil
+import tempfile
+
+import mock
+
+import cloudstorage
+from src import basetest
+from src.clients import bigquery
+from src.clients import gcs
+from src.clients import localstorage
+from src.pipelines.stages import bigqueryinput
+
+
+class BigQueryInputTest(basetest.TestCase):
+
+  def setUp(self):
+    super(BigQueryInputTest, self).setUp()
+    self.table = {'projectId': 'p', 'datasetId': 'd', 'tableId': 't'}
+    self.bq = mock.MagicMock()
+    self.bq.InsertQueryJob.return_value = 'query'
+    self.bq.InsertExtractJob.return_value = 'extract'
+    self.bq.WaitForJob.return_value = {'statistics': {}}
+    self.bq.CheckJob.return_value = {
+        'configuration': {'query': {'destinationTable': self.table}}}
+    mock.patch.object(bigquery, 'BigQuery', return_value=self.bq).start()
+    self.shards = ['gs://b/out-000', 'gs://b/out-001']
+    self.mock_list = mock.patch.object(
+        gcs.Gcs, 'ListBucket',
+        side_effect=lambda *args, **kwargs: iter(self.shards)).start()
+    self.mock_compose = mock.patch.object(gcs.Gcs, 'ComposeObjects').start()
+    self.mock_delete = mock.patch.object(gcs.Gcs, 'DeleteObjects',
+                                         return_value={}).start()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(BigQueryInputTest, self).tearDown()
+
+  def testExportQueryToShards(self):
+    config = {'projectId': 'p', 'query': 'SELECT 1',
+              'destinationFormat': 'newline_delimited_json',
+              'compression': 'GZIP', 'sinks': ['gs://b/out-*']}
+    stage = bigqueryinput.BigQueryInput(config)
+    stage.start_test()
+
+    self.bq.InsertQueryJob.assert_called_once_with(
+        'SELECT 1', destination_table=None, job_id=mock.ANY)
+    self.bq.CheckJob.assert_called_once_with('query')
+    self.bq.InsertExtractJob.assert_called_once_with(
+        self.table, ['gs://b/out-*'],
+        destination_format='newline_delimited_json', compression='GZIP',
+        print_header=True, job_id=mock.ANY)
+    self.assertEquals([mock.call('query'), mock.call('extract')],
+                      self.bq.WaitForJob.call_args_list)
+    self.mock_list.assert_called_once_with('/b', glob='/b/out-*',
+                                           use_cache=False)
+    self.assertEquals(self.shards, stage.outputs.default.value)
+    self.assertFalse(self.mock_compose.called)
+
+  def testExportTableToObject(self):
+    self.shards = ['gs://b/out.export-000', 'gs://b/out.export-001']
+    config = {'sourceTable': self.table, 'sinks': ['gs://b/out']}
+    stage = bigqueryinput.BigQueryInput(config)
+    stage.start_test()
+
+    self.assertFalse(self.bq.InsertQueryJob.called)
+    self.bq.InsertExtractJob.assert_called_once_with(
+        self.table, ['gs://b/out.export-*'], destination_format=None,
+        compression=None, print_header=False, job_id=mock.ANY)
+    self.mock_compose.assert_called_once_with(
+        'b', ['out.export-000', 'out.export-001'], 'out', 'text/csv')
+    self.mock_delete.assert_called_once_with(self.shards)
+    self.assertEquals(['gs://b/out'], stage.outputs.default.value)
+
+
+class CollectShardsTest(basetest.TestCase):
+
+  def _Write(self, storage, urls):
+    for url in urls:
+      with storage.OpenObject(url, mode='w') as f:
+        f.write(url[-1] + '\n')
+
+  def testListsShards(self):
+    shards = ['gs://bucket/out-000', 'gs://bucket/out-001']
+    for url in shards + ['gs://bucket/other']:
+      with cloudstorage.open(gcs.Gcs.UrlToBucketAndNamePath(url), 'w') as f:
+        f.write(url)
+    stage = bigqueryinput.CollectShards({}, ['gs://bucket/out-*'])
+    stage.start_test()
+    self.assertEquals(shards, stage.outputs.default.value)
+
+  def testComposesShardsOnLocalBackend(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    gcs.SetBackend(localstorage.LocalBackend(root))
+    self.addCleanup(gcs.SetBackend, None)
+    storage = gcs.Gcs()
+    self._Write(storage, ['gs://b/out.export-000', 'gs://b/out.export-001'])
+
+    stage = bigqueryinput.CollectShards({}, ['gs://b/out.export-*'],
+                                        'gs://b/out')
+    stage.start_test()
+    self.assertEquals(['gs://b/out'], stage.outputs.default.value)
+    with storage.OpenObject('gs://b/out') as f:
+      self.assertEquals('0\n1\n', f.read())
+    self.assertEquals(['gs://b/out'],
+                      list(storage.ListBucket('/b', use_cache=False)))
+
+
+if __name__ == '__main__':
+  basetest.main()
@@ -18,11 +18,16 @@ import json
 import logging
 
 from src.clients import bigquery
+from src.clients import gcs
+from src.pipelines import bigqueryjob
 from src.pipelines import pipeline
 
 
 class BigQueryOutput(pipeline.Pipeline):
   """Output data to Big Query."""
+  # BigQuery limits on a single load job.
+  MAX_URIS_PER_JOB = 10000
+  MAX_BYTES_PER_JOB = 15 << 40
 
   @staticmethod
   def GetHelp():
@@ -52,6 +57,15 @@ The stage config should look like this:
 You may notice this syntax is very similar to the
 [BigQuery Jobs
 Syntax](https://developers.google.com/bigquery/docs/reference/v2/jobs).
+
+All the sources are loaded, and they may end in a '*' wildcard
+(gs://bucket/prefix*), so sharded outputs of earlier stages can be loaded
+without composing them first. Sources are loaded in one job unless they
+are more files or bytes than a load job takes, in which case they are
+split across several jobs that run in parallel.
+
+The stage starts the load jobs and then waits for them without holding a
+request, checking on them less and less often (up to once a minute).
 """
 
   def run(self, config):
@@ -59,6 +73,8 @@ Syntax](https://developers.google.com/bigquery/docs/reference/v2/jobs).
 
     Args:
       config: Specifies where the data will be loaded.
+    Yields:
+      Pipeline futures for the load jobs.
     """
 
     logging.info('BigQueryOutput.Pipeline start\n%s',
@@ -69,11 +85,68 @@ Syntax](https://developers.google.com/bigquery/docs/reference/v2/jobs).
     # make sure the dataset exists (this is fine if it already exists).
     bq.CreateDataset(config['destinationTable']['datasetId'])
 
-    bq.CreateTable(config['destinationTable']['datasetId'],
-                   config['destinationTable']['tableId'],
-                   config['schema']['fields'],
-                   config['sources'][0],
-                   source_format=config.get('sourceFormat'))
+    groups = self._GroupSources(config['sources'])
+    for (i, sources) in enumerate(groups):
+      job_id = 'datapipeline_%s' % self.pipeline_id
+      if len(groups) > 1:
+        job_id += '_%d' % i
+      job_id = bq.InsertLoadJob(config['destinationTable']['datasetId'],
+                                config['destinationTable']['tableId'],
+                                config['schema']['fields'],
+                                sources,
+                                source_format=config.get('sourceFormat'),
+                                job_id=job_id)
+      yield bigqueryjob.WaitForJob(config['destinationTable']['projectId'],
+                                   job_id)
+
+  def _GroupSources(self, sources):
+    """Splits the sources into groups that each fit in one load job.
+
+    A few sources without wildcards are loaded as they are. Otherwise the
+    wildcards are listed, which also gives the sizes of the objects, and
+    only the other sources are stat'ed.
+
+    Args:
+      sources: the gs:// URLs to load, possibly ending in a '*' wildcard.
+
+    Returns:
+      A list of lists of URLs. When everything fits in one job this is just
+      [sources], wildcards and all.
+    """
+    if len(sources) <= self.MAX_URIS_PER_JOB and not any(
+        '*' in s for s in sources):
+      return [sources]
+
+    storage = gcs.Gcs()
+    stats = storage.StatObjects([s for s in sources if '*' not in s])
+    urls = []
+    sizes = []
+    for source in sources:
+      if '*' in source:
+        (bucket, _) = gcs.Gcs.UrlToBucketAndName(source)
+        for (url, size) in storage.ListBucketSizes(
+            bucket, glob=gcs.Gcs.UrlToBucketAndNamePath(source)):
+          urls.append(url)
+          sizes.append(int(size or 0))
+      else:
+        urls.append(source)
+        sizes.append(int((stats[source] or {}).get('size', 0)))
+    if len(urls) <= self.MAX_URIS_PER_JOB and (
+        sum(sizes) <= self.MAX_BYTES_PER_JOB):
+      return [sources]
+
+    groups = [[]]
+    group_size = 0
+    for (url, size) in zip(urls, sizes):
+      if groups[-1] and (len(groups[-1]) >= self.MAX_URIS_PER_JOB or
+                         group_size + size > self.MAX_BYTES_PER_JOB):
+        groups.append([])
+        group_size = 0
+      groups[-1].append(url)
+      group_size += size
+    logging.info('Loading %d objects (%d bytes) in %d jobs', len(urls),
+                 sum(sizes), len(groups))
+    return groups
 
   def Lint(self, linter):
     """Stage-specific configuration linting."""
@@ -21,6 +21,7 @@ import mock
 import logging
 from src import basetest
 from src.clients import bigquery
+from src.clients import gcs
 from src.pipelines.stages import bigqueryoutput
 
 
@@ -42,7 +43,8 @@ class BigQueryOutputTest(basetest.TestCase):
     bigquery.BigQuery.return_value = mock_bq
 
     mock_bq.CreateDataset.return_value(None)
-    mock_bq.CreateTable.return_value(None)
+    mock_bq.InsertLoadJob.return_value = 'job'
+    mock_bq.WaitForJob.return_value = {'statistics': {}}
 
     with mock.patch.object(bigquery,
                            'BigQuery',
@@ -51,9 +53,11 @@ class BigQueryOutputTest(basetest.TestCase):
       bqo.start_test()
 
     mock_bq.CreateDataset.assert_called_once_with('ark')
-    mock_bq.CreateTable.assert_called_once_with('ark', 'arktable', [],
-                                                'gs://test/example',
-                                                source_format=None)
+    mock_bq.InsertLoadJob.assert_called_once_with('ark', 'arktable', [],
+                                                  ['gs://test/example'],
+                                                  source_format=None,
+                                                  job_id=mock.ANY)
+    mock_bq.WaitForJob.assert_called_once_with('job')
 
   def testRunSourceFormat(self):
     config = {
@@ -72,7 +76,8 @@ class BigQueryOutputTest(basetest.TestCase):
     bigquery.BigQuery.return_value = mock_bq
 
     mock_bq.CreateDataset.return_value(None)
-    mock_bq.CreateTable.return_value(None)
+    mock_bq.InsertLoadJob.return_value = 'job'
+    mock_bq.WaitForJob.return_value = {'statistics': {}}
 
     with mock.patch.object(bigquery,
                            'BigQuery',
@@ -81,9 +86,77 @@ class BigQueryOutputTest(basetest.TestCase):
       bqo.start_test()
 
     mock_bq.CreateDataset.assert_called_once_with('ark')
-    mock_bq.CreateTable.assert_called_once_with(
-        'ark', 'arktable', [], 'gs://test/example',
-        source_format='ChrisSpecialValues')
+    mock_bq.InsertLoadJob.assert_called_once_with(
+        'ark', 'arktable', [], ['gs://test/example'],
+        source_format='ChrisSpecialValues', job_id=mock.ANY)
+
+  def _RunWithObjects(self, sources, sizes):
+    config = {
+        'destinationTable': {
+            'projectId': '99',
+            'datasetId': 'ark',
+            'tableId': 'arktable'
+            },
+        'schema': {
+            'fields': []
+            },
+        'sources': sources
+        }
+    mock_bq = mock.MagicMock()
+    mock_bq.InsertLoadJob.side_effect = lambda *args, **kwargs: kwargs[
+        'job_id']
+    mock_bq.WaitForJob.return_value = {'statistics': {}}
+    with mock.patch.object(bigquery, 'BigQuery', return_value=mock_bq):
+      with mock.patch.object(gcs.Gcs, 'ListBucketSizes',
+                             return_value=iter(sorted(sizes.items()))
+                            ) as mock_list:
+        with mock.patch.object(
+            gcs.Gcs, 'StatObjects', side_effect=lambda urls: dict(
+                (u, {'size': sizes[u]} if u in sizes else None)
+                for u in urls)) as mock_stat:
+          bigqueryoutput.BigQueryOutput(config).start_test()
+    return (mock_bq, mock_list, mock_stat)
+
+  def testRunAllSourcesInOneJob(self):
+    sizes = {'gs://test/shard0': 10, 'gs://test/shard1': 10}
+    (mock_bq, mock_list, mock_stat) = self._RunWithObjects(
+        ['gs://test/shard*', 'gs://test/other'], sizes)
+    mock_list.assert_called_once_with('test', glob='/test/shard*')
+    mock_stat.assert_called_once_with(['gs://test/other'])
+    mock_bq.InsertLoadJob.assert_called_once_with(
+        'ark', 'arktable', [], ['gs://test/shard*', 'gs://test/other'],
+        source_format=None, job_id=mock.ANY)
+
+  def testRunFewSourcesWithoutListingOrStat(self):
+    (mock_bq, mock_list, mock_stat) = self._RunWithObjects(
+        ['gs://test/a', 'gs://test/b'], {})
+    self.assertFalse(mock_list.called)
+    self.assertFalse(mock_stat.called)
+    mock_bq.InsertLoadJob.assert_called_once_with(
+        'ark', 'arktable', [], ['gs://test/a', 'gs://test/b'],
+        source_format=None, job_id=mock.ANY)
+
+  def testRunSplitsLargeLoads(self):
+    sizes = dict(('gs://test/shard%d' % i, 10) for i in range(5))
+    with mock.patch.object(bigqueryoutput.BigQueryOutput,
+                           'MAX_URIS_PER_JOB', 2):
+      (mock_bq, _, _) = self._RunWithObjects(['gs://test/shard*'], sizes)
+    self.assertEquals(
+        [['gs://test/shard0', 'gs://test/shard1'],
+         ['gs://test/shard2', 'gs://test/shard3'],
+         ['gs://test/shard4']],
+        [c[0][3] for c in mock_bq.InsertLoadJob.call_args_list])
+    job_ids = [c[1]['job_id'] for c in mock_bq.InsertLoadJob.call_args_list]
+    self.assertEquals(3, len(set(job_ids)))
+    self.assertEquals(sorted(job_ids),
+                      sorted(c[0][0] for c in mock_bq.WaitForJob.call_args_list))
+
+    with mock.patch.object(bigqueryoutput.BigQueryOutput,
+                           'MAX_BYTES_PER_JOB', 25):
+      (mock_bq, _, _) = self._RunWithObjects(['gs://test/shard*'], sizes)
+    self.assertEquals(
+        [2, 2, 1],
+        [len(c[0][3]) for c in mock_bq.InsertLoadJob.call_args_list])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Stream data into Big Query."""
+
+import csv
+import hashlib
+import json
+import logging
+
+from src import parallel
+from src.clients import bigquery
+from src.clients import gcs
+from src.pipelines import pipeline
+
+
+class BigQueryStreamOutput(pipeline.Pipeline):
+  """Stream data into Big Query."""
+  CONCURRENT_REQUESTS = 4
+
+  @staticmethod
+  def GetHelp():
+    return """Stream data into BigQuery.
+
+The stage config should look like this:
+
+```python
+{
+  "type": "BigQueryStreamOutput",
+  "destinationTable": {
+    "projectId": "...",
+    "tableId": "...",
+    "datasetId": "..."
+  },
+  "sourceFormat": "NEWLINE_DELIMITED_JSON",
+  "skipLeadingRows": 0,
+  "schema": {
+    "fields": [{"type": "STRING", "name": "col_1"},
+               ...
+              ]
+  },
+  "maxBatchRows": 500,
+  "concurrentRequests": 4
+}
+```
+
+Unlike BigQueryOutput, which runs a load job, the rows of the sources are
+inserted straight into the table with tabledata.insertAll, so they can be
+queried within seconds. This suits small, frequent pipelines; load jobs are
+cheaper for large amounts of data.
+
+Sources may be CSV (the default) or NEWLINE_DELIMITED_JSON. CSV columns are
+matched to the schema fields in order, and empty cells are left null. The
+table is created with the schema if it does not exist.
+
+Rows are sent in batches of at most maxBatchRows rows (and a few MB), with
+up to concurrentRequests batches in flight. Failed requests are retried
+with backoff. Every row is given an insertId made from its source and
+position, so rows sent again by a retry (or a rerun of the stage) are not
+added twice.
+"""
+
+  def run(self, config):
+    """Streams the rows of the sources into a Big Query table.
+
+    Args:
+      config: Specifies the sources and the destination table.
+
+    Raises:
+      BigQueryError: some rows could not be inserted.
+    """
+    table = config['destinationTable']
+    fields = config['schema']['fields']
+    source_format = bigquery.VerifySourceFormat(config.get('sourceFormat'))
+
+    bq = bigquery.BigQuery(table['projectId'])
+    bq.CreateDataset(table['datasetId'])
+    bq.CreateEmptyTable(table['datasetId'], table['tableId'], fields)
+
+    rows = self._Rows(config['sources'], source_format, fields,
+                      config.get('skipLeadingRows', 0))
+    batches = _Batches(
+        rows, config.get('maxBatchRows', bigquery.INSERT_ALL_MAX_ROWS),
+        bigquery.INSERT_ALL_MAX_BYTES)
+    inserted = 0
+    not_inserted = []
+    for (count, failed) in parallel.IMap(
+        lambda batch: (len(batch), bq.InsertAll(table['datasetId'],
+                                                table['tableId'], batch)),
+        batches,
+        max_workers=config.get('concurrentRequests',
+                               self.CONCURRENT_REQUESTS)):
+      inserted += count - len(failed)
+      not_inserted.extend(failed)
+    logging.info('Inserted %d rows into %s.%s', inserted,
+                 table['datasetId'], table['tableId'])
+    if not_inserted:
+      (insert_id, errors) = not_inserted[0]
+      raise bigquery.BigQueryError(
+          '%d rows were not inserted, e.g. row %s: %r' % (
+              len(not_inserted), insert_id, errors))
+
+  @staticmethod
+  def _Rows(sources, source_format, fields, skip_leading_rows):
+    """Reads the rows of the sources.
+
+    Args:
+      sources: the GCS URLs of the data.
+      source_format: one of bigquery.SourceFormatTypes.
+      fields: the schema fields, which name the CSV columns.
+      skip_leading_rows: the number of (header) rows to skip in each source.
+
+    Yields:
+      (insert id, row dict) pairs.
+    """
+    storage = gcs.Gcs()
+    names = [f['name'] for f in fields]
+    for url in sources:
+      with storage.OpenObject(url) as f:
+        lines = iter(f.readline, '')
+        if source_format == bigquery.SourceFormatTypes.JSON_FORMAT:
+          rows = (json.loads(line) for line in lines if line.strip())
+        else:
+          rows = (dict((n, v) for (n, v) in zip(names, values) if v != '')
+                  for values in csv.reader(lines))
+        for (i, row) in enumerate(rows):
+          if i >= skip_leading_rows:
+            yield (hashlib.sha1('%s:%d' % (url, i)).hexdigest(), row)
+
+  def Lint(self, linter):
+    """Stage-specific configuration linting."""
+    linter.FieldCheck('destinationTable', field_type=dict, required=True)
+    linter.FieldCheck('destinationTable.projectId', required=True)
+    linter.FieldCheck('destinationTable.tableId', required=True)
+    linter.FieldCheck('destinationTable.datasetId', required=True)
+    linter.FieldCheck('schema', field_type=dict, required=True)
+    linter.FieldCheck('schema.fields', field_type=list, required=True)
+    linter.FieldCheck('skipLeadingRows', field_type=int)
+    linter.FieldCheck('maxBatchRows', field_type=int,
+                      validator=self.ValidateMaxBatchRows)
+    linter.FieldCheck('concurrentRequests', field_type=int)
+
+  def ValidateMaxBatchRows(self, rows):
+    if not 0 < rows <= bigquery.INSERT_ALL_MAX_ROWS:
+      raise ValueError('Must be between 1 and %d.' %
+                       bigquery.INSERT_ALL_MAX_ROWS)
+
+
+def _Batches(rows, max_rows, max_bytes):
+  """Groups rows into insertAll requests of bounded size.
+
+  Args:
+    rows: an iterable of (insert id, row dict) pairs.
+    max_rows: the most rows in a batch.
+    max_bytes: the most JSON encoded bytes in a batch. A row larger than
+      this is sent on its own.
+
+  Yields:
+    Lists of (insert id, row dict) pairs.
+  """
+  batch = []
+  size = 0
+  for row in rows:
+    row_size = len(json.dumps(row[1]))
+    if batch and (len(batch) >= max_rows or size + row_size > max_bytes):
+      yield batch
+      batch = []
+      size = 0
+    batch.append(row)
+    size += row_size
+  if batch:
+    yield batch
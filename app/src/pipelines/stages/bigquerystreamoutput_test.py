@@ -0,0 +1,104 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""BigQueryStreamOutput stage unit tests."""
+
+import cloudstorage
+import mock
+
+from src import basetest
+from src.clients import bigquery
+from src.clients import gcs
+from src.pipelines.stages import bigquerystreamoutput
+
+
+class BigQueryStreamOutputTest(basetest.TestCase):
+
+  def setUp(self):
+    super(BigQueryStreamOutputTest, self).setUp()
+    self.bq = mock.MagicMock()
+    self.bq.InsertAll.return_value = []
+    mock.patch.object(bigquery, 'BigQuery', return_value=self.bq).start()
+
+  def tearDown(self):
+    mock.patch.stopall()
+    super(BigQueryStreamOutputTest, self).tearDown()
+
+  def _Write(self, url, content):
+    with cloudstorage.open(gcs.Gcs.UrlToBucketAndNamePath(url), 'w') as f:
+      f.write(content)
+
+  def _Config(self, sources, **kwargs):
+    config = {
+        'destinationTable': {
+            'projectId': '99',
+            'datasetId': 'ark',
+            'tableId': 'arktable'
+            },
+        'schema': {
+            'fields': [{'name': 'name', 'type': 'STRING'},
+                       {'name': 'size', 'type': 'INTEGER'}]
+            },
+        'sources': sources
+        }
+    config.update(kwargs)
+    return config
+
+  def _InsertedRows(self):
+    return sorted((row for c in self.bq.InsertAll.call_args_list
+                   for (_, row) in c[0][2]), key=lambda row: row['name'])
+
+  def testStreamsCsv(self):
+    self._Write('gs://bucket/a.csv', 'name,size\na,1\nb,\n')
+    self._Write('gs://bucket/b.csv', 'name,size\nc,3\n')
+    config = self._Config(['gs://bucket/a.csv', 'gs://bucket/b.csv'],
+                          skipLeadingRows=1, maxBatchRows=2)
+    bigquerystreamoutput.BigQueryStreamOutput(config).start_test()
+
+    self.bq.CreateEmptyTable.assert_called_once_with(
+        'ark', 'arktable', config['schema']['fields'])
+    self.assertEquals(2, self.bq.InsertAll.call_count)
+    self.assertEquals([{'name': 'a', 'size': '1'}, {'name': 'b'},
+                       {'name': 'c', 'size': '3'}], self._InsertedRows())
+    insert_ids = [i for c in self.bq.InsertAll.call_args_list
+                  for (i, _) in c[0][2]]
+    self.assertEquals(3, len(set(insert_ids)))
+
+  def testStreamsJson(self):
+    self._Write('gs://bucket/a.json',
+                '{"name": "a", "size": 1}\n\n{"name": "b"}\n')
+    config = self._Config(['gs://bucket/a.json'],
+                          sourceFormat='newline_delimited_json')
+    bigquerystreamoutput.BigQueryStreamOutput(config).start_test()
+    self.assertEquals([{'name': 'a', 'size': 1}, {'name': 'b'}],
+                      self._InsertedRows())
+
+  def testNotInserted(self):
+    self._Write('gs://bucket/a.csv', 'a,x\n')
+    self.bq.InsertAll.return_value = [('id', [{'reason': 'invalid'}])]
+    stage = bigquerystreamoutput.BigQueryStreamOutput(
+        self._Config(['gs://bucket/a.csv']))
+    self.assertRaises(bigquery.BigQueryError, stage.start_test)
+
+  def testBatches(self):
+    rows = [(str(i), {'a': 'x' * 10}) for i in range(5)]
+    self.assertEquals([2, 2, 1], [len(b) for b in bigquerystreamoutput._Batches(
+        rows, 2, 1000)])
+    self.assertEquals([1, 1, 1, 1, 1], [len(b) for b in (
+        bigquerystreamoutput._Batches(rows, 10, 20))])
+
+
+if __name__ == '__main__':
+  basetest.main()
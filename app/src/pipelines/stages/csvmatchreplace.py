@@ -15,6 +15,7 @@
 """Transforms csv files."""
 
 import csv
+import hashlib
 import json
 import logging
 
@@ -54,6 +55,8 @@ The stage config should look like this:
   "start": first_byte,
   "length": number_of_bytes,
   "shardSize": number_of_bytes,
+  "checkpointSize": number_of_bytes,
+  "speculativeShards": false,
   "sinks": ["gs://bucket_name/results", "gs://bucket_name/badrows"]
 }
 ```
@@ -63,12 +66,18 @@ rows from the input.
 * start and length are also optional and used when this task is sharded.
 * If shardSize is specified this stage will be split up into jobs
 that are that big and then the results composited together.
+* If a shard is longer than checkpointSize its output is committed in parts
+of about that many input bytes, so a shard that dies partway through
+resumes from the last committed part when it is retried.
+* If speculativeShards is true, shards that run much longer than the
+others are started a second time and whichever run finishes first is used.
 """
 
   CHUNK_SIZE_1MB = 1 << 20
   CHUNK_SIZE_2MB = 1 << 21
   CHUNK_SIZE_4MB = 1 << 22
   SHARD_CHUNK_SIZE = CHUNK_SIZE_4MB
+  CHECKPOINT_SIZE = CHUNK_SIZE_1MB  # a few checkpoints per default shard
 
   def run(self, config):
     """Transform data according to some search/replace patterns from config.
@@ -102,13 +111,14 @@ that are that big and then the results composited together.
 
     if 'shardSize' not in config:
       config['shardSize'] = self.SHARD_CHUNK_SIZE
+    if 'checkpointSize' not in config:
+      config['checkpointSize'] = self.CHECKPOINT_SIZE
 
     (shards, compositors) = self.ShardStage(config)
     if shards and compositors:
       with pipeline.After(*[(yield shard) for shard in shards]):
         _ = [(yield compositor) for compositor in compositors]
     else:
-      # TODO(user) handle this task dying halfway through and resuming.
       # TODO(user) handle some way to update progress (memcache!?)
 
       # TODO(user) if the input file/blob is over 10M split it into
@@ -138,8 +148,7 @@ that are that big and then the results composited together.
 
 
 def FindStartAfterSkippingRows(skip_leading_rows, source_url):
-  source_filename = gcs.Gcs.UrlToBucketAndNamePath(source_url)
-  with cloudstorage.open(source_filename) as source_file:
+  with gcs.Gcs().OpenObject(source_url) as source_file:
     for _ in range(skip_leading_rows):
       source_file.readline()
     return source_file.tell()
@@ -148,6 +157,9 @@ def FindStartAfterSkippingRows(skip_leading_rows, source_url):
 def ReadTransformWrite(config, source_url, sink_url, badrows_url=None):
   """Transformation from one GCS file into another.
 
+  If the range to transform is longer than config['checkpointSize'] the
+  output is written in parts by ReadTransformWriteCheckpointed.
+
   Args:
     config: the transform config section from table.AsDataPipelineJsonDict.
     source_url: The blob_key of the csv file to transform.
@@ -156,19 +168,21 @@ def ReadTransformWrite(config, source_url, sink_url, badrows_url=None):
   Returns:
     True only if the function successfully runs to completion.
   """
+  length = config.get('length', -1)
+  checkpoint_size = config.get('checkpointSize', 0)
+  if checkpoint_size > 0 and length > checkpoint_size:
+    return ReadTransformWriteCheckpointed(config, source_url, sink_url,
+                                          badrows_url)
 
   delimiter = str(config['fieldDelimiter'])
 
-  source_filename = gcs.Gcs.UrlToBucketAndNamePath(source_url)
-  sink_filename = gcs.Gcs.UrlToBucketAndNamePath(sink_url)
-
-  logging.info('CsvMatchReplace %r -> %r', source_filename, sink_filename)
+  logging.info('CsvMatchReplace %r -> %r', source_url, sink_url)
 
   start = config.get('start', 0)
-  length = config.get('length', -1)
 
-  with cloudstorage.open(source_filename) as source_file:
-    with cloudstorage.open(sink_filename, 'w') as sink_file:
+  storage = gcs.Gcs()
+  with storage.OpenObject(source_url) as source_file:
+    with storage.OpenObject(sink_url, mode='w') as sink_file:
       if start > 0:
         source_file.seek(start)
         source_file.readline()
@@ -180,8 +194,7 @@ def ReadTransformWrite(config, source_url, sink_url, badrows_url=None):
         finished_func = None
 
       if badrows_url:
-        badrows_filename = gcs.Gcs.UrlToBucketAndNamePath(badrows_url)
-        with cloudstorage.open(badrows_filename, 'w') as badrows_file:
+        with storage.OpenObject(badrows_url, mode='w') as badrows_file:
           (row_count, bad_row_count) = ReadTransformWriteRows(
               config, csv_reader, csv_writer, finished_func, badrows_file)
       else:
@@ -193,6 +206,151 @@ def ReadTransformWrite(config, source_url, sink_url, badrows_url=None):
     return True
 
 
+def ReadTransformWriteCheckpointed(config, source_url, sink_url,
+                                   badrows_url=None):
+  """Transformation from one GCS file into another, committed in parts.
+
+  Every config['checkpointSize'] bytes of input the output written so far is
+  closed as a numbered part object and a checkpoint recording the source
+  offset is saved. When called again for the same sinks (e.g. because the
+  task was retried) the transformation resumes after the last checkpoint.
+  Once the whole range is done the parts are composed into the sinks.
+
+  Args:
+    config: the transform config section from table.AsDataPipelineJsonDict.
+    source_url: The blob_key of the csv file to transform.
+    sink_url: The gs://bucket/name url to write the output transformations to.
+    badrows_url: (optional) The gs://bucket/name url to write the badrows to.
+  Returns:
+    True only if the function successfully runs to completion.
+  """
+  delimiter = str(config['fieldDelimiter'])
+  start = config.get('start', 0)
+  end = start + config['length']
+  checkpoint_size = config['checkpointSize']
+  sink_urls = [u for u in (sink_url, badrows_url) if u]
+
+  checkpoint = ShardCheckpoint(sink_url, source_url, start, config['length'])
+  logging.info('CsvMatchReplace %r -> %r from checkpoint %r',
+               source_url, sink_urls, checkpoint.state)
+
+  storage = gcs.Gcs()
+  with storage.OpenObject(source_url) as source_file:
+    if checkpoint.state['offset'] is not None:
+      source_file.seek(checkpoint.state['offset'])
+    elif start > 0:
+      source_file.seek(start)
+      source_file.readline()
+
+    while not checkpoint.state['done']:
+      part_end = source_file.tell() + checkpoint_size
+      finished_func = lambda: source_file.tell() >= min(part_end, end + 1)
+      csv_reader = csv.reader(source_file, delimiter=delimiter)
+      part_urls = [checkpoint.PartUrl(i, checkpoint.state['parts'])
+                   for i in range(len(sink_urls))]
+
+      with storage.OpenObject(part_urls[0], mode='w') as sink_file:
+        csv_writer = csv.writer(sink_file)
+        if badrows_url:
+          with storage.OpenObject(part_urls[1], mode='w') as badrows_file:
+            (row_count, bad_row_count) = ReadTransformWriteRows(
+                config, csv_reader, csv_writer, finished_func, badrows_file)
+        else:
+          (row_count, bad_row_count) = ReadTransformWriteRows(
+              config, csv_reader, csv_writer, finished_func)
+
+      # We stopped early only if we reached the end of this part; anything
+      # else means we are past the end of our range or out of input.
+      position = source_file.tell()
+      checkpoint.Commit(position, row_count, bad_row_count,
+                        done=position > end or position < part_end)
+
+  checkpoint.Finish(sink_urls, config.get(
+      'contentType', shardstage.ShardStage.DEFAULT_CONTENT_TYPE))
+  logging.info('CsvMatchReplace complete. %d rows, %d bad.',
+               checkpoint.state['rows'], checkpoint.state['badRows'])
+  return True
+
+
+class ShardCheckpoint(object):
+  """Progress of a transformation whose output is committed in parts.
+
+  The state is kept as a JSON object, with the parts, under a temporary
+  prefix of the first sink that is unique to the attempt: the source object
+  (and its version) and the range of it being transformed. It records the
+  source offset to resume from, how many parts have been committed, the row
+  counts so far and whether the whole range has been transformed. A
+  checkpoint left by an attempt over other input is never resumed; it is
+  deleted when the next attempt starts.
+  """
+  PREFIX = 'checkpoint-'
+
+  def __init__(self, sink_url, source_url, start, length):
+    storage = gcs.Gcs()
+    source = storage.StatObject(url=source_url, use_cache=False)
+    attempt = json.dumps([source_url, source['md5Hash'], start, length])
+    self.prefix = '%s/%s%s/' % (sink_url, self.PREFIX,
+                                hashlib.sha1(attempt).hexdigest())
+    self.checkpoint_url = self.prefix + 'checkpoint'
+    self.state = {'offset': None, 'parts': 0, 'rows': 0, 'badRows': 0,
+                  'done': False}
+
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(sink_url)
+    stale = [u for u in storage.ListBucket(
+        '/' + bucket, prefix='%s/%s' % (obj, self.PREFIX), use_cache=False)
+             if not u.startswith(self.prefix)]
+    if stale:
+      logging.info('Deleting %d objects of stale checkpoints', len(stale))
+      storage.DeleteObjects(stale)
+    try:
+      with storage.OpenObject(self.checkpoint_url) as f:
+        self.state = json.load(f)
+    except cloudstorage.NotFoundError:
+      pass
+
+  def PartUrl(self, sink_index, part):
+    """Returns the url of a part of the output for one of the sinks."""
+    return '%spart-%d-%05d' % (self.prefix, sink_index, part)
+
+  def Commit(self, offset, row_count, bad_row_count, done):
+    """Saves the checkpoint after a part has been written.
+
+    Args:
+      offset: the source offset the next part starts at.
+      row_count: rows transformed in this part.
+      bad_row_count: bad rows found in this part.
+      done: if this was the last part.
+    """
+    self.state['offset'] = offset
+    self.state['parts'] += 1
+    self.state['rows'] += row_count
+    self.state['badRows'] += bad_row_count
+    self.state['done'] = done
+    with gcs.Gcs().OpenObject(self.checkpoint_url, mode='w') as f:
+      json.dump(self.state, f)
+
+  def Finish(self, sink_urls, content_type):
+    """Composes the committed parts into the sinks and cleans up.
+
+    The checkpoint is removed before the parts so that a retry after a
+    partial clean up starts over instead of composing missing parts.
+
+    Args:
+      sink_urls: the final output urls, in the order the parts were written.
+      content_type: the content type of the composed sinks.
+    """
+    storage = gcs.Gcs()
+    parts = []
+    for (sink_index, url) in enumerate(sink_urls):
+      (bucket, obj) = gcs.Gcs.UrlToBucketAndName(url)
+      names = [gcs.Gcs.UrlToBucketAndName(self.PartUrl(sink_index, i))[1]
+               for i in range(self.state['parts'])]
+      storage.ComposeObjects(bucket, names, obj, content_type)
+      parts.extend(gcs.Gcs.MakeUrl(bucket, n) for n in names)
+    storage.DeleteObject(*gcs.Gcs.UrlToBucketAndName(self.checkpoint_url))
+    storage.DeleteObjects(parts)
+
+
 def ReadTransformWriteRows(config, csv_reader, csv_writer,
                            finished_func=None,
                            badrows_file=None):
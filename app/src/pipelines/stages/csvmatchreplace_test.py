@@ -0,0 +1,175 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CsvMatchReplace stage unit tests."""
+
+import json
+import shutil
+import tempfile
+
+import mock
+
+import cloudstorage
+from src import basetest
+from src.clients import bigquery
+from src.clients import gcs
+from src.clients import localstorage
+from src.pipelines.stages import csvmatchreplace
+
+
+class CsvMatchReplaceTest(basetest.TestCase):
+
+  def _Write(self, url, data):
+    with cloudstorage.open(gcs.Gcs.UrlToBucketAndNamePath(url), 'w') as f:
+      f.write(data)
+
+  def _Read(self, url):
+    with cloudstorage.open(gcs.Gcs.UrlToBucketAndNamePath(url)) as f:
+      return f.read()
+
+  def _Config(self, length):
+    column = {'type': bigquery.ColumnTypes.STRING, 'wanted': True}
+    return {'fieldDelimiter': ',',
+            'columns': [column, column],
+            'start': 0,
+            'length': length,
+            'checkpointSize': 12,
+            'contentType': 'text/csv'}
+
+  def testResumeFromCheckpoint(self):
+    source_url = 'gs://bucket/source.csv'
+    sink_url = 'gs://bucket/sink.csv'
+    source = ''.join('a%d,b%d\n' % (i, i) for i in range(10))
+    self._Write(source_url, source)
+
+    # Pretend the task died after committing the first two rows.
+    checkpoint = csvmatchreplace.ShardCheckpoint(
+        sink_url, source_url, 0, len(source))
+    self.assertTrue(checkpoint.checkpoint_url.startswith(sink_url + '/'))
+    self._Write(checkpoint.PartUrl(0, 0), 'a0,b0\r\na1,b1\r\n')
+    self._Write(checkpoint.checkpoint_url, json.dumps({
+        'offset': 12, 'parts': 1, 'rows': 2, 'badRows': 0, 'done': False}))
+
+    with mock.patch.object(gcs.Gcs, 'ComposeObjects') as mock_compose:
+      with mock.patch.object(gcs.Gcs, 'DeleteObject') as mock_delete:
+        with mock.patch.object(gcs.Gcs, 'DeleteObjects') as mock_deletes:
+          self.assertTrue(csvmatchreplace.ReadTransformWrite(
+              self._Config(len(source)), source_url, sink_url))
+
+    part_urls = [checkpoint.PartUrl(0, i) for i in range(6)]
+    (bucket, parts, obj, content_type) = mock_compose.call_args[0]
+    self.assertEquals(('bucket', 'sink.csv', 'text/csv'),
+                      (bucket, obj, content_type))
+    self.assertEquals([gcs.Gcs.UrlToBucketAndName(u)[1] for u in part_urls],
+                      parts)
+    self.assertEquals('a2,b2\r\na3,b3\r\n', self._Read(part_urls[1]))
+    self.assertEquals('a8,b8\r\na9,b9\r\n', self._Read(part_urls[4]))
+    mock_delete.assert_called_once_with(
+        *gcs.Gcs.UrlToBucketAndName(checkpoint.checkpoint_url))
+    self.assertEquals(part_urls, mock_deletes.call_args[0][0])
+
+  def _UseLocalBackend(self):
+    root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, root)
+    gcs.SetBackend(localstorage.LocalBackend(root))
+    self.addCleanup(gcs.SetBackend, None)
+    return gcs.Gcs()
+
+  def testCheckpointOfOtherSourceIsDiscarded(self):
+    storage = self._UseLocalBackend()
+    source_url = 'gs://bucket/source.csv'
+    sink_url = 'gs://bucket/sink.csv'
+    with storage.OpenObject(source_url, mode='w') as f:
+      f.write('x0,y0\nx1,y1\n')
+    stale = csvmatchreplace.ShardCheckpoint(sink_url, source_url, 0, 24)
+    with storage.OpenObject(stale.PartUrl(0, 0), mode='w') as f:
+      f.write('x0,y0\r\n')
+    with storage.OpenObject(stale.checkpoint_url, mode='w') as f:
+      json.dump({'offset': 6, 'parts': 1, 'rows': 1, 'badRows': 0,
+                 'done': False}, f)
+
+    # The source was replaced before the next attempt.
+    source = ''.join('a%d,b%d\n' % (i, i) for i in range(4))
+    with storage.OpenObject(source_url, mode='w') as f:
+      f.write(source)
+    self.assertTrue(csvmatchreplace.ReadTransformWrite(
+        self._Config(len(source)), source_url, sink_url))
+
+    with storage.OpenObject(sink_url) as f:
+      self.assertEquals(source.replace('\n', '\r\n'), f.read())
+    self.assertEquals([sink_url, source_url],
+                      list(storage.ListBucket('bucket', use_cache=False)))
+
+  def testSmallRangeIsNotCheckpointed(self):
+    source_url = 'gs://bucket/source.csv'
+    sink_url = 'gs://bucket/sink.csv'
+    self._Write(source_url, 'a,b\nc,d\n')
+
+    column = {'type': bigquery.ColumnTypes.STRING, 'wanted': True}
+    config = {'fieldDelimiter': ',',
+              'columns': [column, column],
+              'length': 8,
+              'checkpointSize': 1024}
+    with mock.patch.object(gcs.Gcs, 'ComposeObjects') as mock_compose:
+      self.assertTrue(csvmatchreplace.ReadTransformWrite(
+          config, source_url, sink_url))
+      self.assertFalse(mock_compose.called)
+    self.assertEquals('a,b\r\nc,d\r\n', self._Read(sink_url))
+
+  def testShardedOnLocalBackend(self):
+    storage = self._UseLocalBackend()
+
+    source = ''.join('a%d,b%d\n' % (i, i) for i in range(100))
+    with storage.OpenObject('gs://bucket/in.csv', mode='w') as f:
+      f.write(source)
+    column = {'type': bigquery.ColumnTypes.STRING, 'wanted': True}
+    config = {'fieldDelimiter': ',',
+              'columns': [column, column],
+              'shardSize': 100,
+              'checkpointSize': 40,
+              'sources': ['gs://bucket/in.csv'],
+              'sinks': ['gs://bucket/out.csv']}
+    csvmatchreplace.CsvMatchReplace(config).start_test()
+
+    with storage.OpenObject('gs://bucket/out.csv') as f:
+      self.assertEquals(source.replace('\n', '\r\n'), f.read())
+    # The shards under out.csv/ were composed and deleted.
+    self.assertEquals(['gs://bucket/in.csv', 'gs://bucket/out.csv'],
+                      list(storage.ListBucket('bucket', use_cache=False)))
+
+  def testDefaultShardsAreCheckpointed(self):
+    storage = self._UseLocalBackend()
+    row = 'a' * 1023 + '\n'
+    source = row * (4608 + 1)  # a little over 4.5MB
+    with storage.OpenObject('gs://bucket/in.csv', mode='w') as f:
+      f.write(source)
+    column = {'type': bigquery.ColumnTypes.STRING, 'wanted': True}
+    config = {'fieldDelimiter': ',',
+              'columns': [column],
+              'sources': ['gs://bucket/in.csv'],
+              'sinks': ['gs://bucket/out.csv']}
+
+    commit = csvmatchreplace.ShardCheckpoint.Commit
+    with mock.patch.object(csvmatchreplace.ShardCheckpoint, 'Commit',
+                           autospec=True, side_effect=commit) as mock_commit:
+      csvmatchreplace.CsvMatchReplace(config).start_test()
+
+    # Two shards of about 2.25MB, each committed in three parts.
+    self.assertEquals(6, mock_commit.call_count)
+    with storage.OpenObject('gs://bucket/out.csv') as f:
+      self.assertEquals(source.replace('\n', '\r\n'), f.read())
+
+
+if __name__ == '__main__':
+  basetest.main()
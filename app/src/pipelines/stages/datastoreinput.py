@@ -63,7 +63,8 @@ The stage config should look like this:
     gql = config.get('gql')
     if not gql:
       with contextlib.closing(
-          storage.OpenObject(url=config['object'])) as stream:
+          storage.OpenObject(url=config['object'],
+                             prefetch=gcs.Gcs.PREFETCH_RANGES)) as stream:
         with contextlib.closing(StringIO.StringIO()) as gql_buf:
           while True:
             buf = stream.read(gcs.Gcs.READ_CHUNK_SIZE)
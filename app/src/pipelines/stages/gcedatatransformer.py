@@ -189,7 +189,8 @@ The stage config should look like this:
     for (source, sink) in zip(config['sources'], config['sinks']):
       logging.debug('Transforming %s to %s', source, sink)
 
-      with contextlib.closing(storage.OpenObject(source)) as source_file:
+      with contextlib.closing(storage.OpenObject(
+          source, prefetch=gcs.Gcs.PREFETCH_RANGES)) as source_file:
         with contextlib.closing(storage.OpenObject(sink, mode='w')
                                ) as sink_file:
           for line in source_file:
@@ -167,27 +167,17 @@ The stage config should look like this:
         config['destinationTable']['tableId'], zone, date, number_days)
     logging.debug('BigQuery Query: %s', query_str)
 
-    start_index = 0
-    total_rows = 1   # total_rows will be set later after the first query.
-    while start_index < total_rows:
-      result = bq.Query(query_str, table_info=None, offset=start_index,
-                        max_results=100)
-      if len(result) != 3:
-        raise GceZoneOperationsInputException.error(
-            'Big Query query quit. Please review your Big Query query for '
-            'query syntax.')
-
-      _, _, reply = result
-      total_rows = int(reply['totalRows'])
-      reply_rows = reply.get('rows')
-
-      if not reply_rows:
-        logging.info('No BigQuery operation rows found for zone: %s. '
-                     'for date %s', zone, date)
-      else:
-        # Add all operation ids from the reply
-        operation_ids.update([row['f'][0]['v'] for row in reply_rows])
-        start_index += len(reply_rows)
+    try:
+      operation_ids.update(row['f'][0]['v']
+                           for row in bq.QueryResults(query_str))
+    except bigquery.BigQueryError as err:
+      raise GceZoneOperationsInputException(
+          'Big Query query quit (%s). Please review your Big Query query for '
+          'query syntax.' % err)
+
+    if not operation_ids:
+      logging.info('No BigQuery operation rows found for zone: %s. '
+                   'for date %s', zone, date)
 
     return operation_ids
 
@@ -16,8 +16,11 @@
 
 import datetime
 
+import mock
 
 from src import basetest
+from src.clients import bigquery
+from src.pipelines.stages import gcezoneoperationsinput
 from src.pipelines.stages.gcezoneoperationsinput import GceZoneOperationsInput
 
 
@@ -73,6 +76,26 @@ class GceZoneOperationsInputTest(basetest.TestCase):
     self.assertRaises(ValueError, test_input.ValidateBigQueryId, '123:table')
     self.assertRaises(ValueError, test_input.ValidateBigQueryId, '')
 
+  def testGetStoredOperations(self):
+    config = {'destinationTable': {'projectId': 'p', 'datasetId': 'd',
+                                   'tableId': 't'}}
+    mock_bq = mock.MagicMock()
+    mock_bq.GetTable.return_value = {'id': 'p:d.t'}
+    mock_bq.QueryResults.return_value = iter(
+        [{'f': [{'v': '1'}, {'v': 'x'}]}, {'f': [{'v': '2'}, {'v': 'y'}]}])
+    with mock.patch.object(bigquery, 'BigQuery', return_value=mock_bq):
+      ids = GceZoneOperationsInput._GetStoredOperations(
+          'zone', config, datetime.date(2013, 11, 12))
+    self.assertEquals(set(['1', '2']), set(ids))
+    self.assertEquals(1, mock_bq.QueryResults.call_count)
+
+    mock_bq.QueryResults.side_effect = bigquery.BigQueryError('bad query')
+    with mock.patch.object(bigquery, 'BigQuery', return_value=mock_bq):
+      self.assertRaises(
+          gcezoneoperationsinput.GceZoneOperationsInputException,
+          GceZoneOperationsInput._GetStoredOperations,
+          'zone', config, datetime.date(2013, 11, 12))
+
 
 if __name__ == '__main__':
   basetest.main()
@@ -35,6 +35,7 @@ class GcsDeleter(pipeline.Pipeline):
     Args:
       config: Specifies the source object(s).
     """
-    storage = gcs.Gcs()
+    results = gcs.Gcs().DeleteObjects(config['sources'])
     for s in config['sources']:
-      storage.DeleteObject(*gcs.Gcs.UrlToBucketAndName(s))
+      if results[s]:
+        raise results[s]
@@ -0,0 +1,68 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""GcsInput stage unit tests."""
+
+import mock
+
+import cloudstorage
+from src import basetest
+from src.clients import gcs
+from src.pipelines.stages import gcsinput
+
+
+class GcsInputTest(basetest.TestCase):
+
+  def testCopiesChangedObjects(self):
+    stats = {
+        'gs://bucket/a': {'md5Hash': 'aaa', 'size': 3},
+        'gs://bucket/b': {'md5Hash': 'bbb', 'size': 3},
+        'gs://bucket/c': {'md5Hash': 'ccc', 'size': 3},
+        'gs://sink/a': {'md5Hash': 'aaa', 'size': 3},
+        'gs://sink/b': {'md5Hash': 'old', 'size': 3},
+        'gs://sink/c': None,
+    }
+    config = {
+        'objects': {'bucket': 'bucket'},
+        'sinks': ['gs://sink/a', 'gs://sink/b', 'gs://sink/c']
+    }
+    with mock.patch.object(gcs.Gcs, 'ListBucket',
+                           return_value=iter(sorted(stats)[:3])):
+      with mock.patch.object(gcs.Gcs, 'StatObjects',
+                             side_effect=lambda urls: dict(
+                                 (u, stats[u]) for u in urls)):
+        with mock.patch.object(gcs.Gcs, 'CopyObject',
+                               return_value={'selfLink': 'x'}) as mock_copy:
+          gcsinput.GcsInput(config).start_test()
+
+    self.assertEquals(
+        [mock.call('gs://bucket/b', 'gs://sink/b'),
+         mock.call('gs://bucket/c', 'gs://sink/c')],
+        sorted(mock_copy.call_args_list))
+
+  def testMissingSource(self):
+    stats = {'gs://bucket/a': None, 'gs://sink/a': {'md5Hash': 'aaa'}}
+    config = {'object': 'gs://bucket/a', 'sinks': ['gs://sink/a']}
+    with mock.patch.object(gcs.Gcs, 'StatObjects',
+                           side_effect=lambda urls: dict(
+                               (u, stats[u]) for u in urls)):
+      with mock.patch.object(gcs.Gcs, 'CopyObject') as mock_copy:
+        self.assertRaisesRegexp(cloudstorage.NotFoundError, 'gs://bucket/a',
+                                gcsinput.GcsInput(config).start_test)
+    self.assertFalse(mock_copy.called)
+
+
+if __name__ == '__main__':
+  basetest.main()
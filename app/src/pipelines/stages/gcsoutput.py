@@ -51,7 +51,7 @@ The stage config should look like this:
     storage = gcs.Gcs()
     src = config['sources'][0]
     dest = config['object']
-    if src is not dest:
+    if src != dest:
       res = storage.CopyObject(src, dest)
       logging.info('Copied %s to %s', src, res['selfLink'])
 
@@ -14,18 +14,74 @@
 
 """Pipeline stages."""
 
+import collections
 import contextlib
-import cStringIO as StringIO
+import hashlib
+import httplib
 import logging
+import StringIO
+import threading
 import urllib2
 import urlparse
 
+from google.appengine.ext import ndb
+import httplib2
 
+from src import parallel
 from src.clients import gcs
 from src.pipelines import pipeline
 from src.pipelines import shardstage
 
 
+MAX_CONNECTIONS_PER_HOST = 8
+REQUEST_TIMEOUT = 300
+METADATA_PREFIX = 'x-goog-meta-'
+
+
+class HttpInputError(Exception):
+  """Error on fetching a range of the resource."""
+
+
+class ConnectionPool(object):
+  """Keep-alive HTTP connections shared by the threads of this process.
+
+  At most max_per_host connections to any one host are handed out at a time;
+  callers beyond that wait for a connection to be returned.
+  """
+
+  def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST):
+    self._max_per_host = max_per_host
+    self._lock = threading.Lock()
+    self._semaphores = {}
+    self._idle = collections.defaultdict(list)
+
+  @contextlib.contextmanager
+  def Connection(self, url):
+    """Lends out an httplib2.Http for the host of url.
+
+    A connection is only reused if the block using it finished without error.
+
+    Args:
+      url: the URL that will be requested.
+    Yields:
+      An httplib2.Http.
+    """
+    host = urlparse.urlparse(url).netloc
+    with self._lock:
+      if host not in self._semaphores:
+        self._semaphores[host] = threading.BoundedSemaphore(self._max_per_host)
+      semaphore = self._semaphores[host]
+    with semaphore:
+      with self._lock:
+        idle = self._idle[host]
+        http = idle.pop() if idle else httplib2.Http(timeout=REQUEST_TIMEOUT)
+      yield http
+      with self._lock:
+        self._idle[host].append(http)
+
+_connections = ConnectionPool()
+
+
 class HttpInput(shardstage.ShardStage):
   """Provides data from an arbitrary URL as input to a pipeline.
 
@@ -36,6 +92,7 @@ class HttpInput(shardstage.ShardStage):
   CHUNK_SIZE_32MB = 1 << 25
   REQUEST_CHUNK_SIZE = CHUNK_SIZE_8MB
   MAX_SHARD_SIZE = CHUNK_SIZE_32MB  # App Engine's response size limit.
+  CONCURRENT_SHARD_SIZE = 1 << 30
   DEFAULT_CONTENT_TYPE = 'binary/octet-stream'
 
   @staticmethod
@@ -51,6 +108,10 @@ The stage config should look like this:
   "length": number_of_bytes,
   "shardSize": maximum_number_of_bytes,
   "shardPrefix": "...",
+  "speculativeShards": false,
+  "concurrentRequests": 0,
+  "rangeSize": maximum_number_of_bytes,
+  "skipUnchanged": false,
 }
 ```
 
@@ -62,6 +123,22 @@ compisited together into the resulting file.
 * 'shardPrefix' can be used to organize the temporary objects, if any,
   created during the chunked transfer (and recomposition) of the
   object in GCS.
+* If 'speculativeShards' is true, chunks that take much longer than the
+  others are requested a second time and the first to finish is used.
+* If 'concurrentRequests' is set (HTTP/S only), each shard downloads
+  'rangeSize' byte ranges (8MB by default) with up to that many requests at
+  once over kept-alive connections, writes them to temporary objects and
+  composes them. No more than 8 connections are opened to any one host.
+  'shardSize' then defaults to 1GB, so separate shards are only made for
+  very large resources.
+* If 'skipUnchanged' is true, the ETag and Last-Modified of the url are
+  remembered with the object written and sent as If-None-Match and
+  If-Modified-Since on the next run. If the server answers 304 Not
+  Modified the previous object is reused (copied if the sink moved)
+  instead of downloading it again. The sink then has the metadata
+  source-unchanged=true (false after a real download), which later stages
+  can check with httpinput.SourceUnchanged(sink). It is ignored when
+  start or length is given.
 * Any 'sources' for this stage config will be ignored.
 """
 
@@ -78,16 +155,36 @@ compisited together into the resulting file.
       start = 0
       config['start'] = 0
 
-    if 'length' not in config:
+    # Only whole resources are remembered.
+    skip_unchanged = (config.pop('skipUnchanged', False) and
+                      not start and 'length' not in config)
+    previous = skip_unchanged and PreviousDownload(config['url'])
+    validators = None
+    if 'length' not in config or skip_unchanged:
       # hit the resource with a one-byte range GET to find out length
       # this is necessary as App Engine will strip the Content-Length header
       # from a HEAD request
       req = urllib2.Request(config['url'])
       req.add_header('Range', 'bytes=0-0')
+      if previous and previous.etag:
+        req.add_header('If-None-Match', previous.etag)
+      if previous and previous.last_modified:
+        req.add_header('If-Modified-Since', previous.last_modified)
       meta_inf = None
-      with contextlib.closing(urllib2.urlopen(req)) as resp:
-        meta_inf = resp.info()
+      try:
+        with contextlib.closing(urllib2.urlopen(req)) as resp:
+          meta_inf = resp.info()
+      except urllib2.HTTPError as e:
+        if not previous or e.code != httplib.NOT_MODIFIED:
+          raise
+        ReuseDownload(previous, config['sinks'][0])
+        self.set_status(message='%s is unchanged.' % config['url'])
+        return
+
+      if skip_unchanged:
+        validators = _Validators(meta_inf)
 
+    if 'length' not in config:
       range_len = meta_inf.getheaders('Content-Range')
       if range_len:
         range_len = long(range_len[0].split('/')[1])
@@ -95,13 +192,24 @@ compisited together into the resulting file.
       else:
         logging.warning('Cannot determine resource length.')
 
+    concurrent = self._Concurrent(config)
     if 'shardSize' not in config:
-      config['shardSize'] = self.REQUEST_CHUNK_SIZE
+      if concurrent:
+        config['shardSize'] = self.CONCURRENT_SHARD_SIZE
+      else:
+        config['shardSize'] = self.REQUEST_CHUNK_SIZE
 
     (shards, compositors) = self.ShardStage(config)
     if shards and compositors:
       with pipeline.After(*[(yield shard) for shard in shards]):
-        _ = [(yield compositor) for compositor in compositors]
+        composed = [(yield compositor) for compositor in compositors]
+      if validators:
+        with pipeline.After(*composed):
+          yield SaveDownload(config['url'], config['sinks'][0], validators)
+      return
+    elif concurrent and config.get('length') > config.get(
+        'rangeSize', self.REQUEST_CHUNK_SIZE):
+      self._DownloadConcurrently(config)
     else:
       gcs_obj = config['sinks'][0]
       gcs_storage = gcs.Gcs()
@@ -117,13 +225,68 @@ compisited together into the resulting file.
         range_bytes %= (start, '')
       req.add_header('Range', range_bytes)
       with contextlib.closing(urllib2.urlopen(req, timeout=300)) as resp:
-        with contextlib.closing(StringIO.StringIO(resp.read())) as resp_buf:
-          gcs_storage.InsertObject(resp_buf, url=gcs_obj)
+        with contextlib.closing(parallel.ReadAhead(
+            resp, gcs.Gcs.STREAM_CHUNK_SIZE)) as stream:
+          gcs_storage.InsertObject(stream, url=gcs_obj, size=length)
+
+    if validators:
+      RecordDownload(config['url'], config['sinks'][0], validators)
+
+  def _Concurrent(self, config):
+    """Returns how many ranges may be requested at once, or 0."""
+    scheme = urlparse.urlparse(config['url']).scheme
+    if scheme not in ('http', 'https') or 'length' not in config:
+      return 0
+    return config.get('concurrentRequests', 0)
+
+  def _DownloadConcurrently(self, config):
+    """Fetches the ranges of the resource in parallel and composes them."""
+    url = config['url']
+    start = config.get('start', 0)
+    end = start + config['length']
+    range_size = config.get('rangeSize', self.REQUEST_CHUNK_SIZE)
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(config['sinks'][0])
+    make_url = gcs.Gcs.UrlCreator(
+        bucket, '%s/%s' % (obj, config.get('shardPrefix', '')))
+    ranges = [(position, min(position + range_size, end) - 1, make_url())
+              for position in xrange(start, end, range_size)]
+    gcs_storage = gcs.Gcs()
+
+    def _FetchRange(part):
+      (first, last, part_url) = part
+      with _connections.Connection(url) as http:
+        resp, content = http.request(
+            url, headers={'Range': 'bytes=%d-%d' % (first, last)})
+      if resp.status != 206 or len(content) != last - first + 1:
+        raise HttpInputError('Range %d-%d of %s returned status %d with %d '
+                             'bytes.' % (first, last, url, resp.status,
+                                         len(content)))
+      gcs_storage.InsertObject(StringIO.StringIO(content), url=part_url,
+                               size=len(content))
+      return resp.get('content-type')
+
+    logging.info('fetching %d ranges of %s, %d at a time',
+                 len(ranges), url, config['concurrentRequests'])
+    part_urls = [part_url for (_, _, part_url) in ranges]
+    try:
+      content_types = parallel.Map(_FetchRange, ranges,
+                                   config['concurrentRequests'])
+      gcs_storage.ComposeObjects(
+          bucket, [gcs.Gcs.UrlToBucketAndName(u)[1] for u in part_urls], obj,
+          content_types[0] or self.DEFAULT_CONTENT_TYPE)
+    finally:
+      for part_url, err in gcs_storage.DeleteObjects(part_urls).iteritems():
+        if err:
+          logging.warning('Could not delete range %s: %r', part_url, err)
 
   def Lint(self, linter):
     """Stage-specific configuration linting."""
     linter.FieldCheck('url', validator=self.ValidateUrl)
-    linter.FieldCheck('shardSize', validator=self.ValidateShardSize)
+    linter.FieldCheck('concurrentRequests', field_type=int)
+    if linter.config.get('concurrentRequests'):
+      linter.FieldCheck('rangeSize', validator=self.ValidateShardSize)
+    else:
+      linter.FieldCheck('shardSize', validator=self.ValidateShardSize)
 
   def ValidateUrl(self, url):
     parsed = urlparse.urlparse(url)
@@ -134,3 +297,104 @@ compisited together into the resulting file.
     if size > self.MAX_SHARD_SIZE:
       raise ValueError('Size exceeds App Engine response limit.')
 
+
+class HttpDownload(ndb.Model):
+  """Datastore model of the last download of a url by HttpInput.
+
+  The entity id is the SHA-1 of the url.
+  """
+  url = ndb.StringProperty(indexed=False)
+  sink = ndb.StringProperty(indexed=False)
+  md5 = ndb.StringProperty(indexed=False)
+  etag = ndb.StringProperty(indexed=False)
+  last_modified = ndb.StringProperty(indexed=False)
+  length = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SaveDownload(pipeline.Pipeline):
+  """Records a sharded download once its shards have been composed."""
+
+  def run(self, url, sink, validators):
+    RecordDownload(url, sink, validators)
+
+
+def _DownloadId(url):
+  return hashlib.sha1(url).hexdigest()
+
+
+def _Validators(meta_inf):
+  """Returns the ETag, Last-Modified and length headers of a response."""
+  def _Header(name):
+    values = meta_inf.getheaders(name)
+    return values[0] if values else None
+  length = _Header('Content-Range')
+  if length:
+    length = length.rsplit('/', 1)[-1]
+  else:
+    length = _Header('Content-Length')
+  return {'etag': _Header('ETag'),
+          'lastModified': _Header('Last-Modified'),
+          'length': length and str(length)}
+
+
+def PreviousDownload(url):
+  """Returns the HttpDownload of url if its object is still as written."""
+  download = HttpDownload.get_by_id(_DownloadId(url))
+  if not download:
+    return None
+  stat = gcs.Gcs().StatObjects([download.sink])[download.sink]
+  if not stat or stat['md5Hash'] != download.md5:
+    logging.info('%s no longer holds the last download of %s',
+                 download.sink, url)
+    return None
+  return download
+
+
+def RecordDownload(url, sink, validators, unchanged=False):
+  """Tags sink with where it came from and remembers it for the next run.
+
+  Args:
+    url: the url that was downloaded.
+    sink: the URL of the GCS object holding its contents.
+    validators: a dict of the etag, lastModified and length of url.
+    unchanged: True if sink was reused because url had not changed.
+  """
+  metadata = {'source-url': url,
+              'source-unchanged': str(bool(unchanged)).lower()}
+  for (key, name) in (('etag', 'source-etag'),
+                      ('lastModified', 'source-last-modified'),
+                      ('length', 'source-length')):
+    if validators.get(key):
+      metadata[name] = validators[key]
+  storage = gcs.Gcs()
+  storage.SetObjectMetadata(sink, metadata)
+  HttpDownload(id=_DownloadId(url), url=url, sink=sink,
+               md5=storage.StatObject(url=sink, use_cache=False)['md5Hash'],
+               etag=validators.get('etag'),
+               last_modified=validators.get('lastModified'),
+               length=validators.get('length')).put()
+
+
+def ReuseDownload(download, sink):
+  """Makes sink hold the unchanged contents of a previous download."""
+  logging.info('%s is unchanged, reusing %s', download.url, download.sink)
+  if download.sink != sink:
+    gcs.Gcs().CopyObject(download.sink, sink)
+  RecordDownload(download.url, sink,
+                 {'etag': download.etag,
+                  'lastModified': download.last_modified,
+                  'length': download.length},
+                 unchanged=True)
+
+
+def SourceUnchanged(url):
+  """Returns True if HttpInput reused the GCS object at url unchanged."""
+  metadata = gcs.Gcs().StatObject(url=url, use_cache=False)['metadata'] or {}
+  for (key, value) in metadata.iteritems():
+    key = key.lower()
+    if key.startswith(METADATA_PREFIX):
+      key = key[len(METADATA_PREFIX):]
+    if key == 'source-unchanged':
+      return value == 'true'
+  return False
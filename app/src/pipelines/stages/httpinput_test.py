@@ -16,8 +16,10 @@
 
 
 
+import threading
 import urllib2
 
+import httplib2
 from mapreduce.lib.pipeline import common
 import mock
 
@@ -85,7 +87,8 @@ class HttpInputTest(basetest.TestCase):
                              mock.MagicMock()) as mock_gcs_insert:
         stage.start_test()
         mock_gcs_insert.assert_called_once_with(mock.ANY,
-                                                url='gs://bucket/obj')
+                                                url='gs://bucket/obj',
+                                                size=mock.ANY)
 
   def testInputMultipleRequests(self):
     class MockMeta(object):
@@ -230,6 +233,173 @@ class HttpInputTest(basetest.TestCase):
             first_chunk = mock.call('Range', 'bytes=2-6')
             mock_req.add_header.assert_has_calls([first_chunk])
 
+  def testConcurrentRequests(self):
+    payload = 'abcdefghij'
+    inserted = {}
+
+    def _MockRequest(unused_url, headers):
+      (first, last) = headers['Range'][len('bytes='):].split('-')
+      resp = httplib2.Response({'status': '206',
+                                'content-type': 'text/plain'})
+      return resp, payload[int(first):int(last) + 1]
+
+    def _MockInsert(stream, url, size):
+      inserted[url] = stream.read()
+      self.assertEquals(size, len(inserted[url]))
+
+    config = {
+        'url': 'http://foo/bar.txt',
+        'length': len(payload),
+        'rangeSize': 4,
+        'concurrentRequests': 2,
+        'sinks': ['gs://bucket/obj']
+    }
+    with mock.patch.object(httplib2.Http, 'request',
+                           side_effect=_MockRequest):
+      with mock.patch.object(gcs.Gcs, 'InsertObject',
+                             side_effect=_MockInsert):
+        with mock.patch.object(gcs.Gcs, 'ComposeObjects') as mock_compose:
+          with mock.patch.object(gcs.Gcs, 'DeleteObjects',
+                                 return_value={}) as mock_delete:
+            stage = httpinput.HttpInput(config)
+            stage.start_test()
+
+    self.assertEquals(['abcd', 'efgh', 'ij'], sorted(inserted.values()))
+    (bucket, parts, obj, content_type) = mock_compose.call_args[0]
+    self.assertEquals(('bucket', 'obj', 'text/plain'),
+                      (bucket, obj, content_type))
+    self.assertEquals(payload, ''.join(
+        inserted[gcs.Gcs.MakeUrl('bucket', p)] for p in parts))
+    self.assertEquals(sorted(inserted), sorted(mock_delete.call_args[0][0]))
+
+  def testConcurrentRequestsBadRange(self):
+    config = {
+        'url': 'http://foo/bar.txt',
+        'length': 10,
+        'rangeSize': 4,
+        'concurrentRequests': 2,
+        'sinks': ['gs://bucket/obj']
+    }
+    resp = httplib2.Response({'status': '200'})
+    with mock.patch.object(httplib2.Http, 'request',
+                           return_value=(resp, '0123456789')):
+      with mock.patch.object(gcs.Gcs, 'InsertObject') as mock_insert:
+        with mock.patch.object(gcs.Gcs, 'DeleteObjects',
+                               return_value={}) as mock_delete:
+          stage = httpinput.HttpInput(config)
+          self.assertRaises(httpinput.HttpInputError, stage.start_test)
+    self.assertFalse(mock_insert.called)
+    self.assertEquals(3, len(mock_delete.call_args[0][0]))
+
+  def testConnectionPoolReusesAndCaps(self):
+    pool = httpinput.ConnectionPool(max_per_host=1)
+    with pool.Connection('http://foo/a') as first:
+      pass
+    with pool.Connection('http://foo/b') as second:
+      self.assertIs(first, second)
+      acquired = threading.Event()
+
+      def _Acquire():
+        with pool.Connection('http://foo/c'):
+          acquired.set()
+      t = threading.Thread(target=_Acquire)
+      t.start()
+      self.assertFalse(acquired.wait(0.1))
+    t.join()
+    self.assertTrue(acquired.is_set())
+    with pool.Connection('http://bar/a') as other:
+      self.assertIsNot(first, other)
+
+  def testSkipUnchangedReusesPreviousObject(self):
+    httpinput.HttpDownload(id=httpinput._DownloadId('http://foo/bar.txt'),
+                           url='http://foo/bar.txt', sink='gs://bucket/old',
+                           md5='abc', etag='"v1"', length='6').put()
+    requests = []
+
+    def _MockUrlopen(req):
+      requests.append(req)
+      raise urllib2.HTTPError(req.get_full_url(), 304, 'Not Modified', {},
+                              None)
+
+    config = {
+        'url': 'http://foo/bar.txt',
+        'skipUnchanged': True,
+        'sinks': ['gs://bucket/new']
+    }
+    with mock.patch.object(urllib2, 'urlopen', side_effect=_MockUrlopen):
+      with mock.patch.object(gcs.Gcs, 'StatObjects',
+                             return_value={'gs://bucket/old':
+                                           {'md5Hash': 'abc'}}):
+        with mock.patch.object(gcs.Gcs, 'StatObject',
+                               return_value={'md5Hash': 'abc'}):
+          with mock.patch.object(gcs.Gcs, 'CopyObject') as mock_copy:
+            with mock.patch.object(gcs.Gcs, 'SetObjectMetadata') as mock_meta:
+              with mock.patch.object(gcs.Gcs, 'InsertObject') as mock_insert:
+                stage = httpinput.HttpInput(config)
+                stage.start_test()
+
+    self.assertEquals('"v1"', requests[0].get_header('If-none-match'))
+    self.assertFalse(mock_insert.called)
+    mock_copy.assert_called_once_with('gs://bucket/old', 'gs://bucket/new')
+    mock_meta.assert_called_once_with('gs://bucket/new', {
+        'source-url': 'http://foo/bar.txt',
+        'source-unchanged': 'true',
+        'source-etag': '"v1"',
+        'source-length': '6'})
+    download = httpinput.HttpDownload.get_by_id(
+        httpinput._DownloadId('http://foo/bar.txt'))
+    self.assertEquals('gs://bucket/new', download.sink)
+
+  def testSkipUnchangedRecordsDownload(self):
+    class MockMeta(object):
+
+      def getheaders(self, h):
+        return {'ETag': ['"v2"'],
+                'Last-Modified': ['Mon, 05 Oct 2026 10:00:00 GMT'],
+                'Content-Range': ['bytes 0-0/6']}.get(h)
+
+    mock_resp = mock.MagicMock()
+    mock_resp.info.return_value = MockMeta()
+    mock_resp.read.return_value = 'foobar'
+    config = {
+        'url': 'http://foo/bar.txt',
+        'skipUnchanged': True,
+        'sinks': ['gs://bucket/obj']
+    }
+    with mock.patch.object(urllib2, 'urlopen', return_value=mock_resp):
+      with mock.patch.object(gcs.Gcs, 'InsertObject'):
+        with mock.patch.object(gcs.Gcs, 'StatObject',
+                               return_value={'md5Hash': 'def'}):
+          with mock.patch.object(gcs.Gcs, 'SetObjectMetadata') as mock_meta:
+            stage = httpinput.HttpInput(config)
+            stage.start_test()
+
+    metadata = mock_meta.call_args[0][1]
+    self.assertEquals('false', metadata['source-unchanged'])
+    self.assertEquals('"v2"', metadata['source-etag'])
+    download = httpinput.HttpDownload.get_by_id(
+        httpinput._DownloadId('http://foo/bar.txt'))
+    self.assertEquals(('gs://bucket/obj', 'def', '"v2"', '6'),
+                      (download.sink, download.md5, download.etag,
+                       download.length))
+    self.assertEquals('Mon, 05 Oct 2026 10:00:00 GMT', download.last_modified)
+
+  def testSourceUnchanged(self):
+    with mock.patch.object(gcs.Gcs, 'StatObject', return_value={
+        'metadata': {'x-goog-meta-source-unchanged': 'true'}}):
+      self.assertTrue(httpinput.SourceUnchanged('gs://bucket/obj'))
+    with mock.patch.object(gcs.Gcs, 'StatObject', return_value={
+        'metadata': {}}):
+      self.assertFalse(httpinput.SourceUnchanged('gs://bucket/obj'))
+
+  def testLintRangeSize(self):
+    linter = mock.MagicMock()
+    linter.config = {'concurrentRequests': 4}
+    httpinput.HttpInput({}).Lint(linter)
+    checked = [c[0][0] for c in linter.FieldCheck.call_args_list]
+    self.assertIn('rangeSize', checked)
+    self.assertNotIn('shardSize', checked)
+
 
 if __name__ == '__main__':
   basetest.main()
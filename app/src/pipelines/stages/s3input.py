@@ -14,16 +14,21 @@
 
 """Pipeline stages."""
 
+import contextlib
 import copy
-
+import cStringIO as StringIO
+import json
+import logging
+import time
 
 from mapreduce.lib.pipeline import common
 
+import cloudstorage
+from src import parallel
 from src.clients import gcs
 from src.clients import s3
 from src.pipelines import pipeline
 from src.pipelines import shardstage
-from src.pipelines.stages import gcscompositor
 
 
 class S3Input(shardstage.ShardStage):
@@ -33,6 +38,13 @@ class S3Input(shardstage.ShardStage):
   REQUEST_CHUNK_SIZE = CHUNK_SIZE_8MB
   MAX_SHARD_SIZE = CHUNK_SIZE_32MB  # App Engine's response size limit.
   DEFAULT_CONTENT_TYPE = 'binary/octet-stream'
+  BATCH_SIZE = 1 << 28
+  COPY_WORKERS = 8
+  COALESCE_TARGET_SIZE = 1 << 26
+  CONCURRENT_SHARD_SIZE = 1 << 30
+  MANIFEST_SUFFIX = '.manifest.json'
+  PENDING_SUFFIX = '.pending'
+  SYNC_LIST_SUFFIX = '.objects'
 
   @staticmethod
   def GetHelp():
@@ -54,12 +66,50 @@ The stage config should look like this:
     "accessSecret" "...",
   },
   "shardPrefix": "...",
+  "batchSize": maximum_number_of_bytes,
+  "concurrentRequests": 0,
+  "rangeSize": maximum_number_of_bytes,
+  "sync": {
+    "manifest": "gs://bucket_name/manifest_object_name",
+    "appendOnly": false,
+  },
+  "coalesce": {
+    "targetSize": number_of_bytes,
+    "skipHeaderLines": 0,
+    "manifest": "gs://bucket_name/manifest_object_name",
+  },
   "sinks":[destination_object_url]
 }
 ```
 
 * At least one of 'object' and 'objects' must be provided.
 * Within 'objects', 'bucket' is required.
+* When several objects are read, those larger than 'shardSize' each get
+  their own (sharded) transfer. The rest are grouped into batches of up to
+  'batchSize' bytes (256MB by default), and each batch is copied by one
+  task, several objects at a time.
+* If 'concurrentRequests' is set, an object (or shard) larger than
+  'rangeSize' (8MB by default) is fetched as that many ranged GETs at once,
+  each written to a temporary object, and the ranges are then composed.
+  'shardSize' then defaults to 1GB, so separate shards are only made for
+  very large objects.
+* If 'coalesce' is given, all the objects are concatenated, in listing
+  order, into the first sink instead. They are written as parts of about
+  'targetSize' bytes (64MB by default) at once and the parts are then
+  composed. 'skipHeaderLines' drops that many lines from the start of
+  every object but the first, e.g. 1 for CSV files with a header row. A
+  JSON manifest of the byte range of each object in the sink is written
+  to 'manifest', or to the sink's name plus '.manifest.json'. It looks like
+  {"sink": url, "objects": [{"key": s3_url, "start": n, "length": n}]}.
+* If 'sync' is given, only objects under 'objects' that are new or changed
+  (by ETag and size) since the last successful run are read. The key,
+  ETag, size and last-modified time of every object read are kept in the
+  JSON 'manifest'. With 'appendOnly', the listing starts after the last key
+  seen, so objects are expected to be added in name order and never
+  changed. New objects are copied to the first sink's name plus '/' plus
+  their key. Their URLs are the output of the stage and are also written,
+  one per line, to the first sink's name plus '.objects'. Use 'coalesce'
+  instead to concatenate only the new objects into the first sink.
 * 'shardPrefix' can be used to organize the temporary objects, if any,
   created during the chunked transfer (and recomposition) of the object
   in GCS.
@@ -76,30 +126,51 @@ The stage config should look like this:
     """
     storage = s3.S3(config=config.get('s3Credentials'))
 
+    if 'batch' in config:
+      self._CopyBatch(config)
+      return
+
+    sync = config.pop('sync', None)
+    if sync and 'objects' in config:
+      (s3_objects, pending_url, urls) = self._Sync(config, storage, sync)
+      sub_stages = []
+      for cfg in self._SplitObjects(config, s3_objects):
+        s = yield S3Input(cfg)
+        sub_stages.append(s)
+      if sub_stages:
+        with pipeline.After(*sub_stages):
+          yield SaveSyncManifest(pending_url, sync['manifest'], urls)
+      else:
+        yield SaveSyncManifest(pending_url, sync['manifest'], urls)
+      return
+
     s3_objects = []
     if 'object' in config:
-      s3_objects.append(config['object'])
+      s3_objects.append((config['object'], None))
 
     if 'objects' in config:
-      objects = config['objects']
-      for s3_obj in storage.ListBucket(objects['bucket'],
-                                       objects.get('prefix')):
-        s3_objects.append(s3.S3.MakeUrl(objects['bucket'], s3_obj))
+      objects = config.pop('objects')
+      for s3_obj in storage.ListObjects(objects['bucket'],
+                                        objects.get('prefix')):
+        s3_objects.append((s3.S3.MakeUrl(objects['bucket'], s3_obj['name']),
+                           s3_obj['size']))
 
-    s3_objects = zip(s3_objects, config['sinks'])
-    # do the first one here
-    (s3_obj, gcs_obj) = s3_objects.pop()
+    if 'coalesce' in config:
+      self._Coalesce(config, s3_objects)
+      return
 
-    # fan out any others
+    s3_objects = zip(s3_objects, config['sinks'])
     sub_stages = []
-    if 'objects' in config:
-      config.pop('objects')
-    for (next_s3_obj, next_gcs_obj) in s3_objects:
-      cfg = copy.deepcopy(config)
-      cfg['object'] = next_s3_obj
-      cfg['sinks'] = [next_gcs_obj]
-      s = yield S3Input(cfg)
-      sub_stages.append(s)
+    if len(s3_objects) > 1:
+      # fan out large objects one by one and the rest in batches
+      for cfg in self._SplitObjects(config, s3_objects):
+        s = yield S3Input(cfg)
+        sub_stages.append(s)
+      yield common.Append(*sub_stages)
+      return
+
+    ((s3_obj, _), gcs_obj) = s3_objects[0]
+    config['object'] = s3_obj
 
     start = config.get('start')
     if not start:
@@ -111,32 +182,248 @@ The stage config should look like this:
       length = storage.StatObject(s3_obj)['size']
       config['length'] = length
 
+    concurrent = config.get('concurrentRequests', 0)
     if 'shardSize' not in config:
-      config['shardSize'] = self.REQUEST_CHUNK_SIZE
+      if concurrent:
+        config['shardSize'] = self.CONCURRENT_SHARD_SIZE
+      else:
+        config['shardSize'] = self.REQUEST_CHUNK_SIZE
 
     (shards, compositors) = self.ShardStage(config)
     if shards and compositors:
       with pipeline.After(*[(yield shard) for shard in shards]):
         _ = [(yield compositor) for compositor in compositors]
+    elif concurrent and length > config.get('rangeSize',
+                                            self.REQUEST_CHUNK_SIZE):
+      self._TransferConcurrently(config, storage, s3_obj, gcs_obj)
     else:
-      handler = _S3ReadBufferHandler(s3_obj,
-                                     gcs_obj,
-                                     config.get('shardPrefix'))
-
-      storage.ReadObject(url=s3_obj,
-                         handler=handler.Handle,
-                         start=start,
-                         length=length)
-
-      comp_stage = common.Ignore()
-      if handler.chunk_urls:
-        comp_config = {'contentType': handler.content_type,
-                       'sources': handler.chunk_urls,
-                       'sinks': [gcs_obj]}
-        comp_stage = yield gcscompositor.GcsCompositor(comp_config)
-        sub_stages.append(comp_stage)
+      _Transfer(storage, s3_obj, gcs_obj, start, length)
 
-      yield common.Append(*sub_stages)
+  def _Sync(self, config, storage, sync):
+    """Finds the new and changed objects of a prefix.
+
+    With coalesce they are read right away into the first sink, otherwise
+    the list of the GCS objects they are to be copied to is written next to
+    it.
+
+    Args:
+      config: the stage config.
+      storage: the S3 client.
+      sync: the sync options.
+
+    Returns:
+      A tuple of the ((s3 url, size), gcs url) still to copy, the URL of the
+      updated manifest, which is to be put in place once they are, and the
+      URLs of the GCS objects written.
+    """
+    objects = config.pop('objects')
+    manifest_url = sync['manifest']
+    manifest = _LoadManifest(manifest_url)
+    marker = manifest.get('marker') if sync.get('appendOnly') else None
+    known = manifest.setdefault('objects', {})
+
+    s3_objects = []
+    for s3_obj in storage.ListObjects(objects['bucket'], objects.get('prefix'),
+                                      marker=marker):
+      url = s3.S3.MakeUrl(objects['bucket'], s3_obj['name'])
+      entry = known.get(url)
+      if (entry and entry['etag'] == s3_obj['etag'] and
+          entry['size'] == s3_obj['size']):
+        continue
+      s3_objects.append((url, s3_obj))
+      manifest['marker'] = max(manifest.get('marker'), s3_obj['name'])
+    logging.info('%d new or changed objects under s3://%s/%s',
+                 len(s3_objects), objects['bucket'], objects.get('prefix', ''))
+
+    sink = config['sinks'][0]
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(sink)
+    gcs_objects = []
+    for (url, s3_obj) in s3_objects:
+      gcs_obj = sink
+      if 'coalesce' not in config:
+        gcs_obj = gcs.Gcs.MakeUrl(bucket, '%s/%s' % (obj, s3_obj['name']))
+        gcs_objects.append(gcs_obj)
+      known[url] = {'etag': s3_obj['etag'], 'size': s3_obj['size'],
+                    'lastModified': s3_obj['lastModified'], 'sink': gcs_obj}
+
+    gcs_storage = gcs.Gcs()
+    pending_url = manifest_url + self.PENDING_SUFFIX
+    gcs_storage.InsertObject(StringIO.StringIO(json.dumps(manifest)),
+                             url=pending_url, content_type='application/json')
+
+    if 'coalesce' in config:
+      self._Coalesce(config, [(url, s3_obj['size'])
+                              for (url, s3_obj) in s3_objects])
+      return ([], pending_url, [sink])
+    gcs_storage.InsertObject(
+        StringIO.StringIO(''.join(u + '\n' for u in gcs_objects)),
+        url=sink + self.SYNC_LIST_SUFFIX, content_type='text/plain')
+    return ([((url, s3_obj['size']), gcs_obj)
+             for ((url, s3_obj), gcs_obj) in zip(s3_objects, gcs_objects)],
+            pending_url, gcs_objects)
+
+  def _TransferConcurrently(self, config, storage, s3_obj, gcs_obj):
+    """Fetches ranges of an object in parallel and composes them."""
+    start = config['start']
+    end = start + config['length']
+    range_size = config.get('rangeSize', self.REQUEST_CHUNK_SIZE)
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(gcs_obj)
+    url_gen = gcs.Gcs.UrlCreator(
+        bucket, '%s/%s' % (obj, config.get('shardPrefix', '')))
+    ranges = [(position, min(range_size, end - position), url_gen())
+              for position in xrange(start, end, range_size)]
+
+    def _TransferRange((position, length, part_url)):
+      return _Transfer(storage, s3_obj, part_url, position, length)
+
+    gcs_storage = gcs.Gcs()
+    part_urls = [part_url for (_, _, part_url) in ranges]
+    begin = time.time()
+    try:
+      content_types = parallel.Map(_TransferRange, ranges,
+                                   max_workers=config['concurrentRequests'])
+      gcs_storage.ComposeObjects(
+          bucket, [gcs.Gcs.UrlToBucketAndName(u)[1] for u in part_urls], obj,
+          content_types[0] or self.DEFAULT_CONTENT_TYPE)
+    finally:
+      for (part_url, err) in gcs_storage.DeleteObjects(part_urls).iteritems():
+        if err:
+          logging.warning('Could not delete range %s: %r', part_url, err)
+    logging.info('Fetched %d ranges (%d bytes) of %s in %.1fs',
+                 len(ranges), end - start, s3_obj, time.time() - begin)
+
+  def _SplitObjects(self, config, s3_objects):
+    """Makes the configs of the stages that copy many objects.
+
+    Args:
+      config: the stage config.
+      s3_objects: a list of ((s3 url, size), gcs url) to copy.
+
+    Returns:
+      A list of stage configs, each for one large object or a batch of
+      small ones.
+    """
+    shard_size = config.get('shardSize', self.REQUEST_CHUNK_SIZE)
+    batch_size = config.get('batchSize', self.BATCH_SIZE)
+    configs = []
+    batch = []
+    batch_bytes = 0
+    for ((s3_obj, size), gcs_obj) in s3_objects:
+      cfg = copy.deepcopy(config)
+      cfg['sinks'] = [gcs_obj]
+      if size is None or size > shard_size:
+        cfg['object'] = s3_obj
+        if size is not None:
+          cfg['length'] = size
+        configs.append(cfg)
+        continue
+      if batch and batch_bytes + size > batch_size:
+        configs.append(self._BatchConfig(config, batch))
+        batch = []
+        batch_bytes = 0
+      batch.append([s3_obj, gcs_obj, size])
+      batch_bytes += size
+    if batch:
+      configs.append(self._BatchConfig(config, batch))
+    logging.info('copying %d objects with %d stages',
+                 len(s3_objects), len(configs))
+    return configs
+
+  def _BatchConfig(self, config, batch):
+    cfg = copy.deepcopy(config)
+    cfg.pop('object', None)
+    cfg['batch'] = batch
+    cfg['sinks'] = [gcs_obj for (_, gcs_obj, _) in batch]
+    return cfg
+
+  def _CopyBatch(self, config):
+    """Copies a batch of whole objects, several at a time."""
+    credentials = config.get('s3Credentials')
+
+    def _Copy(item):
+      (s3_obj, gcs_obj, size) = item
+      _Transfer(s3.S3(config=credentials), s3_obj, gcs_obj, length=size)
+      return size
+
+    start = time.time()
+    copied = sum(parallel.Map(_Copy, config['batch'],
+                              max_workers=self.COPY_WORKERS))
+    logging.info('Copied %d objects (%d bytes) from S3 in %.1fs',
+                 len(config['batch']), copied, time.time() - start)
+
+  def _Coalesce(self, config, s3_objects):
+    """Concatenates many objects into the first sink and writes a manifest.
+
+    Args:
+      config: the stage config.
+      s3_objects: a list of (s3 url, size) to concatenate, in order.
+    """
+    coalesce = config['coalesce']
+    target_size = coalesce.get('targetSize', self.COALESCE_TARGET_SIZE)
+    skip_lines = coalesce.get('skipHeaderLines', 0)
+    credentials = config.get('s3Credentials')
+    sink = config['sinks'][0]
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(sink)
+    url_gen = gcs.Gcs.UrlCreator(
+        bucket, '%s/%s' % (obj, config.get('shardPrefix', '')))
+    gcs_storage = gcs.Gcs()
+
+    groups = []
+    group_bytes = 0
+    for (s3_obj, size) in s3_objects:
+      if not groups or group_bytes + (size or 0) > target_size:
+        groups.append((url_gen(), []))
+        group_bytes = 0
+      groups[-1][1].append(s3_obj)
+      group_bytes += size or 0
+
+    def _WriteGroup((part_url, group)):
+      storage = s3.S3(config=credentials)
+      lengths = []
+      with gcs_storage.OpenObject(url=part_url, mode='w') as part:
+        for s3_obj in group:
+          first = part_url == groups[0][0] and not lengths
+          writer = _HeaderSkipper(part, 0 if first else skip_lines)
+          with contextlib.closing(storage.OpenObject(url=s3_obj)) as src:
+            while True:
+              data = src.read(gcs.Gcs.STREAM_CHUNK_SIZE)
+              if not data:
+                break
+              writer.write(data)
+          # Keep the last row of an object that does not end with a newline
+          # from running into the first row of the next one.
+          writer.EndLine()
+          lengths.append((s3_obj, writer.written))
+      return lengths
+
+    start = time.time()
+    part_urls = [part_url for (part_url, _) in groups]
+    if not groups:
+      gcs_storage.InsertObject(StringIO.StringIO(''), url=sink, size=0)
+    try:
+      lengths = parallel.Map(_WriteGroup, groups,
+                             max_workers=self.COPY_WORKERS)
+      gcs_storage.ComposeObjects(
+          bucket, [gcs.Gcs.UrlToBucketAndName(u)[1] for u in part_urls], obj,
+          config.get('contentType', self.DEFAULT_CONTENT_TYPE))
+    finally:
+      for (part_url, err) in gcs_storage.DeleteObjects(part_urls).iteritems():
+        if err:
+          logging.warning('Could not delete part %s: %r', part_url, err)
+
+    manifest = {'sink': sink, 'objects': []}
+    position = 0
+    for (s3_obj, length) in sum(lengths, []):
+      manifest['objects'].append(
+          {'key': s3_obj, 'start': position, 'length': length})
+      position += length
+    gcs_storage.InsertObject(
+        StringIO.StringIO(json.dumps(manifest, indent=2)),
+        url=coalesce.get('manifest', sink + self.MANIFEST_SUFFIX),
+        content_type='application/json')
+    logging.info('Coalesced %d objects (%d bytes) from S3 in %d parts in '
+                 '%.1fs', len(s3_objects), position, len(groups),
+                 time.time() - start)
 
   def Lint(self, linter):
     """Stage-specific configuration linting."""
@@ -146,35 +433,85 @@ The stage config should look like this:
     linter.FieldCheck('s3Credentials', field_type=dict, required=True)
     linter.FieldCheck('s3Credentials.accessKey', required=True)
     linter.FieldCheck('s3Credentials.accessSecret', required=True)
-    linter.FieldCheck('shardSize', validator=self.ValidateShardSize)
+    linter.FieldCheck('concurrentRequests', field_type=int)
+    if linter.config.get('concurrentRequests'):
+      linter.FieldCheck('rangeSize', validator=self.ValidateShardSize)
+    else:
+      linter.FieldCheck('shardSize', validator=self.ValidateShardSize)
+    linter.FieldCheck('batchSize', field_type=int)
+    linter.FieldCheck('sync', field_type=dict)
+    linter.FieldCheck('sync.manifest', required='sync' in linter.config,
+                      validator=gcs.Gcs.UrlToBucketAndName)
+    linter.FieldCheck('coalesce', field_type=dict)
+    linter.FieldCheck('coalesce.targetSize', field_type=int)
+    linter.FieldCheck('coalesce.skipHeaderLines', field_type=int)
+    linter.FieldCheck('coalesce.manifest', validator=gcs.Gcs.UrlToBucketAndName)
 
   def ValidateShardSize(self, size):
     if size > self.MAX_SHARD_SIZE:
       raise ValueError('Size exceeds App Engine response limit.')
 
 
-class _S3ReadBufferHandler(object):
-  """Helper for the object reader."""
-
-  def __init__(self, s3_obj, gcs_obj, shard_prefix):
-    self.s3_obj = s3_obj
-    self.gcs_obj = gcs_obj
-    self.gcs_storage = gcs.Gcs()
-    (gcs_bucket, _) = gcs.Gcs.UrlToBucketAndName(gcs_obj)
-    self.url_gen = gcs.Gcs.UrlCreator(gcs_bucket, shard_prefix)
-    self.chunk_urls = []
-    self.content_type = None
-    self.once = True
-
-  def Handle(self, buf, unused_bytes_read, bytes_remaining, ct):
-    """The wrapped handler."""
-    self.content_type = ct
-    if bytes_remaining == 0 and self.once:
-      # got it all in one chunk
-      self.gcs_storage.InsertObject(buf, self.gcs_obj)
-    else:
-      # write chunk to temp gcs obj
-      tmp = self.url_gen()
-      self.chunk_urls.append(tmp)
-      self.gcs_storage.InsertObject(buf, tmp)
-    self.once = False
+class SaveSyncManifest(pipeline.Pipeline):
+  """Puts the manifest of a sync in place once its objects are copied.
+
+  The output is the list of the GCS objects the sync wrote.
+  """
+
+  def run(self, pending_url, manifest_url, urls):
+    storage = gcs.Gcs()
+    storage.CopyObject(pending_url, manifest_url)
+    (bucket, obj) = gcs.Gcs.UrlToBucketAndName(pending_url)
+    storage.DeleteObject(bucket, obj)
+    return urls
+
+
+def _LoadManifest(url):
+  """Returns the sync manifest at url, or an empty one if there is none."""
+  try:
+    with gcs.Gcs().OpenObject(url=url) as f:
+      return json.load(f)
+  except cloudstorage.NotFoundError:
+    return {}
+
+
+def _Transfer(storage, s3_obj, gcs_obj, start=None, length=None):
+  """Streams an object, or a range of it, from S3 into a GCS object.
+
+  Returns:
+    The content type of the S3 object.
+  """
+  with contextlib.closing(storage.OpenObject(url=s3_obj, start=start,
+                                             length=length)) as src:
+    with contextlib.closing(parallel.ReadAhead(
+        src, gcs.Gcs.STREAM_CHUNK_SIZE)) as stream:
+      gcs.Gcs().InsertObject(stream, url=gcs_obj,
+                             content_type=src.content_type, size=length)
+    return src.content_type
+
+
+class _HeaderSkipper(object):
+  """Writes to a file, dropping the first few lines written to it."""
+
+  def __init__(self, f, lines):
+    self.f = f
+    self.lines = lines
+    self.written = 0
+    self.last = None
+
+  def write(self, data):
+    while self.lines and data:
+      newline = data.find('\n')
+      if newline < 0:
+        return
+      data = data[newline + 1:]
+      self.lines -= 1
+    if data:
+      self.f.write(data)
+      self.written += len(data)
+      self.last = data[-1]
+
+  def EndLine(self):
+    """Ends the last line written, if it is not ended yet."""
+    if self.written and self.last != '\n':
+      self.write('\n')
@@ -17,16 +17,34 @@
 
 
 import cStringIO as StringIO
+import json
 
+from mapreduce.lib.pipeline import common
+import cloudstorage
 import mock
 
 import logging
 from src import basetest
 from src.clients import gcs
-from src.clients import s3  # pylint: disable=unused-import
+from src.clients import s3
+from src.pipelines.stages import gcscompositor
 from src.pipelines.stages import s3input
 
 
+class _MockKey(object):
+  """A boto Key opened for reading."""
+
+  def __init__(self, data, content_type='text/plain'):
+    self.stream = StringIO.StringIO(data)
+    self.content_type = content_type
+
+  def read(self, size=0):
+    return self.stream.read(size) if size else self.stream.read()
+
+  def close(self):
+    pass
+
+
 class S3InputTest(basetest.TestCase):
 
   def testSimple(self):
@@ -46,19 +64,18 @@ class S3InputTest(basetest.TestCase):
       return {'size': 10}
 
     mock_s3 = mock.MagicMock()
-    mock_s3_ro = mock.MagicMock()
-    mock_s3.ReadObject = mock_s3_ro
+    mock_s3.OpenObject.return_value = _MockKey('0123456789')
     mock_s3.StatObject = _MockedS3StatObject
     with mock.patch(
         'src.clients.s3.S3',
         autospec=True,
         return_value=mock_s3):
-      stage = s3input.S3Input(config)
-      stage.start_test()
-      mock_s3_ro.assert_called_once_with(url=config['object'],
-                                         handler=mock.ANY,
-                                         start=0,
-                                         length=10)
+      with mock.patch.object(gcs.Gcs, 'InsertObject'):
+        stage = s3input.S3Input(config)
+        stage.start_test()
+        mock_s3.OpenObject.assert_called_once_with(url=config['object'],
+                                                   start=0,
+                                                   length=10)
 
   def testOneObjectNoChunksNoRange(self):
     payload = 'foofoofoofoobar'
@@ -72,23 +89,19 @@ class S3InputTest(basetest.TestCase):
         'sinks': ['gs://bucket/obj']
     }
 
-    def _MockedS3ReadObject(url, handler, start=None, length=None):
-      self.assertIsNotNone(url)
-      self.assertIsNotNone(handler)
-      self.assertIsNotNone(start)
-      self.assertIsNotNone(length)
-
-      buf = StringIO.StringIO(payload)
-      handler(buf, len(payload), 0, content_type)
-
     def _MockedS3StatObject(url, bucket=None, obj=None):
       self.assertIsNotNone(url)
       self.assertIsNone(bucket)
       self.assertIsNone(obj)
       return {'size': len(payload)}
 
+    inserted = []
+
+    def _MockedInsertObject(stream, url, content_type, size):
+      inserted.append((stream.read(), url, content_type, size))
+
     mock_s3 = mock.MagicMock()
-    mock_s3.ReadObject = _MockedS3ReadObject
+    mock_s3.OpenObject.return_value = _MockKey(payload, content_type)
     mock_s3.StatObject = _MockedS3StatObject
     with mock.patch(
         'src.clients.s3.S3',
@@ -96,11 +109,283 @@ class S3InputTest(basetest.TestCase):
         return_value=mock_s3):
       with mock.patch.object(gcs.Gcs,
                              'InsertObject',
-                             return_value=mock.MagicMock()) as mock_gcs_insert:
+                             side_effect=_MockedInsertObject):
         stage = s3input.S3Input(config)
         stage.start_test()
-        mock_gcs_insert.assert_called_once_with(mock.ANY,
-                                                config['sinks'][0])
+    self.assertEquals(
+        [(payload, config['sinks'][0], content_type, len(payload))], inserted)
+
+  def testConcurrentRequests(self):
+    payload = 'abcdefghij'
+    config = {
+        'object': 's3://foo/bar.txt',
+        's3Credentials': {
+            'accessKey': 'key',
+            'accessSecret': 'secret'
+        },
+        'concurrentRequests': 2,
+        'rangeSize': 4,
+        'sinks': ['gs://bucket/obj']
+    }
+    mock_s3 = mock.MagicMock()
+    mock_s3.StatObject.return_value = {'size': len(payload)}
+    mock_s3.OpenObject.side_effect = (
+        lambda url, start, length: _MockKey(payload[start:start + length]))
+    inserted = {}
+
+    def _MockedInsertObject(stream, url, content_type, size):
+      inserted[url] = stream.read()
+      self.assertEquals(size, len(inserted[url]))
+      self.assertEquals('text/plain', content_type)
+
+    with mock.patch('src.clients.s3.S3', autospec=True, return_value=mock_s3):
+      with mock.patch.object(gcs.Gcs, 'InsertObject',
+                             side_effect=_MockedInsertObject):
+        with mock.patch.object(gcs.Gcs, 'ComposeObjects') as mock_compose:
+          with mock.patch.object(gcs.Gcs, 'DeleteObjects',
+                                 return_value={}) as mock_delete:
+            stage = s3input.S3Input(config)
+            stage.start_test()
+
+    (bucket, parts, obj, content_type) = mock_compose.call_args[0]
+    self.assertEquals(('bucket', 'obj', 'text/plain'),
+                      (bucket, obj, content_type))
+    self.assertEquals(payload, ''.join(
+        inserted[gcs.Gcs.MakeUrl('bucket', p)] for p in parts))
+    self.assertEquals(sorted(inserted), sorted(mock_delete.call_args[0][0]))
+
+  def testBatches(self):
+    sizes = {'a': 10, 'b': 10, 'c': 10, 'd': 20, 'big': 60}
+    config = {
+        'objects': {'bucket': 'foo', 'prefix': ''},
+        's3Credentials': {
+            'accessKey': 'key',
+            'accessSecret': 'secret'
+        },
+        'shardSize': 50,
+        'batchSize': 25,
+        'sinks': ['gs://bucket/%s' % name for name in sorted(sizes)]
+    }
+    mock_s3 = mock.MagicMock()
+    mock_s3.ListObjects.return_value = [
+        {'name': name, 'size': sizes[name]} for name in sorted(sizes)]
+    mock_s3.OpenObject.side_effect = (
+        lambda url, **unused_kwargs: _MockKey(url))
+
+    configs = s3input.S3Input(config)._SplitObjects(config, zip(
+        [('s3://foo/%s' % n, sizes[n]) for n in sorted(sizes)],
+        config['sinks']))
+    self.assertEquals(
+        [['s3://foo/a', 's3://foo/b'], ['s3://foo/c'], ['s3://foo/d']],
+        [[o for (o, _, _) in c['batch']] for c in configs if 'batch' in c])
+    big = [c for c in configs if 'batch' not in c]
+    self.assertEquals([('s3://foo/big', 60, ['gs://bucket/big'])],
+                      [(c['object'], c['length'], c['sinks']) for c in big])
+
+    make_url = s3.S3.MakeUrl
+    with mock.patch('src.clients.s3.S3', autospec=True,
+                    return_value=mock_s3) as mock_s3_class:
+      mock_s3_class.MakeUrl.side_effect = make_url
+      with mock.patch.object(gcs.Gcs, 'InsertObject') as mock_gcs_insert:
+        with mock.patch.object(gcscompositor, 'GcsCompositor',
+                               common.Ignore):
+          stage = s3input.S3Input(config)
+          stage.start_test()
+
+    inserted = sorted(c[1]['url'] for c in mock_gcs_insert.call_args_list
+                      if c[1]['size'] != 30)
+    self.assertEquals(['gs://bucket/%s' % n for n in 'abcd'], inserted)
+    for n in 'abcd':
+      mock_s3.OpenObject.assert_any_call(url='s3://foo/%s' % n, start=None,
+                                         length=sizes[n])
+    mock_s3.OpenObject.assert_any_call(url='s3://foo/big', start=30,
+                                       length=30)
+
+  def _Coalesce(self, contents, target_size):
+    """Coalesces s3://foo/ objects into gs://bucket/obj.
+
+    Args:
+      contents: a dict of object names to their data.
+      target_size: the coalesce targetSize.
+
+    Returns:
+      The composed data, the manifest and the DeleteObjects mock.
+    """
+    config = {
+        'objects': {'bucket': 'foo', 'prefix': ''},
+        's3Credentials': {
+            'accessKey': 'key',
+            'accessSecret': 'secret'
+        },
+        'coalesce': {'targetSize': target_size, 'skipHeaderLines': 1},
+        'sinks': ['gs://bucket/obj']
+    }
+    mock_s3 = mock.MagicMock()
+    mock_s3.ListObjects.return_value = [
+        {'name': name, 'size': len(contents[name])} for name in
+        sorted(contents)]
+
+    def _MockedS3OpenObject(url):
+      key = _MockKey(contents[url[len('s3://foo/'):]])
+      # hand the data over in chunks that split the header line
+      key.read = lambda unused_size: key.stream.read(1)
+      return key
+    mock_s3.OpenObject.side_effect = _MockedS3OpenObject
+
+    parts = {}
+
+    def _MockedOpenObject(url, mode):
+      self.assertEquals('w', mode)
+      parts[url] = mock.MagicMock()
+      parts[url].__enter__.return_value = parts[url]
+      return parts[url]
+
+    make_url = s3.S3.MakeUrl
+    with mock.patch('src.clients.s3.S3', autospec=True,
+                    return_value=mock_s3) as mock_s3_class:
+      mock_s3_class.MakeUrl.side_effect = make_url
+      with mock.patch.object(gcs.Gcs, 'OpenObject',
+                             side_effect=_MockedOpenObject):
+        with mock.patch.object(gcs.Gcs, 'ComposeObjects') as mock_compose:
+          with mock.patch.object(gcs.Gcs, 'DeleteObjects',
+                                 return_value={}) as mock_delete:
+            with mock.patch.object(gcs.Gcs, 'InsertObject') as mock_insert:
+              stage = s3input.S3Input(config)
+              stage.start_test()
+
+    (bucket, names, obj, _) = mock_compose.call_args[0]
+    self.assertEquals(('bucket', 'obj'), (bucket, obj))
+    self.assertEquals(sorted(parts), sorted(mock_delete.call_args[0][0]))
+    composed = ''.join(
+        ''.join(c[0][0] for c in parts['gs://bucket/' + n].write.call_args_list)
+        for n in names)
+    self.assertEquals('gs://bucket/obj.manifest.json',
+                      mock_insert.call_args[1]['url'])
+    manifest = json.loads(mock_insert.call_args[0][0].getvalue())
+    self.assertEquals('gs://bucket/obj', manifest['sink'])
+    return (names, composed, manifest)
+
+  def testCoalesce(self):
+    (names, composed, manifest) = self._Coalesce(
+        {'a': 'h\n1,2\n', 'b': 'h\n3,4\n', 'c': 'h\n5,6\n7,8\n'}, 12)
+    self.assertEquals(2, len(names))
+    self.assertEquals('h\n1,2\n3,4\n5,6\n7,8\n', composed)
+    self.assertEquals(
+        [{'key': 's3://foo/a', 'start': 0, 'length': 6},
+         {'key': 's3://foo/b', 'start': 6, 'length': 4},
+         {'key': 's3://foo/c', 'start': 10, 'length': 8}],
+        manifest['objects'])
+
+  def testCoalesceEndsUnterminatedRows(self):
+    (names, composed, manifest) = self._Coalesce(
+        {'a': 'h\n1,2', 'b': 'h\n3,4', 'c': 'h\n', 'd': 'h\n5,6'}, 7)
+    self.assertEquals(3, len(names))
+    self.assertEquals('h\n1,2\n3,4\n5,6\n', composed)
+    self.assertEquals(
+        [{'key': 's3://foo/a', 'start': 0, 'length': 6},
+         {'key': 's3://foo/b', 'start': 6, 'length': 4},
+         {'key': 's3://foo/c', 'start': 10, 'length': 0},
+         {'key': 's3://foo/d', 'start': 10, 'length': 4}],
+        manifest['objects'])
+
+  def _Sync(self, sync, manifest, listed):
+    """Runs a sync of s3://foo/ into gs://bucket/obj.
+
+    Args:
+      sync: the sync options.
+      manifest: the manifest of the last run, or None.
+      listed: the names, etags and sizes of the objects in S3.
+
+    Returns:
+      A tuple of the S3 client mock, a dict of the GCS objects written and
+      the output of the stage.
+    """
+    config = {
+        'objects': {'bucket': 'foo', 'prefix': ''},
+        's3Credentials': {
+            'accessKey': 'key',
+            'accessSecret': 'secret'
+        },
+        'sync': sync,
+        'sinks': ['gs://bucket/obj']
+    }
+    mock_s3 = mock.MagicMock()
+    mock_s3.ListObjects.return_value = [
+        {'name': n, 'etag': e, 'size': size, 'lastModified': 'then'}
+        for (n, e, size) in listed]
+    mock_s3.OpenObject.side_effect = (
+        lambda url, **unused_kwargs: _MockKey(url))
+    written = {}
+
+    def _MockedInsertObject(stream, url, **unused_kwargs):
+      written[url] = stream.read()
+
+    def _MockedOpenObject(url):
+      if manifest is None:
+        raise cloudstorage.NotFoundError(url)
+      self.assertEquals(sync['manifest'], url)
+      f = mock.MagicMock()
+      f.__enter__.return_value = StringIO.StringIO(json.dumps(manifest))
+      return f
+
+    def _MockedCopyObject(src, dest):
+      written[dest] = written.pop(src)
+
+    make_url = s3.S3.MakeUrl
+    with mock.patch('src.clients.s3.S3', autospec=True,
+                    return_value=mock_s3) as mock_s3_class:
+      mock_s3_class.MakeUrl.side_effect = make_url
+      with mock.patch.object(gcs.Gcs, 'InsertObject',
+                             side_effect=_MockedInsertObject):
+        with mock.patch.object(gcs.Gcs, 'OpenObject',
+                               side_effect=_MockedOpenObject):
+          with mock.patch.object(gcs.Gcs, 'CopyObject',
+                                 side_effect=_MockedCopyObject):
+            with mock.patch.object(gcs.Gcs, 'DeleteObject'):
+              stage = s3input.S3Input(config)
+              stage.start_test()
+    return (mock_s3, written, stage.outputs.default.value)
+
+  def testSync(self):
+    manifest = {'marker': 'b', 'objects': {
+        's3://foo/a': {'etag': '"a"', 'size': 2, 'sink': 'gs://bucket/obj/a'},
+        's3://foo/b': {'etag': '"b"', 'size': 2, 'sink': 'gs://bucket/obj/b'}}}
+    (mock_s3, written, output) = self._Sync(
+        {'manifest': 'gs://bucket/sync.json'}, manifest,
+        [('a', '"a"', 2), ('b', '"b2"', 2), ('c', '"c"', 2)])
+
+    mock_s3.ListObjects.assert_called_once_with('foo', '', marker=None)
+    self.assertEquals(['gs://bucket/obj/b', 'gs://bucket/obj/c'], output)
+    self.assertEquals('gs://bucket/obj/b\ngs://bucket/obj/c\n',
+                      written.pop('gs://bucket/obj.objects'))
+    saved = json.loads(written.pop('gs://bucket/sync.json'))
+    self.assertEquals({'gs://bucket/obj/b': 's3://foo/b',
+                       'gs://bucket/obj/c': 's3://foo/c'}, written)
+    self.assertEquals('c', saved['marker'])
+    self.assertEquals(['"a"', '"b2"', '"c"'],
+                      [saved['objects']['s3://foo/%s' % n]['etag']
+                       for n in 'abc'])
+    self.assertEquals('gs://bucket/obj/c',
+                      saved['objects']['s3://foo/c']['sink'])
+
+  def testSyncAppendOnlyFirstRun(self):
+    (mock_s3, written, output) = self._Sync(
+        {'manifest': 'gs://bucket/sync.json', 'appendOnly': True}, None, [])
+
+    mock_s3.ListObjects.assert_called_once_with('foo', '', marker=None)
+    self.assertEquals([], output)
+    self.assertEquals('', written['gs://bucket/obj.objects'])
+    self.assertEquals({'objects': {}},
+                      json.loads(written['gs://bucket/sync.json']))
+
+    manifest = {'marker': 'b', 'objects': {}}
+    (mock_s3, written, _) = self._Sync(
+        {'manifest': 'gs://bucket/sync.json', 'appendOnly': True}, manifest,
+        [('c', '"c"', 2)])
+    mock_s3.ListObjects.assert_called_once_with('foo', '', marker='b')
+    self.assertNotIn('gs://bucket/obj', written)
+    self.assertEquals('gs://bucket/obj/c\n',
+                      written['gs://bucket/obj.objects'])
 
   # TODO(user): flesh out more comprehensive tests
 